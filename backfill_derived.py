@@ -0,0 +1,27 @@
+"""
+Разовый пересчет производных полей игроков
+(reputation_total, territory_count, rank_index), по которым строятся рейтинги.
+Нужен один раз для игроков, созданных до появления этих полей:
+
+    python backfill_derived.py
+"""
+
+import asyncio
+import logging
+
+import config
+from storage import create_storage
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    storage = create_storage(config.STORAGE_BACKEND, uri=config.MONGO_URL, path=config.SQLITE_PATH)
+    updated = await storage.backfill_derived_fields()
+    logger.info(f"Производные поля пересчитаны: обновлено {updated} игроков")
+    await storage.ensure_indexes()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
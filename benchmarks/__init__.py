@@ -0,0 +1,4 @@
+"""
+Бенчмарки подсистем бота
+Запуск из корня проекта: python -m benchmarks.<имя_модуля>
+"""
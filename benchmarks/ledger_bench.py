@@ -0,0 +1,75 @@
+"""
+Бенчмарк журнала транзакций
+Пишет миллионы записей, сжимает журнал и сравнивает восстановление
+баланса до и после сжатия
+
+    python -m benchmarks.ledger_bench --entries 1000000 --users 10000 --backend memory
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from ledger import Ledger
+from storage import create_storage
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Журнал транзакций на больших объемах")
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--replays", type=int, default=1000)
+    parser.add_argument("--backend", default="memory", choices=["memory", "sqlite"])
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = create_storage(args.backend, path=os.path.join(tmp, "ledger.db"))
+        ledger = Ledger(storage, batch_size=10_000)
+        balances = {user_id: 1000 for user_id in range(1, args.users + 1)}
+
+        started = time.perf_counter()
+        for _ in range(args.entries):
+            user_id = rng.randint(1, args.users)
+            delta = rng.randint(-100, 150)
+            balances[user_id] += delta
+            ledger.record(user_id, delta, balances[user_id], "bench")
+            if len(ledger.buffer) >= ledger.batch_size:
+                await ledger.flush()
+        await ledger.flush()
+        elapsed = time.perf_counter() - started
+        print(f"Запись: {args.entries} записей за {elapsed:.2f} с ({args.entries / elapsed:.0f} зап/с)")
+
+        sample = rng.sample(sorted(balances), min(args.replays, args.users))
+
+        async def measure_replays(label):
+            timings = []
+            for user_id in sample:
+                replay_started = time.perf_counter()
+                replayed = await ledger.replay(user_id)
+                timings.append(time.perf_counter() - replay_started)
+                assert replayed == balances[user_id], (user_id, replayed, balances[user_id])
+            timings.sort()
+            print(f"Восстановление {label}: p50 {statistics.median(timings) * 1000:.3f} мс, "
+                  f"p99 {timings[int(len(timings) * 0.99) - 1] * 1000:.3f} мс")
+
+        await measure_replays("до сжатия")
+
+        started = time.perf_counter()
+        folded = await ledger.compact(cutoff_seq=time.time_ns())
+        elapsed = time.perf_counter() - started
+        print(f"Сжатие: {folded} записей за {elapsed:.2f} с ({folded / elapsed:.0f} зап/с)")
+
+        await measure_replays("после сжатия")
+
+        if hasattr(storage, "close"):
+            storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
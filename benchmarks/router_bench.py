@@ -0,0 +1,167 @@
+"""
+Бенчмарк маршрутизации callback'ов
+Сравнивает прежнюю цепочку if/elif из handle_callback с CallbackRouter
+на одном и том же потоке нажатий (только выбор обработчика, без самих обработчиков),
+а также разбор тех же кнопок в формате callback_codec
+
+    python -m benchmarks.router_bench --presses 1000000
+"""
+
+import argparse
+import random
+import time
+
+from callback_codec import callback_codec
+from callback_router import CallbackRouter, choice
+from config import SHOP_ITEMS
+
+# Нажатия и их доли: игровые кнопки преобладают
+PRESSES = [
+    ("slots_100", 12), ("slots_1000", 4), ("blackjack_hit_2", 10), ("blackjack_stand_2", 6),
+    ("blackjack_100", 5), ("dice_100", 5), ("dice_pred_7", 5), ("roulette_red", 4),
+    ("roulette_bet_100", 4), ("roulette_pick_number_17", 2), ("crime_robbery", 6),
+    ("main_menu", 8), ("casino_menu", 5), ("profile", 4), ("top_money", 2), ("top_menu", 2),
+    ("daily_bonus", 2), ("collect_income", 2), ("buy_territory", 1), ("buy_territory_Կենտրոն", 1),
+    ("my_territories", 1), ("help", 1), ("escape", 1), ("gang_menu", 1), ("shop_menu", 1),
+    (f"buy_{next(iter(SHOP_ITEMS))}", 1), ("unknown_button", 1)
+]
+
+
+def legacy_chain(data: str) -> str:
+    """Цепочка проверок в том порядке, в каком она была в handle_callback"""
+    if data == "main_menu":
+        return "main_menu"
+    elif data == "profile":
+        return "profile"
+    elif data == "profile_stats":
+        return "profile_stats"
+    elif data == "profile_achievements":
+        return "profile_achievements"
+    elif data == "shop_menu":
+        return "shop_menu"
+    elif data == "crime_menu":
+        return "crime_menu"
+    elif data == "casino_menu":
+        return "casino_menu"
+    elif data == "poker_menu":
+        return "poker_menu"
+    elif data == "casino_stats":
+        return "casino_stats"
+    elif data == "territories":
+        return "territories"
+    elif data == "gang":
+        return "gang"
+    elif data == "group":
+        return "group"
+    elif data.startswith("slots_"):
+        return "slots"
+    elif data.startswith("roulette_"):
+        return "roulette"
+    elif data.startswith("blackjack_"):
+        return "blackjack"
+    elif data.startswith("dice_"):
+        return "dice"
+    elif data.startswith("crime_"):
+        return "crime"
+    elif data == "territories_menu":
+        return "territories"
+    elif data.startswith("buy_territory"):
+        return "buy_territory"
+    elif data == "collect_income":
+        return "collect_income"
+    elif data == "my_territories":
+        return "my_territories"
+    elif data.startswith("buy_"):
+        return "shop"
+    elif data.startswith("gang_"):
+        return "gang"
+    elif data.startswith("group_"):
+        return "group"
+    elif data == "daily_bonus":
+        return "daily_bonus"
+    elif data == "help":
+        return "help"
+    elif data == "gang_menu":
+        return "gang_menu"
+    elif data == "escape":
+        return "escape"
+    elif data == "top_menu":
+        return "top_menu"
+    elif data.startswith("top_"):
+        return "top"
+    return "unknown"
+
+
+def build_router() -> CallbackRouter:
+    """Те же маршруты, что в MafiaCasinoBot.setup_callback_routes"""
+    router = CallbackRouter(codec=callback_codec)
+    for data in ("main_menu", "shop_menu", "crime_menu", "casino_menu", "poker_menu", "territories",
+                 "territories_menu", "gang", "gang_menu", "help", "top_menu", "profile", "profile_stats",
+                 "profile_achievements", "daily_bonus", "casino_stats", "slots_menu", "roulette_menu",
+                 "roulette_number", "blackjack_menu", "blackjack_hit", "blackjack_stand", "dice_menu",
+                 "escape", "buy_territory", "collect_income", "my_territories"):
+        router.exact(data, data)
+    router.prefix("slots_", "slots", arg=int)
+    router.prefix("roulette_", "roulette", arg=choice("red", "black", "even", "odd"))
+    router.prefix("roulette_pick_number_", "roulette", arg=int)
+    router.prefix("roulette_bet_", "roulette", arg=int)
+    router.prefix("blackjack_", "blackjack", arg=int)
+    router.prefix("blackjack_hit_", "blackjack", arg=int)
+    router.prefix("blackjack_stand_", "blackjack", arg=int)
+    router.prefix("dice_", "dice", arg=int)
+    router.prefix("dice_pred_", "dice", arg=int)
+    router.prefix("crime_", "crime", arg=choice("pickpocket", "robbery", "smuggling", "bank"))
+    router.prefix("buy_territory_", "buy_territory")
+    router.prefix("buy_", "shop", arg=choice(*SHOP_ITEMS))
+    router.prefix("gang_", "gang")
+    router.prefix("top_", "top", arg=choice("money", "rank", "reputation", "territories"))
+    return router
+
+
+def measure(name: str, func, presses) -> float:
+    started = time.perf_counter()
+    for data in presses:
+        func(data)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<16} {elapsed * 1e9 / len(presses):8.1f} нс/нажатие")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Цепочка if/elif против CallbackRouter")
+    parser.add_argument("--presses", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    values = [data for data, _ in PRESSES]
+    weights = [weight for _, weight in PRESSES]
+    presses = rng.choices(values, weights, k=args.presses)
+
+    router = build_router()
+    legacy = measure("if/elif", legacy_chain, presses)
+    routed = measure("router", router.resolve, presses)
+    measure("router no cache", router._resolve, presses)
+    print(f"Ускорение: x{legacy / routed:.2f}")
+
+    # Худший случай для цепочки - кнопки из ее конца
+    tail = ["top_money", "escape", "gang_menu"] * (args.presses // 3)
+    legacy = measure("if/elif tail", legacy_chain, tail)
+    routed = measure("router tail", router.resolve, tail)
+    print(f"Ускорение на конце цепочки: x{legacy / routed:.2f}")
+
+    # Те же нажатия кнопками в формате callback_codec
+    encoded = {}
+    for data in values:
+        route, arg = router._resolve(data)
+        if route is not None and route.pattern in callback_codec:
+            encoded[data] = callback_codec.encode(route.pattern, arg)
+    coded = [encoded.get(data, data) for data in presses]
+    size = sum(len(data.encode()) for data in presses) / len(presses)
+    coded_size = sum(len(data.encode()) for data in coded) / len(coded)
+    print(f"Средний размер callback_data: {size:.1f} -> {coded_size:.1f} байт")
+    measure("router codec", router.resolve, coded)
+
+
+if __name__ == "__main__":
+    main()
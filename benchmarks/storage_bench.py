@@ -0,0 +1,110 @@
+"""
+Бенчмарк хранилищ игроков
+Прогоняет одинаковую нагрузку (как у обработчиков бота) на каждом хранилище
+
+    python -m benchmarks.storage_bench --users 2000 --ops 20000 --backends memory sqlite
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+import config
+from storage import create_storage
+
+# Доли операций в нагрузке: чтения преобладают, как при нажатиях на кнопки
+WORKLOAD = [
+    ("get_user", 0.55),
+    ("apply_delta", 0.30),
+    ("update_user", 0.08),
+    ("get_top_users", 0.05),
+    ("get_users_summary", 0.02)
+]
+
+
+async def run_workload(storage, users: int, ops: int, seed: int) -> Dict[str, List[float]]:
+    """Выполняет нагрузку и возвращает задержки по типам операций (секунды)"""
+    rng = random.Random(seed)
+    timings: Dict[str, List[float]] = {name: [] for name, _ in WORKLOAD}
+    timings["create_user"] = []
+
+    for user_id in range(1, users + 1):
+        started = time.perf_counter()
+        await storage.create_user(user_id, f"user{user_id}", f"Player {user_id}")
+        timings["create_user"].append(time.perf_counter() - started)
+
+    names = [name for name, _ in WORKLOAD]
+    weights = [weight for _, weight in WORKLOAD]
+    for operation in rng.choices(names, weights, k=ops):
+        user_id = rng.randint(1, users)
+        started = time.perf_counter()
+        if operation == "get_user":
+            await storage.get_user(user_id)
+        elif operation == "apply_delta":
+            bet = rng.choice([10, 50, 100, 500, 1000])
+            win = bet * rng.choice([0, 0, 0, 2, 5])
+            await storage.apply_delta(
+                user_id,
+                inc={"money": win - bet, "statistics.slots_played": 1},
+                min_money=bet
+            )
+        elif operation == "update_user":
+            await storage.update_user(user_id, {"last_casino_time": time.time()})
+        elif operation == "get_top_users":
+            await storage.get_top_users(rng.choice(["money", "reputation"]), 10)
+        else:
+            await storage.get_users_summary()
+        timings[operation].append(time.perf_counter() - started)
+    return timings
+
+
+def report(backend: str, timings: Dict[str, List[float]], elapsed: float):
+    total_ops = sum(len(values) for values in timings.values())
+    print(f"\n== {backend}: {total_ops} операций за {elapsed:.2f} с ({total_ops / elapsed:.0f} оп/с)")
+    print(f"{'операция':<20}{'кол-во':>8}{'p50, мс':>10}{'p99, мс':>10}")
+    for name, values in timings.items():
+        if not values:
+            continue
+        values = sorted(values)
+        p50 = statistics.median(values) * 1000
+        p99 = values[min(len(values) - 1, int(len(values) * 0.99))] * 1000
+        print(f"{name:<20}{len(values):>8}{p50:>10.3f}{p99:>10.3f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Сравнение хранилищ игроков")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--backends", nargs="+", default=["memory", "sqlite"],
+                        help="memory, sqlite, mongo (mongo берет MONGO_URL из окружения)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in args.backends:
+            if backend == "mongo":
+                storage = create_storage("mongo", uri=config.MONGO_URL)
+                # Отдельная база, чтобы не задеть данные игроков
+                storage.users = storage.client["storage_benchmark"]["users"]
+                await storage.users.drop()
+                await storage.ensure_indexes()
+            else:
+                storage = create_storage(backend, path=os.path.join(tmp, "bench.db"))
+
+            started = time.perf_counter()
+            timings = await run_workload(storage, args.users, args.ops, args.seed)
+            report(backend, timings, time.perf_counter() - started)
+
+            if backend == "mongo":
+                await storage.users.drop()
+            elif hasattr(storage, "close"):
+                storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+"""
+Бенчмарк многопроцессного режима
+Прогоняет одинаковый поток нажатий кнопок через супервизор (workers.py) с
+1, 2, ... N процессами-обработчиками и сравнивает пропускную способность.
+Обработчик повторяет работу бота без обращений к Telegram: разбор обновления,
+чтение и изменение игрока, игровая логика и клавиатура ответа
+
+    python -m benchmarks.worker_bench --workers 1 2 4 --updates 20000 --work 20
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import time
+from typing import Dict, List
+
+from telegram import Update
+
+from games import casino_games
+from keyboards import keyboards
+from storage import MemoryStorage
+from workers import Supervisor, serve_worker
+
+BETS = [10, 50, 100, 500, 1000]
+
+
+def make_update(update_id: int, user_id: int) -> Dict:
+    """Нажатие кнопки в том виде, в каком его присылает Telegram"""
+    sender = {"id": user_id, "is_bot": False, "first_name": f"Player {user_id}"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": sender,
+            "chat_instance": str(user_id),
+            "data": "blackjack_100",
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bot"},
+                "text": "🃏"
+            }
+        }
+    }
+
+
+def bench_worker(index: int, count: int, sock):
+    """Процесс-обработчик бенчмарка; объем работы на обновление - из WORKER_BENCH_WORK"""
+    work = int(os.environ.get("WORKER_BENCH_WORK", "20"))
+    storage = MemoryStorage()
+
+    async def handle(data: Dict):
+        update = Update.de_json(data, None)
+        user_id = update.callback_query.from_user.id
+        if await storage.get_user(user_id) is None:
+            await storage.create_user(user_id, None, update.callback_query.from_user.first_name)
+        for round_number in range(work):
+            bet = BETS[round_number % len(BETS)]
+            game = casino_games.play_blackjack(bet)
+            result = casino_games.blackjack_stand(game["player_cards"], game["dealer_cards"], bet)
+            await storage.apply_delta(user_id, inc={"money": result["win_amount"] - bet})
+        keyboards.blackjack_game(work).to_dict()
+
+    asyncio.run(serve_worker(sock, handle))
+
+
+async def run_once(workers: int, updates: List[Dict]) -> float:
+    """Пропускная способность (обновлений в секунду) с workers процессами"""
+    supervisor = Supervisor(bench_worker, workers, max_pending=500)
+    await supervisor.start()
+    try:
+        started = time.perf_counter()
+        for data in updates:
+            await supervisor.submit(data)
+        while supervisor.stats["acked"] < len(updates):
+            await asyncio.sleep(0.005)
+        elapsed = time.perf_counter() - started
+    finally:
+        await supervisor.stop()
+    return len(updates) / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Масштабирование по процессам-обработчикам")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--work", type=int, default=20, help="раздач блэкджека на одно обновление")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # Процессы запускаются через spawn и читают объем работы из окружения
+    os.environ["WORKER_BENCH_WORK"] = str(args.work)
+    rng = random.Random(args.seed)
+    updates = [make_update(update_id, rng.randint(1, args.users)) for update_id in range(1, args.updates + 1)]
+
+    print(f"{'процессов':>10}{'обн/с':>12}{'ускорение':>12}")
+    baseline = None
+    for workers in args.workers:
+        rate = await run_once(workers, updates)
+        baseline = baseline or rate
+        print(f"{workers:>10}{rate:>12.0f}{rate / baseline:>11.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
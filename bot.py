@@ -1,101 +1,305 @@
 """
 Основной файл Telegram бота "Мафиозное Казино"
 Содержит все обработчики команд и callback'ов
+Импорт модуля ничего не запускает: хранилище, кэш игроков и приложение
+создает фабрика create_bot, логирование настраивает main (logging_setup.py)
 """
 
+import time
+
+# Отсчет холодного старта: до импорта telegram и модулей бота
+STARTED_AT = time.perf_counter()
+
 import logging
 import asyncio
-import signal
-import sys
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent, InlineQueryResultPhoto
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters, InlineQueryHandler
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
 
 # Импортируем наши модули
 
 import config
-from mongo_database import MongoDB
+from typing import Optional
+
+from storage import create_storage, TimedStorage, RANK_NAMES
+from user_cache import UserCache
+from ledger import Ledger
+from leaderboard import leaderboard, BOARDS
+from rank_engine import rank_engine
+from user_locks import user_locks
+from webhook_server import run_webhook
+from callback_router import CallbackRouter, CallbackRequest, RateLimiter, choice
+from callback_codec import callback_codec, CRIME_TYPES, ROULETTE_BETS
+from outbound import OutboundScheduler
+from broadcast import Broadcaster
+from render import renderer
+from metrics import latency, StartupBudget, MetricsServer, registry, timed_command, callback_seconds, command_seconds, db_seconds, db_errors, api_seconds, api_requests
+from request_context import BotContext, request_scoped
+from lifecycle import in_flight, run_polling, run_worker
+from workers import run_workers, worker_path
+from logging_setup import setup_logging, worker_log_file
+from snapshot import StateSnapshot
+from sessions import SessionStore, create_session_store, blackjack_state, blackjack_hand
 from games import casino_games
 from crime_system import crime_system
 from keyboards import keyboards
 from translations import get_text
-from config import SHOP_ITEMS, ADMIN_IDS
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('mafia_casino_bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+from config import SHOP_ITEMS, ADMIN_IDS, CRIMES, DAILY_BONUS_AMOUNT, DAILY_BONUS_COOLDOWN
+
 logger = logging.getLogger(__name__)
 
-db = MongoDB(config.MONGO_URL)
+startup = StartupBudget(config.STARTUP_BUDGET, started=STARTED_AT)
+startup.mark("import")
+
+# Сервисы создает init_services (через create_bot), а не импорт модуля:
+# инструменты и проверки, которым нужны только функции бота, не открывают
+# соединений с базой
+storage = None
+db: Optional[UserCache] = None
+ledger: Optional[Ledger] = None
+sessions: Optional[SessionStore] = None
+snapshot: Optional[StateSnapshot] = None
+broadcaster: Optional[Broadcaster] = None
+
+
+def init_services():
+    """Создает хранилище, кэш игроков и фоновые службы; повторный вызов ничего не делает"""
+    global storage, db, ledger, sessions, snapshot, broadcaster
+    if db is not None:
+        return
+    storage = TimedStorage(
+        create_storage(config.STORAGE_BACKEND, uri=config.MONGO_URL, path=config.SQLITE_PATH),
+        config.STORAGE_BACKEND
+    )
+    db = UserCache(
+        storage,
+        max_size=config.USER_CACHE_MAX_SIZE,
+        ttl=config.USER_CACHE_TTL,
+        flush_interval=config.USER_CACHE_FLUSH_INTERVAL,
+        rank_engine=rank_engine
+    )
+    ledger = Ledger(
+        storage,
+        batch_size=config.LEDGER_BATCH_SIZE,
+        flush_interval=config.LEDGER_FLUSH_INTERVAL,
+        retention=config.LEDGER_RETENTION,
+        compact_interval=config.LEDGER_COMPACT_INTERVAL
+    )
+    db.subscribe(ledger.on_mutation)
+    db.subscribe(leaderboard.on_mutation)
+    sessions = create_session_store(
+        config.SESSION_BACKEND,
+        storage,
+        ttl=config.SESSION_TTL,
+        purge_interval=config.SESSION_PURGE_INTERVAL
+    )
+    snapshot = StateSnapshot(
+        config.SNAPSHOT_PATH,
+        max_age=config.SNAPSHOT_MAX_AGE,
+        hot_users=config.SNAPSHOT_HOT_USERS
+    )
+    broadcaster = Broadcaster(
+        db,
+        concurrency=config.BROADCAST_CONCURRENCY,
+        report_interval=config.BROADCAST_REPORT_INTERVAL
+    )
+
+
+def create_bot(worker_index: int = 0, worker_count: int = 1) -> "MafiaCasinoBot":
+    """Фабрика приложения: сервисы, бот и его обработчики"""
+    init_services()
+    bot = MafiaCasinoBot(worker_index=worker_index, worker_count=worker_count)
+    startup.mark("build")
+    return bot
+
+
+# Поля документа игрока, которые читают обработчики профиля
+PROFILE_FIELDS = ("name", "first_name", "username", "money", "rank", "reputation",
+                  "territories", "inventory", "gang", "jail_time")
+CRIME_FIELDS = ("money", "reputation", "statistics", "last_crime_time", "jail_time")
+
 
 class MafiaCasinoBot:
-    def __init__(self):
-        """Инициализация бота"""
-        # Настройка логирования
-        logging.basicConfig(
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            level=logging.INFO,
-            handlers=[
-                logging.FileHandler('mafia_casino_bot.log', encoding='utf-8'),
-                logging.StreamHandler()
-            ]
-        )
+    def __init__(self, worker_index: int = 0, worker_count: int = 1):
+        """
+        Инициализация бота
+        worker_index/worker_count - номер процесса-обработчика и число процессов
+        в многопроцессном режиме (см. workers.py)
+        """
+        self.worker_index = worker_index
+        self.worker_count = worker_count
         self.logger = logging.getLogger(__name__)
+        init_services()
+        
+        # Исходящие запросы: лимиты Telegram и приоритет ответов над рассылкой
+        # Общий лимит бота делится между процессами; чаты игроков за процессом закреплены
+        self.outbound = OutboundScheduler(
+            global_rate=config.OUTBOUND_GLOBAL_RATE / worker_count,
+            chat_rate=config.OUTBOUND_CHAT_RATE,
+            chat_burst=config.OUTBOUND_CHAT_BURST,
+            group_rate=config.OUTBOUND_GROUP_RATE,
+            group_burst=config.OUTBOUND_GROUP_BURST,
+            max_retries=config.OUTBOUND_MAX_RETRIES
+        )
         
         # Создание приложения
-        self.application = Application.builder().token(config.BOT_TOKEN).build()
+        self.application = (
+            Application.builder()
+            .token(config.BOT_TOKEN)
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .post_shutdown(self.post_shutdown)
+            .concurrent_updates(config.CONCURRENT_UPDATES)
+            .rate_limiter(self.outbound)
+            .context_types(ContextTypes(context=BotContext))
+            .build()
+        )
+        
+        if worker_count > 1:
+            snapshot.path = worker_path(config.SNAPSHOT_PATH, worker_index)
+            # Сообщения групп правят процессы разных игроков: их отпечатки не ведем
+            renderer.private_only = True
+        
+        # Метрики: у каждого процесса свой эндпоинт
+        self.metrics_server = MetricsServer()
+        self.metrics_port = config.METRICS_PORT + worker_index if config.METRICS_PORT else 0
+        self.register_metrics()
+        
+        # Поздравления с новым званием
+        rank_engine.subscribe(self.on_rank_change)
         
         # Настройка обработчиков
+        self.router = CallbackRouter(codec=callback_codec)
+        self.rate_limiter = RateLimiter(config.CALLBACK_RATE_LIMITS)
+        self.setup_callback_routes()
         self.setup_handlers()
-        
-        # Настройка обработчика сигналов для сохранения игр при завершении
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
+
     
-    def signal_handler(self, signum, frame):
-        """Обработчик сигналов для сохранения игр при завершении"""
-        print(f"\nПолучен сигнал {signum}. Сохраняем игры и завершаем работу...")
-        save_games()
-        sys.exit(0)
+    def register_metrics(self):
+        """Показатели, которые читаются при запросе метрик: кэш, очереди, обработчики"""
+        cache = lambda key: lambda: db.get_stats()[key]
+        registry.collected("user_cache_hit_ratio", "Доля попаданий в кэш игроков", cache("hit_ratio"))
+        registry.collected("user_cache_hits_total", "Попадания в кэш игроков", cache("hits"), kind="counter")
+        registry.collected("user_cache_misses_total", "Промахи кэша игроков", cache("misses"), kind="counter")
+        registry.collected("user_cache_size", "Игроков в кэше", cache("size"))
+        registry.collected("user_cache_dirty", "Игроков с несохраненными изменениями", cache("dirty"))
+        registry.collected("callback_codec_cache_hit_ratio", "Доля попаданий в кэш разбора callback_data",
+                           lambda: self.hit_ratio(callback_codec.get_stats()))
+        registry.collected("outbound_queued", "Запросов в исходящих очередях",
+                           lambda: self.outbound.get_stats()["queued"], ("lane",))
+        registry.collected("outbound_in_flight", "Отправляемых запросов", lambda: self.outbound.in_flight)
+        registry.collected("update_queue", "Обновлений в очереди приложения", lambda: self.application.update_queue.qsize())
+        registry.collected("handlers_in_flight", "Выполняемых обработчиков", lambda: in_flight.get_stats()["active"])
+        registry.collected("user_locks_active", "Игроков с занятой блокировкой", lambda: user_locks.get_stats()["active"])
+        registry.collected("callback_rate_limited_total", "Нажатий, отклоненных ограничением частоты",
+                           lambda: self.rate_limiter.stats["limited"], kind="counter")
+        registry.collected("ledger_buffered", "Записей журнала в буфере", lambda: len(ledger.buffer))
+        registry.collected("sessions_total", "Операции игровых сессий", sessions.get_stats, ("operation",), kind="counter")
+    
+    @staticmethod
+    def hit_ratio(stats):
+        lookups = stats["hits"] + stats["misses"]
+        return stats["hits"] / lookups if lookups else 0.0
+    
+    def on_rank_change(self, user_id, old_rank, new_rank, promoted):
+        """Слушатель RankEngine: сообщает игроку о повышении (понижения проходят молча)"""
+        if promoted:
+            self.application.create_task(self.notify_rank_up(user_id, new_rank))
+    
+    async def notify_rank_up(self, user_id, rank):
+        try:
+            await self.application.bot.send_message(user_id, get_text("rank_up", rank=rank), parse_mode=ParseMode.HTML)
+        except TelegramError as e:
+            logger.warning(f"Не удалось сообщить {user_id} о новом звании: {e}")
+    
+    async def post_init(self, application: Application):
+        """Готовит базу и запускает фоновые задачи после инициализации приложения"""
+        await db.ensure_indexes()
+        if config.CHECK_QUERY_PLANS:
+            await db.check_query_plans()
+        await leaderboard.rebuild(db)
+        # Горячие игроки с прошлого запуска
+        await snapshot.load(db)
+        db.start()
+        # Общие для всех процессов фоновые работы выполняет первый из них
+        ledger.start(compact=self.worker_index == 0)
+        sessions.start_purging()
+        if self.worker_count > 1:
+            leaderboard.start_refreshing(db, config.LEADERBOARD_REFRESH_INTERVAL)
+        if self.worker_index == 0:
+            await broadcaster.resume(application.bot)
+        if self.metrics_port:
+            try:
+                await self.metrics_server.start(config.METRICS_LISTEN, self.metrics_port)
+            except OSError as e:
+                logger.error(f"Эндпоинт метрик не запущен (порт {self.metrics_port}): {e}")
+        startup.mark("ready")
+        startup.report()
+
+    async def post_stop(self, application: Application):
+        """
+        Прерывает рассылки с сохранением прогресса, пока бот еще может отправлять,
+        и сохраняет снимок горячих игроков: обработчики к этому моменту уже завершены
+        """
+        await broadcaster.stop()
+        await leaderboard.stop()
+        try:
+            await snapshot.save(db)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить снимок состояния: {e}")
+
+    async def post_shutdown(self, application: Application):
+        """Сохраняет накопленные в кэше изменения при остановке"""
+        await self.metrics_server.stop()
+        await sessions.stop()
+        await db.stop()
+        await ledger.stop()
+        self.logger.info(f"Кэш пользователей сохранен: {db.get_stats()}")
     
     def setup_handlers(self):
         """Настраивает обработчики команд и callback'ов"""
+        # Обновления обрабатываются параллельно, но одного игрока - по очереди
+        # Контекст запроса создается внутри блокировки: его изменения пишутся до ее снятия
+        scoped = request_scoped(db)
+        serialized = lambda handler: in_flight.tracked(startup.tracked(user_locks.serialized(scoped(handler))))
+        command = lambda name, handler: CommandHandler(name, serialized(timed_command(name, handler)))
+        
         # Добавляем обработчики команд
-        self.application.add_handler(CommandHandler("start", self.start_command))
-        self.application.add_handler(CommandHandler("help", self.help_command))
-        self.application.add_handler(CommandHandler("profile", self.profile_command))
-        self.application.add_handler(CommandHandler("balance", self.balance_command))
-        self.application.add_handler(CommandHandler("casino", self.casino_command))
-        self.application.add_handler(CommandHandler("crime", self.crime_command))
-        self.application.add_handler(CommandHandler("gang", self.gang_command))
-        self.application.add_handler(CommandHandler("top", self.top_command))
-        self.application.add_handler(CommandHandler("daily_bonus", self.daily_bonus_command))
-        self.application.add_handler(CommandHandler("rank", self.rank_command))
-        self.application.add_handler(CommandHandler("stats", self.stats_command))
-        self.application.add_handler(CommandHandler("broadcast", self.broadcast_command))
-        self.application.add_handler(CommandHandler("ban", self.ban_command))
-        self.application.add_handler(CommandHandler("unban", self.unban_command))
-        self.application.add_handler(CommandHandler("addmoney", self.addmoney_command))
-        self.application.add_handler(CommandHandler("removemoney", self.removemoney_command))
-        self.application.add_handler(CommandHandler("setrank", self.setrank_command))
-        self.application.add_handler(CommandHandler("userstats", self.userstats_command))
+        self.application.add_handler(command("start", self.start_command))
+        self.application.add_handler(command("help", self.help_command))
+        self.application.add_handler(command("profile", self.profile_command))
+        self.application.add_handler(command("balance", self.balance_command))
+        self.application.add_handler(command("casino", self.casino_command))
+        self.application.add_handler(command("crime", self.crime_command))
+        self.application.add_handler(command("gang", self.gang_command))
+        self.application.add_handler(command("top", self.top_command))
+        self.application.add_handler(command("daily_bonus", self.daily_bonus_command))
+        self.application.add_handler(command("rank", self.rank_command))
+        self.application.add_handler(command("stats", self.stats_command))
+        self.application.add_handler(command("broadcast", self.broadcast_command))
+        self.application.add_handler(command("broadcast_stop", self.broadcast_stop_command))
+        self.application.add_handler(command("ban", self.ban_command))
+        self.application.add_handler(command("unban", self.unban_command))
+        self.application.add_handler(command("addmoney", self.addmoney_command))
+        self.application.add_handler(command("removemoney", self.removemoney_command))
+        self.application.add_handler(command("setrank", self.setrank_command))
+        self.application.add_handler(command("userstats", self.userstats_command))
+        self.application.add_handler(command("cachestats", self.cachestats_command))
+        self.application.add_handler(command("ledger", self.ledger_command))
+        self.application.add_handler(command("latency", self.latency_command))
+        self.application.add_handler(command("metrics", self.metrics_command))
         
         # Обработчик callback-запросов
-        self.application.add_handler(CallbackQueryHandler(self.handle_callback))
+        self.application.add_handler(CallbackQueryHandler(serialized(self.handle_callback)))
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         user = update.effective_user
         
         # Проверяем, есть ли пользователь в базе
-        user_data = await db.get_user(user.id)
+        user_data = await context.request.get_user(("money", "rank"))
         
         if not user_data:
             # Создаем нового пользователя
@@ -103,6 +307,9 @@ class MafiaCasinoBot:
             
             welcome_text = get_text("welcome_new", name=user.first_name, money=user_data['money'], rank=user_data['rank'])
         else:
+            # Игрок снова пишет боту: рассылки ему опять доставляются. Пометку рассылка
+            # ставит прямо в базе, и кэш этого процесса может ее не видеть - снимаем всегда
+            context.request.mutate(set_fields={"chat_blocked": False})
             welcome_text = get_text("welcome_return", name=user.first_name, money=user_data['money'], rank=user_data['rank'])
         
         await update.message.reply_text(
@@ -114,7 +321,7 @@ class MafiaCasinoBot:
     async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /profile"""
         user = update.effective_user
-        user_data = await db.get_user(user.id)
+        user_data = await context.request.get_user(PROFILE_FIELDS)
         
         if not user_data:
             await update.message.reply_text(get_text("not_registered"))
@@ -125,7 +332,7 @@ class MafiaCasinoBot:
     async def casino_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /casino"""
         user = update.effective_user
-        user_data = await db.get_user(user.id)
+        user_data = await context.request.get_user(())
         
         if not user_data:
             await update.message.reply_text(get_text("not_registered"))
@@ -140,7 +347,7 @@ class MafiaCasinoBot:
     async def crime_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /crime"""
         user = update.effective_user
-        user_data = await db.get_user(user.id)
+        user_data = await context.request.get_user(())
         
         if not user_data:
             await update.message.reply_text(get_text("not_registered"))
@@ -155,7 +362,7 @@ class MafiaCasinoBot:
     async def gang_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /gang"""
         user = update.effective_user
-        user_data = await db.get_user(user.id)
+        user_data = await context.request.get_user(())
         
         if not user_data:
             await update.message.reply_text(get_text("not_registered"))
@@ -235,106 +442,161 @@ class MafiaCasinoBot:
             parse_mode=ParseMode.HTML
         )
     
+    def setup_callback_routes(self):
+        """
+        Таблица маршрутов callback'ов: обработчик, нужные ему поля игрока
+        (False - игрок не нужен), класс частоты и тип аргумента после префикса
+        """
+        router = self.router
+        
+        # Статичные экраны рисуются без обращения к базе
+        router.exact("main_menu", lambda r: self.show_main_menu(r.query), fields=False)
+        router.exact("shop_menu", lambda r: self.show_shop_menu(r.query), fields=False)
+        router.exact("crime_menu", lambda r: self.show_crime_menu(r.query), fields=False)
+        router.exact("casino_menu", lambda r: self.show_casino_menu(r.query), fields=False)
+        router.exact("poker_menu", lambda r: self.show_poker_menu(r.query, r.user_data), fields=False)
+        router.exact("territories", lambda r: self.show_territories_menu(r.query), fields=False)
+        router.exact("territories_menu", lambda r: self.show_territories_menu(r.query), fields=False)
+        router.exact("gang", lambda r: self.show_gang_menu(r.query), fields=False)
+        router.exact("gang_menu", lambda r: self.show_gang_menu(r.query), fields=False)
+        router.exact("help", lambda r: self.show_help(r.query), fields=False)
+        router.exact("top_menu", lambda r: self.show_top_menu(r.query), fields=False)
+        
+        # Профиль
+        router.exact("profile", lambda r: self.show_profile(r.update, r.context, r.user_data, r.query), fields=PROFILE_FIELDS)
+        router.exact("profile_stats", lambda r: self.show_profile_stats(r.query, r.user_data), fields=("statistics",))
+        router.exact("profile_achievements", lambda r: self.show_profile_achievements(r.query, r.user_data), fields=("achievements",))
+        router.exact("daily_bonus", lambda r: self.handle_daily_bonus(r.query, r.user_data, r.request),
+                     fields=("money", "daily_bonus_time", "version"), rate="game")
+        
+        # Казино
+        # Обработчики игр получают шаблон маршрута и уже разобранный аргумент
+        slots = lambda r: self.handle_slots(r.query, r.user_data, r.route.pattern, r.arg, r.request)
+        roulette = lambda r: self.handle_roulette(r.query, r.user_data, r.route.pattern, r.arg, r.request)
+        blackjack = lambda r: self.handle_blackjack(r.query, r.user_data, r.route.pattern, r.arg, r.request)
+        dice = lambda r: self.handle_dice(r.query, r.user_data, r.route.pattern, r.arg, r.request)
+        router.exact("casino_stats", lambda r: self.show_casino_stats(r.query, r.user_data), fields=("statistics",))
+        router.exact("slots_menu", slots, fields=False)
+        router.prefix("slots_", slots, fields=("money",), rate="game", arg=int)
+        router.exact("roulette_menu", roulette, fields=False)
+        router.exact("roulette_number", roulette, fields=False)
+        router.prefix("roulette_", roulette, fields=("money",), arg=choice(*ROULETTE_BETS))
+        router.prefix("roulette_pick_number_", roulette, fields=("money",), arg=int)
+        router.prefix("roulette_bet_", roulette, fields=("money",), rate="game", arg=int)
+        router.exact("blackjack_menu", blackjack, fields=False)
+        router.prefix("blackjack_", blackjack, fields=("money",), rate="game", arg=int)
+        router.prefix("blackjack_hit_", blackjack, fields=("money",), rate="game", arg=int)
+        router.prefix("blackjack_stand_", blackjack, fields=("money",), rate="game", arg=int)
+        # Кнопки без версии сессии из старых сообщений
+        router.exact("blackjack_hit", blackjack, fields=("money",), rate="game")
+        router.exact("blackjack_stand", blackjack, fields=("money",), rate="game")
+        router.exact("dice_menu", dice, fields=False)
+        router.prefix("dice_", dice, fields=("money",), arg=int)
+        router.prefix("dice_pred_", dice, fields=("money",), rate="game", arg=int)
+        
+        # Преступления
+        router.prefix("crime_", lambda r: self.handle_crime(r.query, r.user_data, r.arg, r.request), fields=CRIME_FIELDS,
+                      rate="game", arg=choice(*CRIME_TYPES))
+        router.exact("escape", lambda r: self.handle_escape(r.query, r.user_data, r.request),
+                     fields=("money", "reputation", "jail_time", "version"), rate="game")
+        
+        # Территории
+        router.exact("buy_territory", lambda r: self.handle_buy_territory(r.query, r.user_data), fields=("territories",))
+        router.prefix("buy_territory_", lambda r: self.handle_buy_territory(r.query, r.user_data, r.arg, r.request),
+                      fields=("money", "territories"), rate="game")
+        router.exact("collect_income", lambda r: self.handle_collect_income(r.query, r.user_data, r.request),
+                     fields=("money", "territories", "last_territory_income"), rate="game")
+        router.exact("my_territories", lambda r: self.show_my_territories(r.query, r.user_data), fields=("territories",))
+        
+        # Магазин
+        router.prefix("buy_", lambda r: self.handle_shop(r.query, r.user_data, r.arg, r.request), fields=("money",),
+                      rate="game", arg=choice(*SHOP_ITEMS))
+        
+        # Банда и рейтинги
+        router.prefix("gang_", lambda r: self.handle_gang(r.query, r.user_data, r.data), fields=())
+        router.prefix("top_", lambda r: self.handle_top(r.query, r.arg), fields=(), arg=choice(*BOARDS),
+                      prefetch={"leaderboard": lambda update, context: leaderboard.wait_ready()})
+    
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик всех callback'ов"""
+        """
+        Обработчик всех callback'ов: находит маршрут и одновременно подтверждает
+        нажатие, читает нужные маршруту поля игрока и объявленные им данные
+        """
+        started = time.perf_counter()
         query = update.callback_query
-        await query.answer()
-        
-        user = update.effective_user
-        user_data = await db.get_user(user.id)
+        callback_data = query.data
+        route, arg = self.router.resolve(callback_data)
+        latency.observe("resolve", time.perf_counter() - started)
+        if route is not None:
+            route_label = route.pattern
+        else:
+            route_label = "stale" if callback_codec.is_encoded(callback_data) else "unknown"
         
-        if not user_data:
-            await query.edit_message_text("❌ Вы не зарегистрированы! Используйте /start")
+        if route is not None and not self.rate_limiter.allow(route.rate, update.effective_user.id):
+            # Слишком частые нажатия: только подтверждаем, игрока не загружаем
+            await self.answer_callback(query, get_text("too_fast"))
+            callback_seconds.observe(time.perf_counter() - started, "rate_limited")
             return
         
-        callback_data = query.data
-        
+        # Ответ Telegram не зависит от данных игрока: он идет параллельно с загрузкой
+        ack = asyncio.create_task(self.answer_callback(query))
         try:
-            # Главное меню
-            if callback_data == "main_menu":
-                await self.show_main_menu(query)
-            elif callback_data == "profile":
-                await self.show_profile(update, context, user_data, query)
-            elif callback_data == "profile_stats":
-                await self.show_profile_stats(query, user_data)
-            elif callback_data == "profile_achievements":
-                await self.show_profile_achievements(query, user_data)
-            elif callback_data == "shop_menu":
-                await self.show_shop_menu(query)
-            elif callback_data == "crime_menu":
-                await self.show_crime_menu(query)
-            elif callback_data == "casino_menu":
-                await self.show_casino_menu(query)
-            elif callback_data == "poker_menu":
-                await self.show_poker_menu(query, user_data)
-            elif callback_data == "casino_stats":
-                await self.show_casino_stats(query, user_data)
-            elif callback_data == "territories":
-                await self.show_territories_menu(query)
-            elif callback_data == "gang":
-                await self.show_gang_menu(query, user_data)
-            elif callback_data == "group":
-                await self.show_group_menu(query, user_data)
-            
-            # Казино
-            elif callback_data.startswith("slots_"):
-                await self.handle_slots(query, user_data, callback_data)
-            elif callback_data.startswith("roulette_"):
-                await self.handle_roulette(query, user_data, callback_data, context)
-            elif callback_data.startswith("blackjack_"):
-                await self.handle_blackjack(query, user_data, callback_data, context)
-            elif callback_data.startswith("dice_"):
-                await self.handle_dice(query, user_data, callback_data, context)
-            
-            # Преступления
-            elif callback_data.startswith("crime_"):
-                await self.handle_crime(query, user_data, callback_data)
-            
-            # Территории
-            elif callback_data == "territories_menu":
-                await self.show_territories_menu(query)
-            elif callback_data.startswith("buy_territory"):
-                await self.handle_buy_territory(query, user_data, callback_data)
-            elif callback_data == "collect_income":
-                await self.handle_collect_income(query, user_data)
-            elif callback_data == "my_territories":
-                await self.show_my_territories(query, user_data)
-            
-            # Магазин
-            elif callback_data.startswith("buy_"):
-                await self.handle_shop(query, user_data, callback_data)
-            
-            # Банда
-            elif callback_data.startswith("gang_"):
-                await self.handle_gang(query, user_data, callback_data)
-            
-            # Группа
-            elif callback_data.startswith("group_"):
-                await self.handle_group(query, user_data, callback_data)
+            if route is None:
+                if callback_codec.is_encoded(callback_data):
+                    # Кнопка из прошлой версии таблиц: возвращаем в главное меню
+                    await renderer.edit(
+                        query,
+                        get_text("stale_button"),
+                        reply_markup=keyboards.main_menu(),
+                        parse_mode=ParseMode.HTML
+                    )
+                else:
+                    await renderer.edit(query, "❌ Անհայտ հրաման")
+                return
             
-            elif callback_data == "daily_bonus":
-                await self.handle_daily_bonus(query, user_data)
-            elif callback_data == "help":
-                await self.show_help(query)
-            elif callback_data == "gang_menu":
-                await self.show_gang_menu(query)
-            elif callback_data == "escape":
-                await self.handle_escape(query, user_data)
-            elif callback_data == "top_menu":
-                await self.show_top_menu(query)
-            elif callback_data.startswith("top_"):
-                await self.handle_top(query, callback_data)
+            with latency.timer("load"):
+                user_data, prefetched = await asyncio.gather(
+                    self.load_route_user(route, context.request),
+                    self.router.prefetch(route, update, context)
+                )
+            if route.fields is not False and not user_data:
+                await renderer.edit(query, "❌ Вы не зарегистрированы! Используйте /start")
+                return
             
-            else:
-                await query.edit_message_text("❌ Անհայտ հրաման")
-        
-        except Exception as e:
-            logger.error(f"Ошибка в callback {callback_data}: {e}")
-            await query.edit_message_text(f"❌ Произошла ошибка.\n{e}")
+            try:
+                with latency.timer("handler"):
+                    await route.handler(CallbackRequest(update, context, query, callback_data, route, arg, user_data, prefetched))
+            except Exception as e:
+                # Обработчик прерван на середине: его отложенные изменения не записываются
+                context.request.discard()
+                logger.error(f"Ошибка в callback {callback_data}: {e}")
+                await renderer.edit(query, f"❌ Произошла ошибка.\n{e}")
+        finally:
+            await ack
+            elapsed = time.perf_counter() - started
+            latency.observe("callback", elapsed)
+            callback_seconds.observe(elapsed, route_label)
+    
+    @staticmethod
+    async def answer_callback(query, text: Optional[str] = None):
+        """Подтверждает нажатие; ошибка ответа (например, устаревший запрос) не прерывает обработку"""
+        with latency.timer("ack"):
+            try:
+                await query.answer(text)
+            except TelegramError as e:
+                logger.warning(f"Не удалось ответить на callback: {e}")
+    
+    @staticmethod
+    async def load_route_user(route, request):
+        """Поля игрока, нужные маршруту; None, если игрок маршруту не нужен"""
+        if route.fields is False:
+            return None
+        return await request.get_user(route.fields)
     
     async def show_main_menu(self, query):
         """Показывает главное меню"""
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             get_text("main_menu"),
             reply_markup=keyboards.main_menu(),
             parse_mode=ParseMode.HTML
@@ -373,7 +635,8 @@ class MafiaCasinoBot:
         """
         
         if query:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 profile_text,
                 reply_markup=keyboards.profile_actions(),
                 parse_mode=ParseMode.HTML
@@ -385,7 +648,7 @@ class MafiaCasinoBot:
                 parse_mode=ParseMode.HTML
             )
     
-    async def handle_daily_bonus(self, query, user_data):
+    async def handle_daily_bonus(self, query, user_data, request):
         from datetime import datetime, timedelta
         BONUS_AMOUNT = 1000
         BONUS_COOLDOWN = 24 * 60 * 60  # 24 часа в секундах
@@ -398,22 +661,38 @@ class MafiaCasinoBot:
                 remaining = BONUS_COOLDOWN - elapsed
                 hours = int(remaining // 3600)
                 minutes = int((remaining % 3600) // 60)
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     f"⏰ Օրական բոնուսը հասանելի կլինի {hours} ժ {minutes} ր հետո!",
                     reply_markup=keyboards.back_button("main_menu")
                 )
                 return
-        # Выдаём бонус
-        new_money = user_data["money"] + BONUS_AMOUNT
-        await db.update_user(query.from_user.id, {"money": new_money, "daily_bonus_time": now.isoformat()})
-        await query.edit_message_text(
+        # Выдаём бонус, только если документ не менялся с момента проверки
+        version = user_data.get("version", 0)
+        request.mutate(
+            inc={"money": BONUS_AMOUNT},
+            set_fields={"daily_bonus_time": now.isoformat()},
+            reason="daily_bonus"
+        )
+        user_data = await request.flush(expected_version=version)
+        if user_data is None:
+            await renderer.edit(
+                query,
+                get_text("concurrent_update"),
+                reply_markup=keyboards.back_button("main_menu")
+            )
+            return
+        new_money = user_data["money"]
+        await renderer.edit(
+            query,
             f"🎁 Դուք ստացել եք {BONUS_AMOUNT} մետաղադրամ օրական բոնուս!\n💳 Նոր հաշվեկշիռ: {new_money} մետաղադրամ",
             reply_markup=keyboards.back_button("main_menu")
         )
     
     async def show_casino_menu(self, query):
         """Показывает меню казино"""
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             get_text("casino_title"),
             reply_markup=keyboards.casino_menu(),
             parse_mode=ParseMode.HTML
@@ -421,7 +700,8 @@ class MafiaCasinoBot:
     
     async def show_poker_menu(self, query, user_data):
         """Заглушка для покера"""
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             "♠️ **Պոկեր**\n\nԱյս խաղը շուտով հասանելի կլինի!",
             reply_markup=keyboards.back_button("casino_menu"),
             parse_mode=ParseMode.HTML
@@ -439,27 +719,29 @@ class MafiaCasinoBot:
 🎲 Զառեր: {stats.get('dice_played', 0)} խաղ
 ♠️ Պոկեր: {stats.get('poker_played', 0)} խաղ
 """
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             text,
             reply_markup=keyboards.back_button("casino_menu"),
             parse_mode=ParseMode.HTML
         )
     
-    async def handle_slots(self, query, user_data, callback_data):
+    async def handle_slots(self, query, user_data, action, arg=None, request=None):
         """Обработчик слотов"""
-        if callback_data == "slots_menu":
-            await query.edit_message_text(
+        if action == "slots_menu":
+            await renderer.edit(
+                query,
                 get_text("slots_title"),
                 reply_markup=keyboards.slots_menu(),
                 parse_mode=ParseMode.HTML
             )
             return
         
-        # Извлекаем ставку
-        bet = int(callback_data.split("_")[1])
+        bet = arg
         
         if user_data["money"] < bet:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 get_text("not_enough_money", amount=bet),
                 reply_markup=keyboards.back_button("slots_menu"),
                 parse_mode=ParseMode.HTML
@@ -470,11 +752,18 @@ class MafiaCasinoBot:
         result = casino_games.play_slots(bet)
         
         if result["success"]:
-            # Обновляем деньги
-            new_money = user_data["money"] - bet + result["win_amount"]
-            stats = user_data.get("statistics", {})
-            stats["slots_played"] = stats.get("slots_played", 0) + 1
-            await db.update_user(query.from_user.id, {"money": new_money, "statistics": stats})
+            # Списываем ставку и начисляем выигрыш одной записью
+            request.mutate(inc={"money": result["win_amount"] - bet, "statistics.slots_played": 1}, reason="slots")
+            user_data = await request.flush(min_money=bet)
+            if user_data is None:
+                await renderer.edit(
+                    query,
+                    get_text("not_enough_money", amount=bet),
+                    reply_markup=keyboards.back_button("slots_menu"),
+                    parse_mode=ParseMode.HTML
+                )
+                return
+            new_money = user_data["money"]
             
             # Показываем результат
             result_text = get_text("slots_result", 
@@ -483,16 +772,18 @@ class MafiaCasinoBot:
                                  bet=bet, 
                                  balance=new_money)
             
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 result_text,
                 reply_markup=keyboards.back_button("slots_menu"),
                 parse_mode=ParseMode.HTML
             )
     
-    async def handle_roulette(self, query, user_data, callback_data, context):
+    async def handle_roulette(self, query, user_data, action, arg, request=None):
         """Обработчик рулетки"""
-        if callback_data == "roulette_menu":
-            await query.edit_message_text(
+        if action == "roulette_menu":
+            await renderer.edit(
+                query,
                 get_text("roulette_title"),
                 reply_markup=keyboards.roulette_menu(),
                 parse_mode=ParseMode.HTML
@@ -500,14 +791,15 @@ class MafiaCasinoBot:
             return
         
         # Обрабатываем разные типы ставок
-        if callback_data in ["roulette_red", "roulette_black", "roulette_even", "roulette_odd"]:
-            bet_type = callback_data.split("_")[1]
+        if action == "roulette_":
+            bet_type = arg
             bet_value = {"red": "կարմիր", "black": "սև", "even": "զույգ", "odd": "կենտ"}[bet_type]
             
-            # Сохраняем выбор в контексте
-            context.user_data["roulette_bet"] = {"type": "color" if bet_type in ["red", "black"] else "even_odd", "value": bet_value}
+            # Выбор ставки живет в сессии до следующего выбора
+            await sessions.start(query.from_user.id, "roulette", {"type": "color" if bet_type in ["red", "black"] else "even_odd", "value": bet_value})
             
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 f"🎲 **Ռուլետկա** 🎲\n\nԳրավադրում: {bet_value}\nԸնտրեք գումարը՝",
                 reply_markup=keyboards.roulette_bet_amounts(),
                 parse_mode=ParseMode.HTML
@@ -515,29 +807,32 @@ class MafiaCasinoBot:
             return
         
         # Новый блок: выбор числа
-        if callback_data == "roulette_number":
-            await query.edit_message_text(
+        if action == "roulette_number":
+            await renderer.edit(
+                query,
                 "🎯 Ընտրեք թիվը (0-36):",
                 reply_markup=keyboards.number_keyboard(36, "roulette_pick_number"),
                 parse_mode=ParseMode.HTML
             )
             return
         
-        if callback_data.startswith("roulette_pick_number_"):
-            number = int(callback_data.split("_")[-1])
-            context.user_data["roulette_bet"] = {"type": "number", "value": str(number)}
-            await query.edit_message_text(
+        if action == "roulette_pick_number_":
+            number = arg
+            await sessions.start(query.from_user.id, "roulette", {"type": "number", "value": str(number)})
+            await renderer.edit(
+                query,
                 f"🎲 **Ռուլետկա** 🎲\n\nԳրավադրում: թիվ {number}\nԸնտրեք գումարը՝",
                 reply_markup=keyboards.roulette_bet_amounts(),
                 parse_mode=ParseMode.HTML
             )
             return
         
-        if callback_data.startswith("roulette_bet_"):
-            bet_amount = int(callback_data.split("_")[2])
+        if action == "roulette_bet_":
+            bet_amount = arg
             
             if user_data["money"] < bet_amount:
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     get_text("not_enough_money", amount=bet_amount),
                     reply_markup=keyboards.back_button("roulette_menu"),
                     parse_mode=ParseMode.HTML
@@ -545,9 +840,11 @@ class MafiaCasinoBot:
                 return
             
             # Получаем сохраненную ставку
-            roulette_bet = context.user_data.get("roulette_bet", {})
+            session = await sessions.get(query.from_user.id, "roulette")
+            roulette_bet = session["state"] if session else None
             if not roulette_bet:
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     "❌ Սխալ! Ընտրեք գրավադրման տեսակը կրկին",
                     reply_markup=keyboards.roulette_menu(),
                     parse_mode=ParseMode.HTML
@@ -562,11 +859,21 @@ class MafiaCasinoBot:
             )
             
             if result["success"]:
-                # Обновляем деньги
-                new_money = user_data["money"] - bet_amount + result["win_amount"]
-                stats = user_data.get("statistics", {})
-                stats["roulette_played"] = stats.get("roulette_played", 0) + 1
-                await db.update_user(query.from_user.id, {"money": new_money, "statistics": stats})
+                # Списываем ставку и начисляем выигрыш одной записью
+                request.mutate(
+                    inc={"money": result["win_amount"] - bet_amount, "statistics.roulette_played": 1},
+                    reason="roulette"
+                )
+                user_data = await request.flush(min_money=bet_amount)
+                if user_data is None:
+                    await renderer.edit(
+                        query,
+                        get_text("not_enough_money", amount=bet_amount),
+                        reply_markup=keyboards.back_button("roulette_menu"),
+                        parse_mode=ParseMode.HTML
+                    )
+                    return
+                new_money = user_data["money"]
                 
                 # Показываем результат
                 result_text = get_text("roulette_result",
@@ -576,125 +883,170 @@ class MafiaCasinoBot:
                                      bet=bet_amount,
                                      balance=new_money)
                 
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     result_text,
                     reply_markup=keyboards.back_button("roulette_menu"),
                     parse_mode=ParseMode.HTML
                 )
     
-    async def handle_blackjack(self, query, user_data, callback_data, context):
-        """Обработчик блэкджека"""
-        if callback_data == "blackjack_menu":
-            await query.edit_message_text(
+    async def handle_blackjack(self, query, user_data, action, arg, request=None):
+        """
+        Обработчик блэкджека
+        Раздача хранится в игровой сессии; кнопки хода несут версию сессии,
+        и ход с устаревшей версией (повторное нажатие) не применяется
+        """
+        if action == "blackjack_menu":
+            await renderer.edit(
+                query,
                 get_text("blackjack_title"),
                 reply_markup=keyboards.blackjack_menu(),
                 parse_mode=ParseMode.HTML
             )
             return
         
+        user_id = query.from_user.id
+        
         # Первый ход: выбор ставки
-        if callback_data.startswith("blackjack_") and callback_data.split("_")[1].isdigit():
-            bet = int(callback_data.split("_")[1])
+        if action == "blackjack_":
+            bet = arg
             if user_data["money"] < bet:
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     get_text("not_enough_money", amount=bet),
                     reply_markup=keyboards.back_button("blackjack_menu"),
                     parse_mode=ParseMode.HTML
                 )
                 return
-            # Сохраняем ставку в context
-            context.user_data["blackjack_bet"] = bet
             # Играем в блэкджек
             result = casino_games.play_blackjack(bet)
             if result["success"]:
-                new_money = user_data["money"] - bet + result.get("win_amount", 0)
-                stats = user_data.get("statistics", {})
-                stats["blackjack_played"] = stats.get("blackjack_played", 0) + 1
-                await db.update_user(query.from_user.id, {"money": new_money, "statistics": stats})
-                player_score = casino_games.calculate_blackjack_score(result["player_cards"])
-                result_text = f"""
-🃏 **Բլեքջեք** 🃏
-
-🎯 Ձեր քարտերը: {' '.join(result['player_cards'])}
-📊 Ձեր միավորները: {player_score}
-
-🎰 Դիլերի քարտերը: {' '.join(result['dealer_visible'])}
-
-Ընտրեք գործողությունը՝
-                """
-                # Сохраняем карты в context
-                context.user_data["blackjack_player_cards"] = result["player_cards"]
-                context.user_data["blackjack_dealer_cards"] = result["dealer_cards"]
-                await query.edit_message_text(
-                    result_text,
-                    reply_markup=keyboards.blackjack_game(),
-                    parse_mode=ParseMode.HTML
+                request.mutate(
+                    inc={"money": result.get("win_amount", 0) - bet, "statistics.blackjack_played": 1},
+                    reason="blackjack"
                 )
+                user_data = await request.flush(min_money=bet)
+                if user_data is None:
+                    await renderer.edit(
+                        query,
+                        get_text("not_enough_money", amount=bet),
+                        reply_markup=keyboards.back_button("blackjack_menu"),
+                        parse_mode=ParseMode.HTML
+                    )
+                    return
+                # Сохраняем раздачу в сессии
+                version = await sessions.start(
+                    user_id, "blackjack", blackjack_state(bet, result["player_cards"], result["dealer_cards"])
+                )
+                await self.show_blackjack_hand(query, result["player_cards"], result["dealer_cards"], version)
+            return
+        
+        # Ходы: взять карту или хватит. Кнопки из старых сообщений приходят без версии
+        session = await sessions.get(user_id, "blackjack")
+        if session is None:
+            await renderer.edit(
+                query,
+                get_text("blackjack_no_game"),
+                reply_markup=keyboards.blackjack_menu(),
+                parse_mode=ParseMode.HTML
+            )
             return
+        version = session["version"] if arg is None else arg
+        bet, player_cards, dealer_cards = blackjack_hand(session["state"])
         
-        # Ход: взять карту
-        if callback_data == "blackjack_hit":
-            bet = context.user_data.get("blackjack_bet", 0)
-            player_cards = context.user_data.get("blackjack_player_cards", [])
-            dealer_cards = context.user_data.get("blackjack_dealer_cards", [])
+        if action in ("blackjack_hit_", "blackjack_hit"):
             result = casino_games.blackjack_hit(player_cards, dealer_cards, bet)
             player_score = casino_games.calculate_blackjack_score(result["player_cards"])
             if result["game_state"] == "bust":
+                if not await sessions.finish(user_id, "blackjack", version):
+                    await self.show_current_blackjack_hand(query, user_id)
+                    return
                 # Проигрыш
                 result_text = f"💥 **Փոխանցում** 💥\n\n🎯 Ձեր քարտերը: {' '.join(result['player_cards'])}\n📊 Ձեր միավորները: {player_score}\n\nԴուք պարտվեցիք!"
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     result_text,
                     reply_markup=keyboards.back_button("blackjack_menu"),
                     parse_mode=ParseMode.HTML
                 )
                 return
             # Иначе продолжаем игру
-            context.user_data["blackjack_player_cards"] = result["player_cards"]
-            context.user_data["blackjack_dealer_cards"] = result["dealer_cards"]
-            result_text = f"🃏 **Բլեքջեք** 🃏\n\n🎯 Ձեր քարտերը: {' '.join(result['player_cards'])}\n📊 Ձեր միավորները: {player_score}\n\n🎰 Դիլերի քարտերը: {' '.join(['🂠' if i > 0 else c for i, c in enumerate(result['dealer_cards'])])}\n\nԸնտրեք գործողությունը՝"
-            await query.edit_message_text(
-                result_text,
-                reply_markup=keyboards.blackjack_game(),
-                parse_mode=ParseMode.HTML
+            version = await sessions.update(
+                user_id, "blackjack", blackjack_state(bet, result["player_cards"], result["dealer_cards"]), version
             )
+            if version is None:
+                await self.show_current_blackjack_hand(query, user_id)
+                return
+            await self.show_blackjack_hand(query, result["player_cards"], result["dealer_cards"], version)
             return
         
         # Ход: хватит
-        if callback_data == "blackjack_stand":
-            bet = context.user_data.get("blackjack_bet", 0)
-            player_cards = context.user_data.get("blackjack_player_cards", [])
-            dealer_cards = context.user_data.get("blackjack_dealer_cards", [])
+        if action in ("blackjack_stand_", "blackjack_stand"):
+            # Сессия закрывается до выплаты: выигрыш начисляется ровно один раз
+            if not await sessions.finish(user_id, "blackjack", version):
+                await self.show_current_blackjack_hand(query, user_id)
+                return
             result = casino_games.blackjack_stand(player_cards, dealer_cards, bet)
             player_score = casino_games.calculate_blackjack_score(result["player_cards"])
             dealer_score = casino_games.calculate_blackjack_score(result["dealer_cards"])
             result_text = f"🃏 **Բլեքջեք** 🃏\n\n🎯 Ձեր քարտերը: {' '.join(result['player_cards'])}\n📊 Ձեր միավորները: {player_score}\n\n🎰 Դիլերի քարտերը: {' '.join(result['dealer_cards'])}\n📊 Դիլերի միավորները: {dealer_score}\n\n{result['message']}"
             # Обновляем деньги
-            new_money = user_data["money"] + result.get("win_amount", 0)
-            stats = user_data.get("statistics", {})
-            stats["blackjack_played"] = stats.get("blackjack_played", 0) + 1
-            await db.update_user(query.from_user.id, {"money": new_money, "statistics": stats})
-            await query.edit_message_text(
+            request.mutate(
+                inc={"money": result.get("win_amount", 0), "statistics.blackjack_played": 1},
+                reason="blackjack"
+            )
+            await request.flush()
+            await renderer.edit(
+                query,
                 result_text,
                 reply_markup=keyboards.back_button("blackjack_menu"),
                 parse_mode=ParseMode.HTML
             )
             return
     
-    async def handle_dice(self, query, user_data, callback_data, context):
+    async def show_blackjack_hand(self, query, player_cards, dealer_cards, version):
+        """Показывает раздачу с кнопками хода для версии сессии version"""
+        player_score = casino_games.calculate_blackjack_score(player_cards)
+        dealer_visible = ' '.join(['🂠' if i > 0 else c for i, c in enumerate(dealer_cards)])
+        result_text = f"🃏 **Բլեքջեք** 🃏\n\n🎯 Ձեր քարտերը: {' '.join(player_cards)}\n📊 Ձեր միավորները: {player_score}\n\n🎰 Դիլերի քարտերը: {dealer_visible}\n\nԸնտրեք գործողությունը՝"
+        await renderer.edit(
+            query,
+            result_text,
+            reply_markup=keyboards.blackjack_game(version),
+            parse_mode=ParseMode.HTML
+        )
+    
+    async def show_current_blackjack_hand(self, query, user_id):
+        """Повторное нажатие: ход уже сделан, показываем актуальную раздачу (или меню, если игра окончена)"""
+        session = await sessions.get(user_id, "blackjack")
+        if session is None:
+            await renderer.edit(
+                query,
+                get_text("blackjack_no_game"),
+                reply_markup=keyboards.blackjack_menu(),
+                parse_mode=ParseMode.HTML
+            )
+            return
+        _, player_cards, dealer_cards = blackjack_hand(session["state"])
+        await self.show_blackjack_hand(query, player_cards, dealer_cards, session["version"])
+    
+    async def handle_dice(self, query, user_data, action, arg, request=None):
         """Обработчик костей"""
-        if callback_data == "dice_menu":
-            await query.edit_message_text(
+        if action == "dice_menu":
+            await renderer.edit(
+                query,
                 get_text("dice_title"),
                 reply_markup=keyboards.dice_menu(),
                 parse_mode=ParseMode.HTML
             )
             return
         
-        if callback_data.startswith("dice_") and not callback_data.startswith("dice_pred_"):
-            bet = int(callback_data.split("_")[1])
+        if action == "dice_":
+            bet = arg
             
             if user_data["money"] < bet:
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     get_text("not_enough_money", amount=bet),
                     reply_markup=keyboards.back_button("dice_menu"),
                     parse_mode=ParseMode.HTML
@@ -702,21 +1054,24 @@ class MafiaCasinoBot:
                 return
             
             # Сохраняем ставку
-            context.user_data["dice_bet"] = bet
+            await sessions.start(query.from_user.id, "dice", {"bet": bet})
             
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 f"🎲 **Զառեր** 🎲\n\nԳրավադրում: {bet} մետաղադրամ\nԳուշակեք երկու զառերի գումարը՝",
                 reply_markup=keyboards.dice_predictions(),
                 parse_mode=ParseMode.HTML
             )
             return
         
-        if callback_data.startswith("dice_pred_"):
-            prediction = int(callback_data.split("_")[2])
-            bet = context.user_data.get("dice_bet", 0)
+        if action == "dice_pred_":
+            prediction = arg
+            session = await sessions.get(query.from_user.id, "dice")
+            bet = session["state"]["bet"] if session else 0
             
             if bet == 0:
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     "❌ Սխալ! Ընտրեք գրավադրումը կրկին",
                     reply_markup=keyboards.dice_menu(),
                     parse_mode=ParseMode.HTML
@@ -727,11 +1082,18 @@ class MafiaCasinoBot:
             result = casino_games.play_dice(bet, prediction)
             
             if result["success"]:
-                # Обновляем деньги
-                new_money = user_data["money"] - bet + result["win_amount"]
-                stats = user_data.get("statistics", {})
-                stats["dice_played"] = stats.get("dice_played", 0) + 1
-                await db.update_user(query.from_user.id, {"money": new_money, "statistics": stats})
+                # Списываем ставку и начисляем выигрыш одной записью
+                request.mutate(inc={"money": result["win_amount"] - bet, "statistics.dice_played": 1}, reason="dice")
+                user_data = await request.flush(min_money=bet)
+                if user_data is None:
+                    await renderer.edit(
+                        query,
+                        get_text("not_enough_money", amount=bet),
+                        reply_markup=keyboards.back_button("dice_menu"),
+                        parse_mode=ParseMode.HTML
+                    )
+                    return
+                new_money = user_data["money"]
                 
                 # Показываем результат
                 result_text = get_text("dice_result",
@@ -743,7 +1105,8 @@ class MafiaCasinoBot:
                                      bet=bet,
                                      balance=new_money)
                 
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     result_text,
                     reply_markup=keyboards.back_button("dice_menu"),
                     parse_mode=ParseMode.HTML
@@ -751,15 +1114,15 @@ class MafiaCasinoBot:
     
     async def show_crime_menu(self, query):
         """Показывает меню преступлений"""
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             get_text("crime_title"),
             reply_markup=keyboards.crime_menu(),
             parse_mode=ParseMode.HTML
         )
     
-    async def handle_crime(self, query, user_data, callback_data):
+    async def handle_crime(self, query, user_data, crime_type, request):
         """Обработчик преступлений"""
-        crime_type = callback_data.split("_")[1]
         crime_names = {
             "pickpocket": get_text("crime_pickpocket"),
             "robbery": get_text("crime_robbery"),
@@ -769,35 +1132,46 @@ class MafiaCasinoBot:
         
         crime_name = crime_names.get(crime_type)
         if not crime_name:
-            await query.edit_message_text("❌ Անհայտ հանցագործություն")
+            await renderer.edit(query, "❌ Անհայտ հանցագործություն")
             return
         
         # Совершаем преступление
         result = crime_system.commit_crime(query.from_user.id, crime_name, user_data)
         
         if result["success"]:
-            # Обновляем данные пользователя
-            updates = {
-                "money": result.get("new_money", user_data["money"]),
-                "reputation": result.get("new_reputation", user_data["reputation"]),
-                "statistics": result.get("new_stats", user_data["statistics"]),
-                "last_crime_time": datetime.now().isoformat()
-            }
+            # Обновляем данные пользователя приращениями, а не перезаписью
+            inc = {"money": result.get("reward", 0)}
+            for faction, change in result["reputation_changes"].items():
+                inc[f"reputation.{faction}"] = change
+            for stat, change in result["stats_changes"].items():
+                inc[f"statistics.{stat}"] = change
             
+            set_fields = {"last_crime_time": datetime.now().isoformat()}
             if result.get("jail_time"):
-                updates["jail_time"] = result["jail_time"]
-                updates["jail_start"] = datetime.now().isoformat()
+                set_fields["jail_time"] = result["jail_time"]
+                set_fields["jail_start"] = datetime.now().isoformat()
             
-            await db.update_user(query.from_user.id, updates)
+            request.mutate(inc=inc, set_fields=set_fields, reason="crime")
+            user_data = await request.flush(min_money=CRIMES[crime_name]["min_money"])
+            if user_data is None:
+                await renderer.edit(
+                    query,
+                    get_text("not_enough_money", amount=CRIMES[crime_name]["min_money"]),
+                    reply_markup=keyboards.back_button("crime_menu"),
+                    parse_mode=ParseMode.HTML
+                )
+                return
             
             # Показываем результат
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 f"🔫 **{crime_name.title()}** 🔫\n\n{result['message']}",
                 reply_markup=keyboards.back_button("crime_menu"),
                 parse_mode=ParseMode.HTML
             )
         else:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 f"❌ {result['message']}",
                 reply_markup=keyboards.back_button("crime_menu"),
                 parse_mode=ParseMode.HTML
@@ -805,27 +1179,30 @@ class MafiaCasinoBot:
     
     async def show_territories_menu(self, query):
         """Показывает меню территорий"""
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             get_text("territories_title"),
             reply_markup=keyboards.territories_menu(),
             parse_mode=ParseMode.HTML
         )
     
-    async def handle_buy_territory(self, query, user_data, callback_data):
-        """Обработчик покупки территории"""
-        if callback_data == "buy_territory":
+    async def handle_buy_territory(self, query, user_data, territory_name=None, request=None):
+        """Обработчик покупки территории (без названия - список доступных)"""
+        if territory_name is None:
             # Показываем доступные территории
             available = crime_system.get_available_territories(user_data)
             
             if not available:
-                await query.edit_message_text(
+                await renderer.edit(
+                    query,
                     "❌ Գնման համար հասանելի տարածքներ չկան",
                     reply_markup=keyboards.back_button("territories_menu"),
                     parse_mode=ParseMode.HTML
                 )
                 return
             
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 "🏘️ **Հասանելի տարածքներ** 🏘️\n\nԸնտրեք գնման համար՝",
                 reply_markup=keyboards.available_territories(available),
                 parse_mode=ParseMode.HTML
@@ -833,48 +1210,63 @@ class MafiaCasinoBot:
             return
         
         # Покупаем конкретную территорию
-        territory_name = callback_data.split("_", 2)[2]
         result = crime_system.buy_territory(query.from_user.id, territory_name, user_data)
         
         if result["success"]:
             # Обновляем данные пользователя
-            await db.update_user(query.from_user.id, {
-                "money": result["new_money"],
-                "territories": result["new_territories"]
-            })
+            request.mutate(inc={"money": -result["cost"]}, push={"territories": territory_name}, reason="territory")
+            user_data = await request.flush(min_money=result["cost"])
+            if user_data is None:
+                await renderer.edit(
+                    query,
+                    get_text("not_enough_money", amount=result["cost"]),
+                    reply_markup=keyboards.back_button("territories_menu"),
+                    parse_mode=ParseMode.HTML
+                )
+                return
             
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 get_text("territory_bought", message=result['message']),
                 reply_markup=keyboards.back_button("territories_menu"),
                 parse_mode=ParseMode.HTML
             )
         else:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 f"❌ {result['message']}",
                 reply_markup=keyboards.back_button("territories_menu"),
                 parse_mode=ParseMode.HTML
             )
     
-    async def handle_collect_income(self, query, user_data):
+    async def handle_collect_income(self, query, user_data, request):
         """Обработчик сбора дохода с территорий"""
         result = crime_system.collect_territory_income(query.from_user.id, user_data)
         
         if result["success"]:
-            # Обновляем данные пользователя
-            updates = {
-                "money": result["new_money"],
-                "last_territory_income": datetime.now().isoformat()
-            }
-            
-            await db.update_user(query.from_user.id, updates)
+            # Изменения записываются одной операцией после ответа игроку
+            if result.get("territory_lost"):
+                request.mutate(
+                    pull={"territories": result["territory_lost"]},
+                    set_fields={"last_territory_income": datetime.now().isoformat()},
+                    reason="territory_lost"
+                )
+            else:
+                request.mutate(
+                    inc={"money": result["total_income"]},
+                    set_fields={"last_territory_income": datetime.now().isoformat()},
+                    reason="territory_income"
+                )
             
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 get_text("income_collected", message=result['message']),
                 reply_markup=keyboards.back_button("territories_menu"),
                 parse_mode=ParseMode.HTML
             )
         else:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 f"❌ {result['message']}",
                 reply_markup=keyboards.back_button("territories_menu"),
                 parse_mode=ParseMode.HTML
@@ -882,7 +1274,8 @@ class MafiaCasinoBot:
     
     async def show_gang_menu(self, query):
         """Показывает меню банды"""
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             "👥 **Խմբեր** 👥\n\nԽմբի կառավարում՝",
             reply_markup=keyboards.gang_menu(),
             parse_mode=ParseMode.HTML
@@ -891,7 +1284,8 @@ class MafiaCasinoBot:
     async def handle_gang(self, query, user_data, callback_data):
         """Обработчик действий с бандой"""
         # Заглушка для обработки действий с бандой
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             "👥 **Խմբեր** 👥\n\nФункция в разработке!",
             reply_markup=keyboards.back_button("gang_menu"),
             parse_mode=ParseMode.HTML
@@ -899,19 +1293,20 @@ class MafiaCasinoBot:
     
     async def show_shop_menu(self, query):
         """Показывает меню магазина"""
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             get_text("shop_title"),
             reply_markup=keyboards.shop_menu(),
             parse_mode=ParseMode.HTML
         )
     
-    async def handle_shop(self, query, user_data, callback_data):
+    async def handle_shop(self, query, user_data, item_name, request):
         """Обработчик покупок в магазине"""
-        item_name = callback_data.split("_", 1)[1]
         item_info = SHOP_ITEMS.get(item_name)
         
         if not item_info:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 "❌ Անհայտ առարկա",
                 reply_markup=keyboards.back_button("shop_menu"),
                 parse_mode=ParseMode.HTML
@@ -919,7 +1314,8 @@ class MafiaCasinoBot:
             return
         
         if user_data["money"] < item_info["cost"]:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 get_text("not_enough_money", amount=item_info['cost']),
                 reply_markup=keyboards.back_button("shop_menu"),
                 parse_mode=ParseMode.HTML
@@ -927,15 +1323,20 @@ class MafiaCasinoBot:
             return
         
         # Покупаем предмет
-        new_money = user_data["money"] - item_info["cost"]
-        new_inventory = user_data["inventory"] + [item_name]
-        
-        await db.update_user(query.from_user.id, {
-            "money": new_money,
-            "inventory": new_inventory
-        })
+        request.mutate(inc={"money": -item_info["cost"]}, push={"inventory": item_name}, reason="shop")
+        user_data = await request.flush(min_money=item_info["cost"])
+        if user_data is None:
+            await renderer.edit(
+                query,
+                get_text("not_enough_money", amount=item_info['cost']),
+                reply_markup=keyboards.back_button("shop_menu"),
+                parse_mode=ParseMode.HTML
+            )
+            return
+        new_money = user_data["money"]
         
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             get_text("item_bought", item=item_name, cost=item_info['cost'], balance=new_money),
             reply_markup=keyboards.back_button("shop_menu"),
             parse_mode=ParseMode.HTML
@@ -943,54 +1344,56 @@ class MafiaCasinoBot:
     
     async def show_top_menu(self, query):
         """Показывает меню рейтингов"""
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             get_text("top_title"),
             reply_markup=keyboards.top_menu(),
             parse_mode=ParseMode.HTML
         )
     
-    async def handle_top(self, query, callback_data):
-        """Обработчик рейтингов"""
-        top_type = callback_data.split("_")[1]
-        top_users = await db.get_top_users(top_type, 10)
+    async def handle_top(self, query, top_type):
+        """Обработчик рейтингов (из рейтингов в памяти, без запроса к базе)"""
+        if top_type not in BOARDS:
+            top_type = "money"
+        top_users = leaderboard.top(top_type, 10)
         
         if not top_users:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 "❌ Դասակարգման տվյալներ չկան",
                 reply_markup=keyboards.back_button("top_menu"),
                 parse_mode=ParseMode.HTML
             )
             return
         
-        # Формируем текст рейтинга
-        if top_type == "money":
-            top_text = get_text("top_money")
-        elif top_type == "rank":
-            top_text = get_text("top_rank")
-        elif top_type == "reputation":
-            top_text = get_text("top_reputation")
-        else:
-            top_text = get_text("top_territories")
-        
-        for i, user in enumerate(top_users, 1):
-            if top_type == "money":
-                value = f"{user['money']} մետաղադրամ"
-            elif top_type == "rank":
-                value = user['rank']
-            elif top_type == "reputation":
-                value = f"{sum(user['reputation'].values())} միավոր"
-            else:
-                value = f"{len(user['territories'])} տարածք"
-            # Исправлено: используем user['name'] или user['username'] вместо user['first_name']
-            display_name = user.get('name') or user.get('username') or 'Без имени'
-            top_text += f"{i}. {display_name}: {value}\n"
+        top_text = get_text(f"top_{top_type}")
+        for i, (user_id, display_name, score) in enumerate(top_users, 1):
+            top_text += f"{i}. {display_name}: {self.format_top_value(top_type, score)}\n"
         
-        await query.edit_message_text(
+        # Место текущего игрока, если он не попал в топ
+        my_position = leaderboard.position(top_type, query.from_user.id)
+        if my_position and my_position[0] > len(top_users):
+            place, score = my_position
+            top_text += get_text("top_my_position", place=place, value=self.format_top_value(top_type, score))
+        
+        await renderer.edit(
+            query,
             top_text,
             reply_markup=keyboards.back_button("top_menu"),
             parse_mode=ParseMode.HTML
         )
     
+    @staticmethod
+    def format_top_value(top_type, score):
+        """Форматирует очки игрока для строки рейтинга"""
+        if top_type == "money":
+            return f"{score} մետաղադրամ"
+        if top_type == "rank":
+            return RANK_NAMES[score] if 0 <= score < len(RANK_NAMES) else "?"
+        if top_type == "reputation":
+            return f"{score} միավոր"
+        return f"{score} տարածք"
+    
     async def show_help(self, query):
         """Показывает справку"""
         help_text = f"""
@@ -1045,35 +1448,53 @@ class MafiaCasinoBot:
 {get_text("help_good_luck")}
         """
         
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             help_text,
             reply_markup=keyboards.back_button("main_menu"),
             parse_mode=ParseMode.HTML
         )
     
-    async def handle_escape(self, query, user_data):
+    async def handle_escape(self, query, user_data, request):
         """Обработчик побега из тюрьмы"""
         result = crime_system.organize_escape(query.from_user.id, user_data)
         
         if result["success"]:
             # Обновляем данные пользователя
-            updates = {}
-            if "new_money" in result:
-                updates["money"] = result["new_money"]
-            if result.get("new_jail_time"):
-                updates["jail_time"] = result["new_jail_time"]
             if result.get("escape_success"):
-                updates["jail_time"] = 0
-                updates["jail_start"] = None
-            await db.update_user(query.from_user.id, updates)
+                request.mutate(
+                    inc={"money": -result["cost"]},
+                    set_fields={"jail_time": 0, "jail_start": None},
+                    reason="escape"
+                )
+                if await request.flush(min_money=result["cost"]) is None:
+                    await renderer.edit(
+                        query,
+                        get_text("not_enough_money", amount=result["cost"]),
+                        reply_markup=keyboards.back_button("main_menu"),
+                        parse_mode=ParseMode.HTML
+                    )
+                    return
+            else:
+                version = user_data.get("version", 0)
+                request.mutate(set_fields={"jail_time": result["new_jail_time"]}, reason="escape")
+                if await request.flush(expected_version=version) is None:
+                    await renderer.edit(
+                        query,
+                        get_text("concurrent_update"),
+                        reply_markup=keyboards.back_button("main_menu")
+                    )
+                    return
             
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 f"🏃‍♂️ **Փախուստ** 🏃‍♂️\n\n{result['message']}",
                 reply_markup=keyboards.back_button("main_menu"),
                 parse_mode=ParseMode.HTML
             )
         else:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 f"❌ {result['message']}",
                 reply_markup=keyboards.back_button("main_menu"),
                 parse_mode=ParseMode.HTML
@@ -1083,7 +1504,7 @@ class MafiaCasinoBot:
     async def daily_bonus_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда ежедневного бонуса для групп"""
         user = update.effective_user
-        user_data = await db.get_user(user.id)
+        user_data = await context.request.get_user(("money", "daily_bonus_time", "version"))
         
         if not user_data:
             await update.message.reply_text(get_text("not_registered"))
@@ -1106,12 +1527,18 @@ class MafiaCasinoBot:
                 )
                 return
         
-        # Выдаем бонус
-        new_money = user_data["money"] + DAILY_BONUS_AMOUNT
-        await db.update_user(user.id, {
-            "money": new_money,
-            "daily_bonus_time": current_time.isoformat()
-        })
+        # Выдаем бонус, только если документ не менялся с момента проверки
+        version = user_data.get("version", 0)
+        context.request.mutate(
+            inc={"money": DAILY_BONUS_AMOUNT},
+            set_fields={"daily_bonus_time": current_time.isoformat()},
+            reason="daily_bonus"
+        )
+        user_data = await context.request.flush(expected_version=version)
+        if user_data is None:
+            await update.message.reply_text(get_text("concurrent_update"))
+            return
+        new_money = user_data["money"]
         
         await update.message.reply_text(
             get_text("group_daily_received", username=user.username or user.first_name, amount=DAILY_BONUS_AMOUNT, balance=new_money),
@@ -1121,13 +1548,13 @@ class MafiaCasinoBot:
     async def balance_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда баланса для групп"""
         user = update.effective_user
-        user_data = await db.get_user(user.id)
+        user_data = await context.request.get_user(("money", "rank"))
         
         if not user_data:
             await update.message.reply_text(get_text("not_registered"))
             return
         
-        rank = await db.get_user_rank(user.id)
+        rank = await context.request.get_rank()
         
         await update.message.reply_text(
             get_text("group_balance", username=user.username or user.first_name, money=user_data['money'], rank=rank),
@@ -1137,13 +1564,13 @@ class MafiaCasinoBot:
     async def rank_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда ранга для групп"""
         user = update.effective_user
-        user_data = await db.get_user(user.id)
+        user_data = await context.request.get_user(("rank", "reputation", "territories"))
         
         if not user_data:
             await update.message.reply_text(get_text("not_registered"))
             return
         
-        rank = await db.get_user_rank(user.id)
+        rank = await context.request.get_rank()
         total_reputation = sum(user_data["reputation"].values())
         
         await update.message.reply_text(
@@ -1154,7 +1581,7 @@ class MafiaCasinoBot:
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда статистики для групп"""
         user = update.effective_user
-        user_data = await db.get_user(user.id)
+        user_data = await context.request.get_user(("statistics",))
         
         if not user_data:
             await update.message.reply_text(get_text("not_registered"))
@@ -1170,7 +1597,8 @@ class MafiaCasinoBot:
     async def show_my_territories(self, query, user_data):
         """Показывает список территорий пользователя"""
         if not user_data["territories"]:
-            await query.edit_message_text(
+            await renderer.edit(
+                query,
                 "❌ Դուք չունեք տարածքներ",
                 reply_markup=keyboards.back_button("territories_menu"),
                 parse_mode=ParseMode.HTML
@@ -1179,7 +1607,8 @@ class MafiaCasinoBot:
         text = "🏘️ **Ձեր տարածքները** 🏘️\n\n"
         for t in user_data["territories"]:
             text += f"• {t}\n"
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             text,
             reply_markup=keyboards.back_button("territories_menu"),
             parse_mode=ParseMode.HTML
@@ -1197,10 +1626,11 @@ class MafiaCasinoBot:
 💰 Կողոպուտներ: {stats.get('robberies', 0)}
         """
         
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             text,
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Հետ", callback_data="profile")]
+                [InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("profile"))]
             ]),
             parse_mode=ParseMode.HTML
         )
@@ -1212,7 +1642,8 @@ class MafiaCasinoBot:
             text = "🏆 Դեռևս ձեռքբերումներ չկան"
         else:
             text = "🏆 **Ձեռքբերումներ**\n\n" + "\n".join(f"• {a}" for a in achievements)
-        await query.edit_message_text(
+        await renderer.edit(
+            query,
             text,
             reply_markup=keyboards.back_button("profile"),
             parse_mode=ParseMode.HTML
@@ -1227,14 +1658,21 @@ class MafiaCasinoBot:
         if not await self.is_admin(update.effective_user.id):
             return
         text = ' '.join(context.args)
-        count = 0
-        for user in await db.get_all_users():
-            try:
-                await context.bot.send_message(user['user_id'], text)
-                count += 1
-            except Exception:
-                pass
-        await update.message.reply_text(f"Рассылка отправлена {count} пользователям.")
+        if not text:
+            await update.message.reply_text("Использование: /broadcast текст")
+            return
+        # Задание работает в фоне; прогресс обновляется в отдельном сообщении
+        job = await broadcaster.start(context.bot, text, update.effective_chat.id)
+        await update.message.reply_text(f"Рассылка {job['job_id']} запущена. Остановить: /broadcast_stop {job['job_id']}")
+
+    async def broadcast_stop_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.is_admin(update.effective_user.id):
+            return
+        cancelled = await broadcaster.cancel(context.args[0] if context.args else None)
+        if cancelled:
+            await update.message.reply_text(f"Остановлены рассылки: {', '.join(cancelled)}")
+        else:
+            await update.message.reply_text("Активных рассылок нет.")
 
     # Бан/разбан
     async def ban_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1257,34 +1695,50 @@ class MafiaCasinoBot:
             return
         user_id = int(context.args[0])
         amount = int(context.args[1])
-        user = await db.get_user(user_id)
+        user = await db.apply_delta(user_id, inc={"money": amount}, reason="admin")
         if not user:
             await update.message.reply_text("Пользователь не найден.")
             return
-        new_money = user["money"] + amount
-        await db.update_user(user_id, {"money": new_money})
-        await update.message.reply_text(f"Готово! Новый баланс: {new_money}")
+        await update.message.reply_text(f"Готово! Новый баланс: {user['money']}")
 
     async def removemoney_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await self.is_admin(update.effective_user.id):
             return
         user_id = int(context.args[0])
         amount = int(context.args[1])
-        user = await db.get_user(user_id)
+        user = await db.get_user(user_id, fields=("money",))
         if not user:
             await update.message.reply_text("Пользователь не найден.")
             return
-        new_money = max(0, user["money"] - amount)
-        await db.update_user(user_id, {"money": new_money})
-        await update.message.reply_text(f"Готово! Новый баланс: {new_money}")
+        # Баланс не уходит в минус: списываем не больше, чем есть
+        amount = min(amount, user["money"])
+        user = await db.apply_delta(user_id, inc={"money": -amount}, min_money=amount, reason="admin")
+        if not user:
+            await update.message.reply_text("Баланс изменился, повторите команду.")
+            return
+        await update.message.reply_text(f"Готово! Новый баланс: {user['money']}")
 
     # Изменить ранг
     async def setrank_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await self.is_admin(update.effective_user.id):
             return
         user_id = int(context.args[0])
-        rank = context.args[1]
-        await db.update_user(user_id, {"rank": rank})
+        rank = " ".join(context.args[1:])
+        if rank == "auto":
+            # Снимаем закрепление: звание снова считается по деньгам и репутации
+            user = await db.get_user(user_id, fields=("money", "rank", "reputation"))
+            if not user:
+                await update.message.reply_text("Пользователь не найден.")
+                return
+            rank = rank_engine.resolve(user["money"], sum((user.get("reputation") or {}).values()))
+            await db.update_user(user_id, {"rank": rank, "rank_locked": False})
+            await update.message.reply_text(f"Ранг пользователя {user_id} снова автоматический: {rank}.")
+            return
+        if rank not in RANK_NAMES:
+            await update.message.reply_text(f"Неизвестный ранг. Доступны: {', '.join(RANK_NAMES)}, auto")
+            return
+        # Закрепленное звание не перезаписывается пересчетом (RankEngine.evaluate)
+        await db.update_user(user_id, {"rank": rank, "rank_locked": True})
         await update.message.reply_text(f"Ранг пользователя {user_id} изменён на {rank}.")
 
     # Профиль пользователя
@@ -1298,20 +1752,157 @@ class MafiaCasinoBot:
             return
         await update.message.reply_text(str(user))
 
+    # Статистика кэша пользователей
+    async def cachestats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.is_admin(update.effective_user.id):
+            return
+        stats = db.get_stats()
+        await update.message.reply_text(
+            f"Кэш: {stats['size']}/{stats['max_size']} (грязных: {stats['dirty']})\n"
+            f"Попадания: {stats['hits']}, промахи: {stats['misses']} ({stats['hit_ratio']:.1%})\n"
+            f"Сбросы: {stats['flushes']} ({stats['flushed_users']} польз.), ошибки: {stats['flush_errors']}\n"
+            f"Вытеснено: {stats['evictions']}, устарело: {stats['expired']}"
+        )
+        rendered = renderer.get_stats()
+        outbound = self.outbound.get_stats()
+        await update.message.reply_text(
+            f"Исходящая очередь: {outbound['queued']['interactive']} ответов, {outbound['queued']['broadcast']} рассылки, "
+            f"в полете: {outbound['in_flight']}\n"
+            f"Отправлено: {outbound['sent']} (+{outbound['immediate']} вне очереди), "
+            f"объединено правок: {outbound['coalesced']}\n"
+            f"429: {outbound['retry_after']}, ошибки: {outbound['failed']}, "
+            f"макс. ожидание: {outbound['max_wait']:.1f} с, пауза: {outbound['paused']:.1f} с\n"
+            f"Правки: {rendered['edits']}, пропущено без изменений: {rendered['skipped']}, "
+            f"\"not modified\": {rendered['not_modified']}"
+        )
+        ranks = rank_engine.get_stats()
+        await update.message.reply_text(
+            f"Звания: пересчетов {ranks['evaluated']}, повышений {ranks['promoted']}, понижений {ranks['demoted']}"
+        )
+
+    # Сверка баланса с журналом транзакций
+    async def ledger_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.is_admin(update.effective_user.id):
+            return
+        user_id = int(context.args[0])
+        user = await db.get_user(user_id, fields=("money",))
+        if not user:
+            await update.message.reply_text("Пользователь не найден.")
+            return
+        replayed = await ledger.replay(user_id)
+        await update.message.reply_text(
+            f"Баланс: {user['money']}\n"
+            f"По журналу: {replayed if replayed is not None else 'нет записей'}\n"
+            f"Записано: {ledger.stats['written']}, свернуто: {ledger.stats['compacted']}"
+        )
+
+    # Задержки обработки callback'ов по стадиям
+    async def latency_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.is_admin(update.effective_user.id):
+            return
+        lines = [
+            f"{stage}: p50 {stats['p50']:.1f} мс, p99 {stats['p99']:.1f} мс ({stats['count']})"
+            for stage, stats in latency.summary().items()
+        ] or ["Замеров пока нет."]
+        lines.append("Старт:")
+        for stage, stats in startup.summary().items():
+            budget = f" (бюджет {stats['budget']:.0f} мс)" if stats["budget"] is not None else ""
+            lines.append(f"{stage}: {stats['elapsed']:.0f} мс{budget}")
+        await update.message.reply_text("\n".join(lines))
+
+    # Метрики процесса: маршруты, команды, база, Bot API, кэш и очереди
+    async def metrics_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.is_admin(update.effective_user.id):
+            return
+        lines = []
+        sections = (
+            ("Маршруты", callback_seconds),
+            ("Команды", command_seconds),
+            ("База", db_seconds),
+            ("Bot API", api_seconds)
+        )
+        for title, histogram in sections:
+            summary = histogram.summary(limit=5)
+            lines.append(f"{title}:" if summary else f"{title}: замеров пока нет")
+            for labels, stats in summary.items():
+                p99 = f"≤{stats['p99']:.0f}" if stats["p99"] != float("inf") else f">{histogram.buckets[-1] * 1000:.0f}"
+                lines.append(f"  {'/'.join(labels)}: {stats['count']}, ср. {stats['avg']:.1f} мс, p99 {p99} мс")
+        db_failed = sum(db_errors.values.values())
+        api_failed = sum(count for (_, outcome), count in api_requests.values.items() if outcome != "ok")
+        cache = db.get_stats()
+        outbound = self.outbound.get_stats()
+        lines.append(f"Ошибки: база {db_failed}, Bot API {api_failed}")
+        lines.append(f"Кэш игроков: {cache['hit_ratio']:.1%} попаданий, callback_data: {self.hit_ratio(callback_codec.get_stats()):.1%}")
+        lines.append(
+            f"Очереди: обновлений {self.application.update_queue.qsize()}, "
+            f"обработчиков {in_flight.get_stats()['active']}, "
+            f"исходящих {outbound['queued']['interactive']}+{outbound['queued']['broadcast']}, "
+            f"журнала {len(ledger.buffer)}"
+        )
+        if self.metrics_port:
+            lines.append(f"Эндпоинт: http://{config.METRICS_LISTEN}:{self.metrics_port}/metrics")
+        await update.message.reply_text("\n".join(lines))
+
     # Общая статистика
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await self.is_admin(update.effective_user.id):
             return
-        total = len(await db.get_all_users())
-        banned = sum(1 for u in await db.get_all_users() if u.get("banned"))
-        total_money = sum(u["money"] for u in await db.get_all_users())
-        await update.message.reply_text(f"Всего пользователей: {total}\nЗабанено: {banned}\nОбщий баланс: {total_money}")
+        summary = await db.get_users_summary()
+        await update.message.reply_text(f"Всего пользователей: {summary['total']}\nЗабанено: {summary['banned']}\nОбщий баланс: {summary['total_money']}")
 
     def run(self):
         """Запускает бота"""
         logger.info("Запуск бота Мафиозное Казино...")
-        self.application.run_polling()
-    
+        if config.UPDATE_MODE == "webhook":
+            asyncio.run(run_webhook(
+                self.application,
+                url=config.WEBHOOK_URL,
+                secret_token=config.WEBHOOK_SECRET,
+                listen=config.WEBHOOK_LISTEN,
+                port=config.WEBHOOK_PORT,
+                path=config.WEBHOOK_PATH,
+                queue_size=config.WEBHOOK_QUEUE_SIZE,
+                workers=config.CONCURRENT_UPDATES,
+                drain_timeout=config.WEBHOOK_DRAIN_TIMEOUT
+            ))
+        else:
+            asyncio.run(run_polling(self.application, in_flight, drain_timeout=config.SHUTDOWN_DRAIN_TIMEOUT))
+
+
+def run_supervisor():
+    """Многопроцессный режим: супервизор сам бота не создает, это делают процессы-обработчики"""
+    logger.info(f"Запуск бота Мафиозное Казино: {config.WORKERS} процессов...")
+    if config.STORAGE_BACKEND == "memory":
+        logger.warning("WORKERS > 1 с хранилищем memory: у каждого процесса будут свои игроки")
+    asyncio.run(run_workers(
+        run_worker_process,
+        config.WORKERS,
+        config.BOT_TOKEN,
+        mode=config.UPDATE_MODE,
+        url=config.WEBHOOK_URL,
+        secret_token=config.WEBHOOK_SECRET,
+        listen=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        path=config.WEBHOOK_PATH,
+        queue_size=config.WEBHOOK_QUEUE_SIZE,
+        stop_timeout=config.WORKER_STOP_TIMEOUT
+    ))
+
+
+def run_worker_process(index: int, count: int, sock):
+    """Процесс-обработчик многопроцессного режима (запускает супервизор, см. workers.py)"""
+    setup_logging(worker_log_file(config.LOG_FILE, index))
+    bot = create_bot(worker_index=index, worker_count=count)
+    asyncio.run(run_worker(bot.application, sock, in_flight, drain_timeout=config.SHUTDOWN_DRAIN_TIMEOUT))
+
+
+def main():
+    setup_logging()
+    if config.WORKERS > 1:
+        run_supervisor()
+    else:
+        create_bot().run()
+
+
 if __name__ == "__main__":
-    bot = MafiaCasinoBot()
-    bot.run() 
+    main() 
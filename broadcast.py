@@ -0,0 +1,219 @@
+"""
+Модуль рассылок
+Задание перебирает игроков курсором по возрастанию user_id и отправляет
+сообщения несколькими обработчиками через очередь "broadcast" планировщика
+исходящих запросов. Контрольная точка и счетчики сохраняются в базе, поэтому
+после перезапуска задание продолжается с места остановки (последние несколько
+игроков перед точкой могут получить сообщение повторно)
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Исходы отправки; после DEAD_KINDS чат помечается chat_blocked и больше не получает рассылок
+OUTCOMES = ("sent", "blocked", "deactivated", "not_found", "flood", "failed")
+DEAD_KINDS = ("blocked", "deactivated", "not_found")
+
+RECIPIENTS_QUERY = {"banned": {"$ne": True}, "chat_blocked": {"$ne": True}}
+
+
+def classify_error(error: TelegramError) -> str:
+    """Относит ошибку Telegram к одному из исходов OUTCOMES"""
+    message = str(error).lower()
+    if isinstance(error, RetryAfter):
+        return "flood"
+    if isinstance(error, Forbidden):
+        return "deactivated" if "deactivated" in message else "blocked"
+    if isinstance(error, BadRequest) and "chat not found" in message:
+        return "not_found"
+    return "failed"
+
+
+def format_progress(job: Dict, rate: float = 0.0) -> str:
+    counts = job["counts"]
+    return (
+        f"📣 Рассылка {job['job_id']}: {job['status']}\n"
+        f"Отправлено: {counts['sent']}\n"
+        f"Заблокировали бота: {counts['blocked']}, удалены: {counts['deactivated']}, "
+        f"нет чата: {counts['not_found']}\n"
+        f"Флуд: {counts['flood']}, прочие ошибки: {counts['failed']}\n"
+        f"Скорость: {rate:.1f} сообщ./с"
+    )
+
+
+class Broadcaster:
+    """
+    Задания рассылки: запуск, возобновление после перезапуска, отмена
+    Отправкой занимаются concurrency обработчиков; сколько сообщений реально
+    уходит в секунду, решает OutboundScheduler
+    """
+
+    def __init__(self, db, concurrency: int = 32, batch_size: int = 500,
+                 report_interval: float = 5, flood_retries: int = 3):
+        self.db = db
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self.flood_retries = flood_retries
+        self.jobs: Dict[str, Dict] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._rates: Dict[str, float] = {}
+
+    async def start(self, bot, text: str, admin_chat_id: int) -> Dict:
+        """Создает задание и запускает его; прогресс пишется в сообщение администратору"""
+        job = {
+            "job_id": uuid.uuid4().hex[:8],
+            "text": text,
+            "status": "running",
+            "checkpoint": None,
+            "counts": dict.fromkeys(OUTCOMES, 0),
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": None,
+            "created_at": datetime.now().isoformat(),
+            "finished_at": None
+        }
+        message = await bot.send_message(admin_chat_id, format_progress(job))
+        job["progress_message_id"] = message.message_id
+        await self.db.save_broadcast_job(job)
+        self._launch(bot, job)
+        return job
+
+    async def resume(self, bot) -> int:
+        """Продолжает задания, прерванные остановкой процесса"""
+        jobs = await self.db.get_broadcast_jobs("running")
+        for job in jobs:
+            logger.info(f"Продолжаем рассылку {job['job_id']} после user_id={job['checkpoint']}")
+            self._launch(bot, job)
+        return len(jobs)
+
+    async def cancel(self, job_id: Optional[str] = None) -> List[str]:
+        """Отменяет задание (или все активные): новые получатели больше не выбираются"""
+        cancelled = []
+        for job in list(self.jobs.values()):
+            if job_id is None or job["job_id"] == job_id:
+                job["status"] = "cancelled"
+                cancelled.append(job["job_id"])
+        return cancelled
+
+    async def stop(self):
+        """
+        Останавливает задания при завершении процесса, сохранив контрольную точку;
+        статус остается "running", и resume продолжит их при следующем запуске
+        """
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _launch(self, bot, job: Dict):
+        self.jobs[job["job_id"]] = job
+        task = asyncio.create_task(self._run(bot, job))
+        self._tasks[job["job_id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["job_id"], None))
+
+    async def _run(self, bot, job: Dict):
+        # user_id -> отправлено ли; контрольная точка - последний id, до которого все готово
+        pending: "OrderedDict[int, bool]" = OrderedDict()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(bot, job, queue, pending)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report_loop(bot, job))
+        try:
+            async for user in self.db.iter_users(RECIPIENTS_QUERY, {"_id": 0, "user_id": 1},
+                                                 self.batch_size, after_user_id=job["checkpoint"]):
+                if job["status"] != "running":
+                    break
+                pending[user["user_id"]] = False
+                await queue.put(user["user_id"])
+            await queue.join()
+            if job["status"] == "running":
+                job["status"] = "done"
+            job["finished_at"] = datetime.now().isoformat()
+        except Exception as e:
+            job["status"] = "failed"
+            logger.error(f"Рассылка {job['job_id']} прервана ошибкой: {e}")
+        finally:
+            for task in workers + [reporter]:
+                task.cancel()
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+            # Сохранение и отчет не должны отменяться вместе с заданием
+            await asyncio.shield(self._checkpoint(bot, job))
+            self.jobs.pop(job["job_id"], None)
+            self._rates.pop(job["job_id"], None)
+        logger.info(f"Рассылка {job['job_id']} завершена: {job['status']}, {job['counts']}")
+
+    async def _worker(self, bot, job: Dict, queue: asyncio.Queue, pending: "OrderedDict[int, bool]"):
+        while True:
+            user_id = await queue.get()
+            try:
+                if job["status"] == "running":
+                    outcome = await self._send(bot, job["text"], user_id)
+                    job["counts"][outcome] += 1
+                    if outcome in DEAD_KINDS:
+                        await self.db.mark_chat_blocked(user_id)
+                pending[user_id] = True
+                while pending:
+                    first_id, done = next(iter(pending.items()))
+                    if not done:
+                        break
+                    pending.popitem(last=False)
+                    job["checkpoint"] = first_id
+            except Exception as e:
+                job["counts"]["failed"] += 1
+                pending[user_id] = True
+                logger.error(f"Ошибка рассылки {job['job_id']} для {user_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def _send(self, bot, text: str, user_id) -> str:
+        for attempt in range(self.flood_retries + 1):
+            try:
+                await bot.send_message(user_id, text, rate_limit_args={"priority": "broadcast"})
+                return "sent"
+            except TelegramError as e:
+                outcome = classify_error(e)
+                if outcome != "flood" or attempt == self.flood_retries:
+                    return outcome
+                # Планировщик уже исчерпал свои повторы: ждем и пробуем еще раз
+                await asyncio.sleep(float(getattr(e, "retry_after", 1)))
+        return "flood"
+
+    async def _report_loop(self, bot, job: Dict):
+        started = time.monotonic()
+        initial = sum(job["counts"].values())
+        while True:
+            await asyncio.sleep(self.report_interval)
+            done = sum(job["counts"].values()) - initial
+            self._rates[job["job_id"]] = done / (time.monotonic() - started)
+            await self._checkpoint(bot, job)
+
+    async def _checkpoint(self, bot, job: Dict):
+        """Сохраняет задание и обновляет сообщение с прогрессом"""
+        try:
+            await self.db.save_broadcast_job(job)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить рассылку {job['job_id']}: {e}")
+        if job.get("progress_message_id"):
+            try:
+                await bot.edit_message_text(
+                    format_progress(job, self._rates.get(job["job_id"], 0.0)),
+                    chat_id=job["admin_chat_id"],
+                    message_id=job["progress_message_id"]
+                )
+            except TelegramError:
+                # "message is not modified" и удаленное сообщение не мешают рассылке
+                pass
+
+    def get_stats(self) -> Dict:
+        return {
+            job_id: {**job["counts"], "rate": self._rates.get(job_id, 0.0), "checkpoint": job["checkpoint"]}
+            for job_id, job in self.jobs.items()
+        }
@@ -0,0 +1,156 @@
+"""
+Модуль компактного кодирования callback_data
+Маршрут и аргумент кнопки записываются короткими числами вместо строк вида
+"buy_territory_Էլիտար շրջան": "~<версия>.<маршрут>.<аргумент>"
+Версия - отпечаток таблиц маршрутов и каталогов: после их изменения старые
+кнопки не расшифровываются в чужой маршрут, а считаются устаревшими
+"""
+
+import functools
+import zlib
+from typing import Dict, Optional, Tuple
+
+from config import SHOP_ITEMS, TERRITORIES
+from storage import LEADERBOARD_SORTS
+
+PREFIX = "~"
+VERSION_LENGTH = 6
+
+BET_AMOUNTS = (10, 50, 100, 500, 1000)
+CRIME_TYPES = ("pickpocket", "robbery", "smuggling", "bank")
+ROULETTE_BETS = ("red", "black", "even", "odd")
+
+# Каталоги аргументов: в кнопке хранится индекс значения
+CATALOGS: Dict[str, Tuple] = {
+    "bet": BET_AMOUNTS,
+    "crime": CRIME_TYPES,
+    "roulette": ROULETTE_BETS,
+    "territory": tuple(TERRITORIES),
+    "shop": tuple(SHOP_ITEMS),
+    "board": tuple(LEADERBOARD_SORTS)
+}
+
+# Маршруты: (шаблон, аргумент), номер маршрута - позиция в списке
+# Аргумент: None - без аргумента, int - число как есть, иначе имя каталога
+ROUTES = (
+    ("main_menu", None),
+    ("shop_menu", None),
+    ("crime_menu", None),
+    ("casino_menu", None),
+    ("poker_menu", None),
+    ("territories_menu", None),
+    ("gang_menu", None),
+    ("help", None),
+    ("top_menu", None),
+    ("profile", None),
+    ("profile_stats", None),
+    ("profile_achievements", None),
+    ("daily_bonus", None),
+    ("casino_stats", None),
+    ("slots_menu", None),
+    ("slots_", "bet"),
+    ("roulette_menu", None),
+    ("roulette_number", None),
+    ("roulette_", "roulette"),
+    ("roulette_pick_number_", int),
+    ("roulette_bet_", "bet"),
+    ("blackjack_menu", None),
+    ("blackjack_", "bet"),
+    ("blackjack_hit_", int),
+    ("blackjack_stand_", int),
+    ("dice_menu", None),
+    ("dice_", "bet"),
+    ("dice_pred_", int),
+    ("crime_", "crime"),
+    ("escape", None),
+    ("buy_territory", None),
+    ("buy_territory_", "territory"),
+    ("collect_income", None),
+    ("my_territories", None),
+    ("buy_", "shop"),
+    ("top_", "board")
+)
+
+
+def _to_base36(number: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while True:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+        if not number:
+            return result
+
+
+def tables_version(routes, catalogs) -> str:
+    """
+    Отпечаток таблиц (до VERSION_LENGTH символов): меняется при любом изменении
+    маршрутов или каталогов; случайное совпадение - примерно 1 из 2 миллиардов
+    """
+    kinds = [(pattern, kind if kind is not int else "int") for pattern, kind in routes]
+    return _to_base36(zlib.crc32(repr((kinds, sorted(catalogs.items()))).encode()) % 36 ** VERSION_LENGTH)
+
+
+class CallbackCodec:
+    """
+    Кодек callback_data
+    encode("buy_territory_", "Կենտրոն") -> "~1k9f3c.31.2"; decode - обратно
+    в ("buy_territory_", "Կենտրոն"), None для устаревших и чужих кнопок
+    Расшифровки запоминаются в LRU-кэше
+    """
+
+    def __init__(self, routes=ROUTES, catalogs: Optional[Dict[str, Tuple]] = None, cache_size: int = 4096):
+        self.catalogs = CATALOGS if catalogs is None else catalogs
+        self.routes = tuple(routes)
+        self.version = tables_version(self.routes, self.catalogs)
+        self.route_ids: Dict[str, int] = {pattern: index for index, (pattern, _) in enumerate(self.routes)}
+        self.arg_ids: Dict[str, Dict] = {
+            name: {value: index for index, value in enumerate(values)}
+            for name, values in self.catalogs.items()
+        }
+        self.decode = functools.lru_cache(maxsize=cache_size)(self._decode)
+
+    def __contains__(self, pattern: str) -> bool:
+        return pattern in self.route_ids
+
+    @staticmethod
+    def is_encoded(data: str) -> bool:
+        return data.startswith(PREFIX)
+
+    def encode(self, pattern: str, arg=None) -> str:
+        """
+        Кодирует маршрут и аргумент; KeyError для незнакомого маршрута или
+        значения не из каталога
+        """
+        route_id = self.route_ids[pattern]
+        kind = self.routes[route_id][1]
+        if kind is None:
+            return f"{PREFIX}{self.version}.{route_id}"
+        if kind is int:
+            return f"{PREFIX}{self.version}.{route_id}.{int(arg)}"
+        return f"{PREFIX}{self.version}.{route_id}.{self.arg_ids[kind][arg]}"
+
+    def _decode(self, data: str) -> Optional[Tuple[str, object]]:
+        version, _, rest = data[len(PREFIX):].partition(".")
+        if version != self.version:
+            return None
+        route_id, _, raw = rest.partition(".")
+        if not route_id.isdecimal() or int(route_id) >= len(self.routes):
+            return None
+        pattern, kind = self.routes[int(route_id)]
+        if kind is None:
+            return (pattern, None) if not raw else None
+        if not raw.isdecimal():
+            return None
+        if kind is int:
+            return pattern, int(raw)
+        values = self.catalogs[kind]
+        index = int(raw)
+        return (pattern, values[index]) if index < len(values) else None
+
+    def get_stats(self) -> Dict:
+        info = self.decode.cache_info()
+        return {"version": self.version, "hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+
+callback_codec = CallbackCodec()
@@ -0,0 +1,226 @@
+"""
+Модуль маршрутизации callback'ов
+Точные маршруты ищутся в словаре, параметризованные - по префиксному дереву
+из сегментов "слово_" (побеждает самый длинный префикс), так что порядок
+регистрации не важен
+Кнопки, закодированные callback_codec, разбираются кодеком без работы со строкой
+"""
+
+import asyncio
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from outbound import TokenBucket
+
+
+def choice(*values: str) -> Callable[[str], str]:
+    """Тип аргумента: одно из перечисленных значений"""
+    allowed = frozenset(values)
+
+    def parse(raw: str) -> str:
+        if raw not in allowed:
+            raise ValueError(f"недопустимое значение {raw!r}")
+        return raw
+    return parse
+
+
+class Route:
+    """
+    Маршрут callback'а и его метаданные
+    fields - поля игрока для обработчика: False - игрок не нужен,
+    None - весь документ, иначе кортеж полей
+    rate - класс ограничения частоты ("menu", "game", ...)
+    arg - функция разбора аргумента после префикса (int, str, choice(...))
+    prefetch - имя -> async функция (update, context): данные, которые
+    загружаются одновременно с игроком и попадают в request.prefetched
+    """
+    __slots__ = ("pattern", "handler", "fields", "rate", "arg", "prefetch")
+
+    def __init__(self, pattern: str, handler: Callable, fields=None, rate: str = "menu",
+                 arg: Optional[Callable[[str], object]] = None, prefetch: Optional[Dict[str, Callable]] = None):
+        self.pattern = pattern
+        self.handler = handler
+        self.fields = fields
+        self.rate = rate
+        self.arg = arg
+        self.prefetch = prefetch
+
+
+class RateLimiter:
+    """
+    Ограничение частоты нажатий по классам маршрутов (Route.rate)
+    limits - класс -> (нажатий в секунду, сколько подряд); классы без
+    лимита не ограничиваются. На каждую пару (класс, игрок) - ведро токенов;
+    полные ведра выбрасываются, поэтому память не растет с числом игроков
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], clock: Callable[[], float] = time.monotonic,
+                 prune_threshold: int = 4096):
+        self.limits = limits
+        self.clock = clock
+        self.buckets: Dict[Tuple[str, int], TokenBucket] = {}
+        self.min_prune_threshold = self.prune_threshold = prune_threshold
+        self.stats = {"allowed": 0, "limited": 0}
+
+    def allow(self, rate: str, user_id) -> bool:
+        """Можно ли обработать нажатие; разрешенное нажатие расходует токен"""
+        limit = self.limits.get(rate)
+        if limit is None:
+            return True
+        now = self.clock()
+        key = (rate, user_id)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.prune_threshold:
+                self._prune(now)
+            bucket = self.buckets[key] = TokenBucket(limit[0], limit[1], now)
+        if bucket.wait_time(now) > 0:
+            self.stats["limited"] += 1
+            return False
+        bucket.take()
+        self.stats["allowed"] += 1
+        return True
+
+    def _prune(self, now: float):
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if not bucket.is_full(now)}
+        self.prune_threshold = max(self.min_prune_threshold, 2 * len(self.buckets))
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, "buckets": len(self.buckets)}
+
+
+class CallbackRequest:
+    """Все, что нужно обработчику callback'а: обработчики принимают только его"""
+    __slots__ = ("update", "context", "query", "data", "route", "arg", "user_data", "prefetched")
+
+    def __init__(self, update, context, query, data: str, route: Route, arg=None, user_data=None,
+                 prefetched: Optional[Dict] = None):
+        self.update = update
+        self.context = context
+        self.query = query
+        self.data = data
+        self.route = route
+        self.arg = arg
+        self.user_data = user_data
+        self.prefetched = prefetched or {}
+
+    @property
+    def request(self):
+        """Контекст запроса (RequestContext) текущего обновления"""
+        return getattr(self.context, "request", None)
+
+
+class _TrieNode:
+    __slots__ = ("children", "route")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.route: Optional[Route] = None
+
+
+class CallbackRouter:
+    """
+    Таблица маршрутов callback'ов
+    Набор кнопок конечен, поэтому результаты разбора запоминаются:
+    повторное нажатие - один поиск в словаре
+    codec - CallbackCodec для компактных кнопок; строковые (старые) кнопки
+    продолжают работать
+    """
+
+    def __init__(self, cache_size: int = 4096, codec=None):
+        self.exact_routes: Dict[str, Route] = {}
+        self.patterns: Dict[str, Route] = {}
+        self.root = _TrieNode()
+        self.codec = codec
+        self.cache_size = cache_size
+        self._cache: Dict[str, Tuple[Optional[Route], object]] = {}
+
+    def exact(self, data: str, handler: Callable, fields=None, rate: str = "menu",
+              prefetch: Optional[Dict[str, Callable]] = None) -> Route:
+        """Регистрирует маршрут для точного значения callback_data"""
+        if data in self.exact_routes:
+            raise ValueError(f"Маршрут {data!r} уже зарегистрирован")
+        route = self.exact_routes[data] = self.patterns[data] = Route(data, handler, fields, rate, prefetch=prefetch)
+        self._cache.clear()
+        return route
+
+    def prefix(self, prefix: str, handler: Callable, fields=None, rate: str = "menu",
+               arg: Callable[[str], object] = str, prefetch: Optional[Dict[str, Callable]] = None) -> Route:
+        """
+        Регистрирует маршрут "prefix + аргумент"; аргумент разбирается функцией arg
+        Префикс заканчивается на "_": дерево ветвится по сегментам, а не по символам
+        """
+        if not prefix.endswith("_"):
+            raise ValueError(f"Префикс {prefix!r} должен заканчиваться на '_'")
+        node = self.root
+        for segment in prefix[:-1].split("_"):
+            node = node.children.setdefault(segment + "_", _TrieNode())
+        if node.route is not None:
+            raise ValueError(f"Префикс {prefix!r} уже зарегистрирован")
+        node.route = self.patterns[prefix] = Route(prefix, handler, fields, rate, arg, prefetch)
+        self._cache.clear()
+        return node.route
+
+    def resolve(self, data: str) -> Tuple[Optional[Route], object]:
+        """
+        Находит маршрут и разобранный аргумент: (route, arg)
+        (None, None), если маршрута нет или аргумент не разбирается
+        """
+        if self.codec is not None and self.codec.is_encoded(data):
+            # Кодек сам кэширует расшифровки и уже отдает разобранный аргумент
+            decoded = self.codec.decode(data)
+            if decoded is None:
+                return None, None
+            route = self.patterns.get(decoded[0])
+            return (route, decoded[1]) if route is not None else (None, None)
+        result = self._cache.get(data)
+        if result is None:
+            result = self._resolve(data)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[data] = result
+        return result
+
+    def _resolve(self, data: str) -> Tuple[Optional[Route], object]:
+        route = self.exact_routes.get(data)
+        if route is not None:
+            return route, None
+
+        node = self.root
+        best, best_length = None, 0
+        start = 0
+        while True:
+            end = data.find("_", start) + 1
+            if not end:
+                break
+            node = node.children.get(data[start:end])
+            if node is None:
+                break
+            if node.route is not None:
+                best, best_length = node.route, end
+            start = end
+        if best is None:
+            return None, None
+        try:
+            return best, best.arg(data[best_length:])
+        except ValueError:
+            return None, None
+
+    @staticmethod
+    async def prefetch(route: Route, update, context) -> Dict:
+        """Загружает одновременно все данные, объявленные маршрутом"""
+        if not route.prefetch:
+            return {}
+        names = list(route.prefetch)
+        results = await asyncio.gather(*(route.prefetch[name](update, context) for name in names))
+        return dict(zip(names, results))
+
+    def routes(self):
+        """Все зарегистрированные маршруты (для отладки и бенчмарков)"""
+        yield from self.exact_routes.values()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.route is not None:
+                yield node.route
+            stack.extend(node.children.values())
@@ -95,11 +95,98 @@ COOLDOWNS = {
     "territory_income": 3600,  # 1 час
 }
 
+# Частота нажатий: класс маршрута (Route.rate) -> (нажатий в секунду, сколько подряд)
+CALLBACK_RATE_LIMITS = {
+    "menu": (5, 10),
+    "game": (3, 6),
+}
+
+# Хранилище игроков: "mongo", "sqlite" (локальный файл) или "memory" (для тестов)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongo')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'mafia_casino.db')
+
+# Кэш пользователей перед базой
+USER_CACHE_MAX_SIZE = 10000  # Максимум игроков в памяти
+USER_CACHE_TTL = 300  # Через сколько секунд документ перечитывается из базы
+USER_CACHE_FLUSH_INTERVAL = 2  # Период сброса накопленных изменений (секунды)
+
+# Прием обновлений: "polling" или "webhook" (встроенный HTTP-сервер, см. webhook_server.py)
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес, например https://bot.example.com
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # Секретный токен: 1-256 символов A-Z, a-z, 0-9, _ и -
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_QUEUE_SIZE = 1000  # Обновлений в очереди до ответа 503
+WEBHOOK_DRAIN_TIMEOUT = 30  # Сколько секунд дорабатывать очередь при остановке
+
+# Игровые сессии (см. sessions.py): "storage" - в базе, общие для всех экземпляров; "memory" - в процессе
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'storage')
+SESSION_TTL = 3600  # Через сколько секунд без ходов брошенная игра удаляется
+SESSION_PURGE_INTERVAL = 300
+
+# Остановка и перезапуск (см. lifecycle.py, snapshot.py)
+SHUTDOWN_DRAIN_TIMEOUT = 20  # Сколько секунд дорабатывать начатые обработчики в режиме polling
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'state_snapshot.bin')  # Горячие игроки между перезапусками
+SNAPSHOT_MAX_AGE = 900  # Снимок старше стольких секунд при запуске не применяется
+SNAPSHOT_HOT_USERS = 5000  # Сколько недавних игроков прогревать в кэше
+
+# Многопроцессный режим (см. workers.py): обновления игрока всегда попадают в один процесс
+WORKERS = int(os.getenv('WORKERS', '1'))  # 1 - все в одном процессе
+WORKER_STOP_TIMEOUT = 30  # Сколько секунд процессы дорабатывают начатое при остановке
+LEADERBOARD_REFRESH_INTERVAL = 60  # При WORKERS > 1: период перечитывания рейтингов из базы
+
+# Сколько обновлений обрабатывается одновременно (обновления одного игрока - по очереди)
+CONCURRENT_UPDATES = 256
+
+# Исходящие запросы к Telegram (см. outbound.py)
+OUTBOUND_GLOBAL_RATE = 30  # Сообщений в секунду на бота
+OUTBOUND_CHAT_RATE = 1  # Сообщений в секунду в личный чат (правки экранов не считаются)
+OUTBOUND_CHAT_BURST = 3  # Сколько сообщений в личный чат можно отправить подряд
+OUTBOUND_GROUP_RATE = 20 / 60  # Сообщений в секунду в группу (20 в минуту)
+OUTBOUND_GROUP_BURST = 5
+OUTBOUND_MAX_RETRIES = 3  # Повторов после 429
+
+# Рассылки (см. broadcast.py)
+BROADCAST_CONCURRENCY = 32  # Одновременных отправок в задании
+BROADCAST_REPORT_INTERVAL = 5  # Период сохранения прогресса и отчета администратору (секунды)
+
+# Журнал транзакций
+LEDGER_BATCH_SIZE = 500  # Записей в одной пачке вставки
+LEDGER_FLUSH_INTERVAL = 2  # Период записи буфера (секунды)
+LEDGER_RETENTION = 7 * 24 * 60 * 60  # Записи старше сворачиваются в снимки
+LEDGER_COMPACT_INTERVAL = 60 * 60  # Период сжатия журнала (секунды)
+
+# Бюджет холодного старта, секунды (см. metrics.StartupBudget): import - загрузка модулей бота,
+# build - создание приложения, ready - база и фоновые задачи готовы (от начала импорта),
+# first_update - обработка первого обновления
+STARTUP_BUDGET = {"import": 1.5, "build": 2.0, "ready": 10.0, "first_update": 1.0}
+
+# Метрики (см. metrics.py): текстовый формат Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics
+# В многопроцессном режиме процесс-обработчик i слушает METRICS_PORT + i; 0 - эндпоинт выключен
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Проверять планы горячих запросов при запуске (предупреждение о COLLSCAN)
+CHECK_QUERY_PLANS = True
+
 # Файлы данных
 DATA_FILE = "users_data.json"
 GANGS_FILE = "gangs_data.json"
 EVENTS_FILE = "events_data.json"
 
-# Логирование
-LOG_LEVEL = "INFO"
-LOG_FILE = "mafia_casino_bot.log" 
\ No newline at end of file
+# Логирование (см. logging_setup.py)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FILE = os.getenv('LOG_FILE', 'mafia_casino_bot.log')
+LOG_ROTATION = 'size'  # "size" - по размеру LOG_MAX_BYTES, "time" - по LOG_ROTATE_WHEN
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_ROTATE_WHEN = 'midnight'
+LOG_BACKUP_COUNT = 5  # Сколько старых файлов хранить
+# Уровни отдельных логгеров
+LOG_LEVELS = {
+    'httpcore': 'WARNING'
+}
+# Прореживание частых записей ниже WARNING: логгер -> пишется одна из N одинаковых
+LOG_SAMPLING = {
+    'httpx': 100
+}
@@ -75,6 +75,7 @@ class CrimeSystem:
                 "reputation_changes": crime_info["reputation_change"],
                 "new_reputation": new_reputation,
                 "new_stats": new_stats,
+                "stats_changes": {"crimes_committed": 1, "crimes_successful": 1, "money_earned": reward},
                 "message": f"✅ Հաջող {crime_type}! +{reward} մետաղադրամ"
             }
         else:
@@ -98,6 +99,7 @@ class CrimeSystem:
                 "reputation_changes": {k: v // 2 for k, v in crime_info["reputation_change"].items()},
                 "new_reputation": new_reputation,
                 "new_stats": new_stats,
+                "stats_changes": {"crimes_committed": 1},
                 "message": f"🚔 Բռնվեցին! {crime_type} չհաջողվեց: Բանտ {jail_time//60} րոպե"
             }
     
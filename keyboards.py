@@ -1,233 +1,249 @@
 """
 Модуль с клавиатурами и кнопками
 Создает inline клавиатуры для всех меню бота
+callback_data маршрутизируемых кнопок кодируется callback_codec
+Постоянные меню строятся при первом обращении и дальше переиспользуются:
+разметка PTB неизменяема, поэтому один объект можно отдавать всем ответам
 """
 
+import functools
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from typing import List, Dict, Optional
 from translations import get_text
+from callback_codec import callback_codec
 
 class Keyboards:
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def main_menu() -> InlineKeyboardMarkup:
         """Главное меню"""
         keyboard = [
             [
-                InlineKeyboardButton("💰 Կազինո", callback_data="casino_menu"),
-                InlineKeyboardButton("🔫 Հանցագործություններ", callback_data="crime_menu")
+                InlineKeyboardButton("💰 Կազինո", callback_data=callback_codec.encode("casino_menu")),
+                InlineKeyboardButton("🔫 Հանցագործություններ", callback_data=callback_codec.encode("crime_menu"))
             ],
             [
-                InlineKeyboardButton("👤 Պրոֆիլ", callback_data="profile"),
-                InlineKeyboardButton("👥 Խումբ", callback_data="gang_menu")
+                InlineKeyboardButton("👤 Պրոֆիլ", callback_data=callback_codec.encode("profile")),
+                InlineKeyboardButton("👥 Խումբ", callback_data=callback_codec.encode("gang_menu"))
             ],
             [
-                InlineKeyboardButton("🏪 Խանութ", callback_data="shop_menu"),
-                InlineKeyboardButton("📊 Դասակարգում", callback_data="top_menu")
+                InlineKeyboardButton("🏪 Խանութ", callback_data=callback_codec.encode("shop_menu")),
+                InlineKeyboardButton("📊 Դասակարգում", callback_data=callback_codec.encode("top_menu"))
             ],
             [
-                InlineKeyboardButton("🎁 Օրական բոնուս", callback_data="daily_bonus"),
-                InlineKeyboardButton("❓ Օգնություն", callback_data="help")
+                InlineKeyboardButton("🎁 Օրական բոնուս", callback_data=callback_codec.encode("daily_bonus")),
+                InlineKeyboardButton("❓ Օգնություն", callback_data=callback_codec.encode("help"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def casino_menu() -> InlineKeyboardMarkup:
         """Меню казино"""
         keyboard = [
             [
-                InlineKeyboardButton("🎰 Սլոտեր", callback_data="slots_menu"),
-                InlineKeyboardButton("🎲 Ռուլետկա", callback_data="roulette_menu")
+                InlineKeyboardButton("🎰 Սլոտեր", callback_data=callback_codec.encode("slots_menu")),
+                InlineKeyboardButton("🎲 Ռուլետկա", callback_data=callback_codec.encode("roulette_menu"))
             ],
             [
-                InlineKeyboardButton("🃏 Բլեքջեք", callback_data="blackjack_menu"),
-                InlineKeyboardButton("🎲 Զառեր", callback_data="dice_menu")
+                InlineKeyboardButton("🃏 Բլեքջեք", callback_data=callback_codec.encode("blackjack_menu")),
+                InlineKeyboardButton("🎲 Զառեր", callback_data=callback_codec.encode("dice_menu"))
             ],
             [
-                InlineKeyboardButton("♠️ Պոկեր", callback_data="poker_menu"),
-                InlineKeyboardButton("📊 Խաղերի վիճակագրություն", callback_data="casino_stats")
+                InlineKeyboardButton("♠️ Պոկեր", callback_data=callback_codec.encode("poker_menu")),
+                InlineKeyboardButton("📊 Խաղերի վիճակագրություն", callback_data=callback_codec.encode("casino_stats"))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="main_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("main_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def slots_menu() -> InlineKeyboardMarkup:
         """Меню слотов"""
         keyboard = [
             [
-                InlineKeyboardButton("🎰 10 մետաղադրամ", callback_data="slots_10"),
-                InlineKeyboardButton("🎰 50 մետաղադրամ", callback_data="slots_50"),
-                InlineKeyboardButton("🎰 100 մետաղադրամ", callback_data="slots_100")
+                InlineKeyboardButton("🎰 10 մետաղադրամ", callback_data=callback_codec.encode("slots_", 10)),
+                InlineKeyboardButton("🎰 50 մետաղադրամ", callback_data=callback_codec.encode("slots_", 50)),
+                InlineKeyboardButton("🎰 100 մետաղադրամ", callback_data=callback_codec.encode("slots_", 100))
             ],
             [
-                InlineKeyboardButton("🎰 500 մետաղադրամ", callback_data="slots_500"),
-                InlineKeyboardButton("🎰 1000 մետաղադրամ", callback_data="slots_1000")
+                InlineKeyboardButton("🎰 500 մետաղադրամ", callback_data=callback_codec.encode("slots_", 500)),
+                InlineKeyboardButton("🎰 1000 մետաղադրամ", callback_data=callback_codec.encode("slots_", 1000))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="casino_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("casino_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def roulette_menu() -> InlineKeyboardMarkup:
         """Меню рулетки"""
         keyboard = [
             [
-                InlineKeyboardButton("🔴 Կարմիր", callback_data="roulette_red"),
-                InlineKeyboardButton("⚫ Սև", callback_data="roulette_black")
+                InlineKeyboardButton("🔴 Կարմիր", callback_data=callback_codec.encode("roulette_", "red")),
+                InlineKeyboardButton("⚫ Սև", callback_data=callback_codec.encode("roulette_", "black"))
             ],
             [
-                InlineKeyboardButton("🔢 Զույգ", callback_data="roulette_even"),
-                InlineKeyboardButton("🔢 Կենտ", callback_data="roulette_odd")
+                InlineKeyboardButton("🔢 Զույգ", callback_data=callback_codec.encode("roulette_", "even")),
+                InlineKeyboardButton("🔢 Կենտ", callback_data=callback_codec.encode("roulette_", "odd"))
             ],
             [
-                InlineKeyboardButton("🎯 Կոնկրետ թիվ", callback_data="roulette_number")
+                InlineKeyboardButton("🎯 Կոնկրետ թիվ", callback_data=callback_codec.encode("roulette_number"))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="casino_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("casino_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def roulette_bet_amounts() -> InlineKeyboardMarkup:
         """Ставки для рулетки"""
         keyboard = [
             [
-                InlineKeyboardButton("💰 10", callback_data="roulette_bet_10"),
-                InlineKeyboardButton("💰 50", callback_data="roulette_bet_50"),
-                InlineKeyboardButton("💰 100", callback_data="roulette_bet_100")
+                InlineKeyboardButton("💰 10", callback_data=callback_codec.encode("roulette_bet_", 10)),
+                InlineKeyboardButton("💰 50", callback_data=callback_codec.encode("roulette_bet_", 50)),
+                InlineKeyboardButton("💰 100", callback_data=callback_codec.encode("roulette_bet_", 100))
             ],
             [
-                InlineKeyboardButton("💰 500", callback_data="roulette_bet_500"),
-                InlineKeyboardButton("💰 1000", callback_data="roulette_bet_1000")
+                InlineKeyboardButton("💰 500", callback_data=callback_codec.encode("roulette_bet_", 500)),
+                InlineKeyboardButton("💰 1000", callback_data=callback_codec.encode("roulette_bet_", 1000))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="roulette_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("roulette_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def blackjack_menu() -> InlineKeyboardMarkup:
         """Меню блэкджека"""
         keyboard = [
             [
-                InlineKeyboardButton("🃏 10 մետաղադրամ", callback_data="blackjack_10"),
-                InlineKeyboardButton("🃏 50 մետաղադրամ", callback_data="blackjack_50"),
-                InlineKeyboardButton("🃏 100 մետաղադրամ", callback_data="blackjack_100")
+                InlineKeyboardButton("🃏 10 մետաղադրամ", callback_data=callback_codec.encode("blackjack_", 10)),
+                InlineKeyboardButton("🃏 50 մետաղադրամ", callback_data=callback_codec.encode("blackjack_", 50)),
+                InlineKeyboardButton("🃏 100 մետաղադրամ", callback_data=callback_codec.encode("blackjack_", 100))
             ],
             [
-                InlineKeyboardButton("🃏 500 մետաղադրամ", callback_data="blackjack_500"),
-                InlineKeyboardButton("🃏 1000 մետաղադրամ", callback_data="blackjack_1000")
+                InlineKeyboardButton("🃏 500 մետաղադրամ", callback_data=callback_codec.encode("blackjack_", 500)),
+                InlineKeyboardButton("🃏 1000 մետաղադրամ", callback_data=callback_codec.encode("blackjack_", 1000))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="casino_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("casino_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
-    def blackjack_game() -> InlineKeyboardMarkup:
-        """Кнопки во время игры в блэкджек"""
+    def blackjack_game(version: int) -> InlineKeyboardMarkup:
+        """Кнопки во время игры в блэкджек; version - версия сессии, к которой относятся ходы"""
         keyboard = [
             [
-                InlineKeyboardButton("➕ Վերցնել քարտ", callback_data="blackjack_hit"),
-                InlineKeyboardButton("✋ Բավական է", callback_data="blackjack_stand")
+                InlineKeyboardButton("➕ Վերցնել քարտ", callback_data=callback_codec.encode("blackjack_hit_", version)),
+                InlineKeyboardButton("✋ Բավական է", callback_data=callback_codec.encode("blackjack_stand_", version))
             ],
             [
-                InlineKeyboardButton("🔙 Նոր խաղ", callback_data="blackjack_menu")
+                InlineKeyboardButton("🔙 Նոր խաղ", callback_data=callback_codec.encode("blackjack_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def dice_menu() -> InlineKeyboardMarkup:
         """Меню костей"""
         keyboard = [
             [
-                InlineKeyboardButton("🎲 10 մետաղադրամ", callback_data="dice_10"),
-                InlineKeyboardButton("🎲 50 մետաղադրամ", callback_data="dice_50"),
-                InlineKeyboardButton("🎲 100 մետաղադրամ", callback_data="dice_100")
+                InlineKeyboardButton("🎲 10 մետաղադրամ", callback_data=callback_codec.encode("dice_", 10)),
+                InlineKeyboardButton("🎲 50 մետաղադրամ", callback_data=callback_codec.encode("dice_", 50)),
+                InlineKeyboardButton("🎲 100 մետաղադրամ", callback_data=callback_codec.encode("dice_", 100))
             ],
             [
-                InlineKeyboardButton("🎲 500 մետաղադրամ", callback_data="dice_500"),
-                InlineKeyboardButton("🎲 1000 մետաղադրամ", callback_data="dice_1000")
+                InlineKeyboardButton("🎲 500 մետաղադրամ", callback_data=callback_codec.encode("dice_", 500)),
+                InlineKeyboardButton("🎲 1000 մետաղադրամ", callback_data=callback_codec.encode("dice_", 1000))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="casino_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("casino_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def dice_predictions() -> InlineKeyboardMarkup:
         """Предполагаемые суммы для костей"""
         keyboard = [
             [
-                InlineKeyboardButton("2", callback_data="dice_pred_2"),
-                InlineKeyboardButton("3", callback_data="dice_pred_3"),
-                InlineKeyboardButton("4", callback_data="dice_pred_4")
+                InlineKeyboardButton("2", callback_data=callback_codec.encode("dice_pred_", 2)),
+                InlineKeyboardButton("3", callback_data=callback_codec.encode("dice_pred_", 3)),
+                InlineKeyboardButton("4", callback_data=callback_codec.encode("dice_pred_", 4))
             ],
             [
-                InlineKeyboardButton("5", callback_data="dice_pred_5"),
-                InlineKeyboardButton("6", callback_data="dice_pred_6"),
-                InlineKeyboardButton("7", callback_data="dice_pred_7")
+                InlineKeyboardButton("5", callback_data=callback_codec.encode("dice_pred_", 5)),
+                InlineKeyboardButton("6", callback_data=callback_codec.encode("dice_pred_", 6)),
+                InlineKeyboardButton("7", callback_data=callback_codec.encode("dice_pred_", 7))
             ],
             [
-                InlineKeyboardButton("8", callback_data="dice_pred_8"),
-                InlineKeyboardButton("9", callback_data="dice_pred_9"),
-                InlineKeyboardButton("10", callback_data="dice_pred_10")
+                InlineKeyboardButton("8", callback_data=callback_codec.encode("dice_pred_", 8)),
+                InlineKeyboardButton("9", callback_data=callback_codec.encode("dice_pred_", 9)),
+                InlineKeyboardButton("10", callback_data=callback_codec.encode("dice_pred_", 10))
             ],
             [
-                InlineKeyboardButton("11", callback_data="dice_pred_11"),
-                InlineKeyboardButton("12", callback_data="dice_pred_12")
+                InlineKeyboardButton("11", callback_data=callback_codec.encode("dice_pred_", 11)),
+                InlineKeyboardButton("12", callback_data=callback_codec.encode("dice_pred_", 12))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="dice_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("dice_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def crime_menu() -> InlineKeyboardMarkup:
         """Меню преступлений"""
         keyboard = [
             [
-                InlineKeyboardButton("🦹 Գրպանահատություն", callback_data="crime_pickpocket"),
-                InlineKeyboardButton("🔫 Կողոպուտ", callback_data="crime_robbery")
+                InlineKeyboardButton("🦹 Գրպանահատություն", callback_data=callback_codec.encode("crime_", "pickpocket")),
+                InlineKeyboardButton("🔫 Կողոպուտ", callback_data=callback_codec.encode("crime_", "robbery"))
             ],
             [
-                InlineKeyboardButton("🚢 Մաքսանենգություն", callback_data="crime_smuggling"),
-                InlineKeyboardButton("🏦 Բանկի կողոպուտ", callback_data="crime_bank")
+                InlineKeyboardButton("🚢 Մաքսանենգություն", callback_data=callback_codec.encode("crime_", "smuggling")),
+                InlineKeyboardButton("🏦 Բանկի կողոպուտ", callback_data=callback_codec.encode("crime_", "bank"))
             ],
             [
-                InlineKeyboardButton("🏘️ Տարածքներ", callback_data="territories_menu"),
-                InlineKeyboardButton("🏃‍♂️ Փախուստ", callback_data="escape")
+                InlineKeyboardButton("🏘️ Տարածքներ", callback_data=callback_codec.encode("territories_menu")),
+                InlineKeyboardButton("🏃‍♂️ Փախուստ", callback_data=callback_codec.encode("escape"))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="main_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("main_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def territories_menu() -> InlineKeyboardMarkup:
         """Меню территорий"""
         keyboard = [
             [
-                InlineKeyboardButton("🏘️ Գնել տարածք", callback_data="buy_territory"),
-                InlineKeyboardButton("💰 Հավաքել եկամուտ", callback_data="collect_income")
+                InlineKeyboardButton("🏘️ Գնել տարածք", callback_data=callback_codec.encode("buy_territory")),
+                InlineKeyboardButton("💰 Հավաքել եկամուտ", callback_data=callback_codec.encode("collect_income"))
             ],
             [
-                InlineKeyboardButton("📊 Իմ տարածքները", callback_data="my_territories")
+                InlineKeyboardButton("📊 Իմ տարածքները", callback_data=callback_codec.encode("my_territories"))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="crime_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("crime_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
@@ -241,14 +257,15 @@ class Keyboards:
             keyboard.append([
                 InlineKeyboardButton(
                     f"🏘️ {territory['name']} ({territory['cost']} մետաղադրամ)",
-                    callback_data=f"buy_territory_{territory['name']}"
+                    callback_data=callback_codec.encode("buy_territory_", territory["name"])
                 )
             ])
         
-        keyboard.append([InlineKeyboardButton("🔙 Հետ", callback_data="territories_menu")])
+        keyboard.append([InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("territories_menu"))])
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def gang_menu() -> InlineKeyboardMarkup:
         """Меню банды"""
         keyboard = [
@@ -261,65 +278,69 @@ class Keyboards:
                 InlineKeyboardButton("💰 Խմբի բանկ", callback_data="gang_bank")
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="main_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("main_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def shop_menu() -> InlineKeyboardMarkup:
         """Меню магазина"""
         keyboard = [
             [
-                InlineKeyboardButton("🔪 Դանակ (500 մետաղադրամ)", callback_data="buy_դանակ"),
-                InlineKeyboardButton("🔫 Ատրճանակ (2000 մետաղադրամ)", callback_data="buy_ատրճանակ")
+                InlineKeyboardButton("🔪 Դանակ (500 մետաղադրամ)", callback_data=callback_codec.encode("buy_", "դանակ")),
+                InlineKeyboardButton("🔫 Ատրճանակ (2000 մետաղադրամ)", callback_data=callback_codec.encode("buy_", "ատրճանակ"))
             ],
             [
-                InlineKeyboardButton("🔫 Հրացան (10000 մետաղադրամ)", callback_data="buy_հրացան"),
-                InlineKeyboardButton("🛡️ Զրահապատ վերնաշապիկ (1000 մետաղադրամ)", callback_data="buy_զրահապատ վերնաշապիկ")
+                InlineKeyboardButton("🔫 Հրացան (10000 մետաղադրամ)", callback_data=callback_codec.encode("buy_", "հրացան")),
+                InlineKeyboardButton("🛡️ Զրահապատ վերնաշապիկ (1000 մետաղադրամ)", callback_data=callback_codec.encode("buy_", "զրահապատ վերնաշապիկ"))
             ],
             [
-                InlineKeyboardButton("👮 Կապեր ոստիկանության հետ (5000 մետաղադրամ)", callback_data="buy_կապեր ոստիկանության հետ")
+                InlineKeyboardButton("👮 Կապեր ոստիկանության հետ (5000 մետաղադրամ)", callback_data=callback_codec.encode("buy_", "կապեր ոստիկանության հետ"))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="main_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("main_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def top_menu() -> InlineKeyboardMarkup:
         """Меню рейтингов"""
         keyboard = [
             [
-                InlineKeyboardButton("💰 Ըստ փողի", callback_data="top_money"),
-                InlineKeyboardButton("👑 Ըստ կոչման", callback_data="top_rank")
+                InlineKeyboardButton("💰 Ըստ փողի", callback_data=callback_codec.encode("top_", "money")),
+                InlineKeyboardButton("👑 Ըստ կոչման", callback_data=callback_codec.encode("top_", "rank"))
             ],
             [
-                InlineKeyboardButton("⭐ Ըստ հեղինակության", callback_data="top_reputation"),
-                InlineKeyboardButton("🏘️ Ըստ տարածքների", callback_data="top_territories")
+                InlineKeyboardButton("⭐ Ըստ հեղինակության", callback_data=callback_codec.encode("top_", "reputation")),
+                InlineKeyboardButton("🏘️ Ըստ տարածքների", callback_data=callback_codec.encode("top_", "territories"))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="main_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("main_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def profile_actions() -> InlineKeyboardMarkup:
         """Действия с профилем"""
         keyboard = [
             [
-                InlineKeyboardButton("📊 Վիճակագրություն", callback_data="profile_stats"),
-                InlineKeyboardButton("🏆 Ձեռքբերումներ", callback_data="profile_achievements")
+                InlineKeyboardButton("📊 Վիճակագրություն", callback_data=callback_codec.encode("profile_stats")),
+                InlineKeyboardButton("🏆 Ձեռքբերումներ", callback_data=callback_codec.encode("profile_achievements"))
             ],
             [
-                InlineKeyboardButton("🔙 Հետ", callback_data="main_menu")
+                InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode("main_menu"))
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def jail_menu() -> InlineKeyboardMarkup:
         """Меню тюрьмы"""
         keyboard = [
@@ -344,21 +365,22 @@ class Keyboards:
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def back_button(menu: str) -> InlineKeyboardMarkup:
         """Кнопка назад"""
         keyboard = [
-            [InlineKeyboardButton("🔙 Հետ", callback_data=menu)]
+            [InlineKeyboardButton("🔙 Հետ", callback_data=callback_codec.encode(menu) if menu in callback_codec else menu)]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
     def number_keyboard(max_num: int, callback_prefix: str) -> InlineKeyboardMarkup:
-        """Клавиатура с числами"""
+        """Клавиатура с числами (callback_prefix без "_" на конце)"""
         keyboard = []
         row = []
         
         for i in range(1, max_num + 1):
-            row.append(InlineKeyboardButton(str(i), callback_data=f"{callback_prefix}_{i}"))
+            row.append(InlineKeyboardButton(str(i), callback_data=callback_codec.encode(f"{callback_prefix}_", i)))
             
             if len(row) == 3:  # 3 кнопки в ряду
                 keyboard.append(row)
@@ -0,0 +1,163 @@
+"""
+Модуль рейтингов игроков
+Держит в памяти упорядоченные списки по каждому рейтингу и обновляет их
+по изменениям из UserCache, не обращаясь к базе при каждом /top
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from sortedcontainers import SortedList
+
+from storage import LEADERBOARD_SORTS, fields_projection
+
+logger = logging.getLogger(__name__)
+
+# Рейтинг -> поле документа с очками (производные поля, см. storage.derived_fields)
+BOARDS = {board: sort[0][0] for board, sort in LEADERBOARD_SORTS.items()}
+
+NAME_FIELDS = ("name", "username")
+LEADERBOARD_FIELDS = NAME_FIELDS + tuple(BOARDS.values())
+
+
+def display_name(doc: Dict) -> str:
+    return doc.get("name") or doc.get("username") or "Без имени"
+
+
+class Leaderboard:
+    """
+    Рейтинги в памяти: для каждого рейтинга SortedList пар (-очки, user_id)
+    Вставка, удаление, топ-N и место игрока - O(log n)
+    """
+
+    def __init__(self):
+        self.boards: Dict[str, SortedList] = {name: SortedList() for name in BOARDS}
+        self.scores: Dict[str, Dict[int, int]] = {name: {} for name in BOARDS}
+        self.names: Dict[int, str] = {}
+        self.ready = False
+        self._ready_event: Optional[asyncio.Event] = None
+        # Изменения, пришедшие во время refresh (user_id -> поля)
+        self._changed: Optional[Dict[int, Dict]] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _set_score(self, board: str, user_id, score: int):
+        scores = self.scores[board]
+        old = scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self.boards[board].remove((-old, user_id))
+        scores[user_id] = score
+        self.boards[board].add((-score, user_id))
+
+    def update(self, user_id, doc: Dict):
+        """Обновляет очки игрока по тем полям, которые есть в документе"""
+        if any(field in doc for field in NAME_FIELDS):
+            self.names[user_id] = display_name(doc)
+        for board, field in BOARDS.items():
+            if field in doc:
+                self._set_score(board, user_id, doc[field])
+
+    def remove(self, user_id):
+        """Убирает игрока из всех рейтингов"""
+        for board in BOARDS:
+            old = self.scores[board].pop(user_id, None)
+            if old is not None:
+                self.boards[board].remove((-old, user_id))
+        self.names.pop(user_id, None)
+
+    def on_mutation(self, user_id, changes: Dict, doc: Dict):
+        """Слушатель изменений из UserCache"""
+        self.update(user_id, doc)
+        if self._changed is not None:
+            self._changed.setdefault(user_id, {}).update(doc)
+
+    async def rebuild(self, db, batch_size: int = 1000):
+        """Перестраивает рейтинги по всем игрокам из базы"""
+        self.boards = {name: SortedList() for name in BOARDS}
+        self.scores = {name: {} for name in BOARDS}
+        self.names = {}
+        projection = fields_projection(LEADERBOARD_FIELDS)
+        count = 0
+        async for user in db.iter_users(projection=projection, batch_size=batch_size):
+            self.update(user["user_id"], user)
+            count += 1
+        self.ready = True
+        if self._ready_event is not None:
+            self._ready_event.set()
+        logger.info(f"Рейтинги построены: {count} игроков")
+        return count
+
+    async def wait_ready(self):
+        """Дожидается первого построения рейтингов (сразу, если они уже построены)"""
+        if self.ready:
+            return
+        if self._ready_event is None:
+            self._ready_event = asyncio.Event()
+        await self._ready_event.wait()
+
+    def top(self, board: str, limit: int = 10) -> List[Tuple[int, str, int]]:
+        """Возвращает первые limit игроков: (user_id, имя, очки)"""
+        return [
+            (user_id, self.names.get(user_id, "Без имени"), -neg_score)
+            for neg_score, user_id in self.boards[board].islice(0, limit)
+        ]
+
+    def position(self, board: str, user_id) -> Optional[Tuple[int, int]]:
+        """
+        Место игрока в рейтинге и его очки, None если игрока нет
+        Игроки с равными очками делят одно место
+        """
+        score = self.scores[board].get(user_id)
+        if score is None:
+            return None
+        return self.boards[board].bisect_left((-score,)) + 1, score
+
+    async def refresh(self, db, batch_size: int = 1000) -> int:
+        """
+        Перестраивает рейтинги, не опустошая текущие: до конца чтения /top
+        показывает прежние списки, а изменения, пришедшие за это время,
+        накладываются поверх прочитанного из базы
+        """
+        fresh = Leaderboard()
+        self._changed = {}
+        try:
+            count = await fresh.rebuild(db, batch_size)
+            for user_id, doc in self._changed.items():
+                fresh.update(user_id, doc)
+        finally:
+            self._changed = None
+        self.boards, self.scores, self.names = fresh.boards, fresh.scores, fresh.names
+        return count
+
+    def start_refreshing(self, db, interval: float):
+        """
+        Периодически перечитывает рейтинги из базы
+        Нужно в многопроцессном режиме: изменения игроков других процессов
+        сюда не приходят и видны только через базу
+        """
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop(db, interval))
+
+    async def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+
+    async def _refresh_loop(self, db, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # Свои изменения сначала в базу, иначе чтение вернет их старые значения
+                await db.flush()
+                await self.refresh(db)
+            except Exception as e:
+                logger.error(f"Ошибка обновления рейтингов: {e}")
+
+    def get_stats(self) -> Dict:
+        return {board: len(entries) for board, entries in self.boards.items()}
+
+
+leaderboard = Leaderboard()
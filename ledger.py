@@ -0,0 +1,159 @@
+"""
+Модуль журнала транзакций
+Записывает каждое изменение баланса, сворачивает старые записи в снимки
+и восстанавливает баланс игрока по снимку и хвосту журнала
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def fold_snapshot(user_id, snapshot: Optional[Dict], entries: Iterable[Dict]) -> Optional[Dict]:
+    """
+    Сворачивает записи журнала (по возрастанию seq) в снимок баланса
+    Начальный баланс берется из снимка, а без него - из первой записи
+    (balance - delta), поэтому история до появления журнала не теряется
+    """
+    result = dict(snapshot) if snapshot else None
+    for entry in entries:
+        if result is not None and entry["seq"] <= result["seq"]:
+            # Запись уже учтена в снимке (например, сжатие прервалось)
+            continue
+        if result is None:
+            result = {"user_id": user_id, "balance": entry["balance"] - entry["delta"], "seq": 0, "entries": 0}
+        result["balance"] += entry["delta"]
+        result["seq"] = entry["seq"]
+        result["entries"] += 1
+    return result
+
+
+class Ledger:
+    """
+    Журнал изменений баланса поверх хранилища игроков
+    Записи копятся в буфере и пишутся пачками; фоновое сжатие оставляет
+    в журнале только записи моложе retention секунд
+    """
+
+    def __init__(self, storage, batch_size: int = 500, flush_interval: float = 2.0,
+                 retention: float = 7 * 24 * 3600, compact_interval: float = 3600):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.compact_interval = compact_interval
+        self.buffer: List[Dict] = []
+        self.stats = {"recorded": 0, "written": 0, "write_errors": 0, "compacted": 0}
+        self._last_seq = 0
+        self._tasks: List[asyncio.Task] = []
+        self._flush_lock = asyncio.Lock()
+
+    def _next_seq(self) -> int:
+        """Монотонный номер записи на основе времени в наносекундах"""
+        self._last_seq = max(time.time_ns(), self._last_seq + 1)
+        return self._last_seq
+
+    def record(self, user_id, delta: int, balance: int, reason: Optional[str] = None):
+        """Добавляет запись об изменении баланса в буфер"""
+        seq = self._next_seq()
+        self.buffer.append({
+            "user_id": user_id,
+            "seq": seq,
+            "ts": seq / 1e9,
+            "delta": delta,
+            "balance": balance,
+            "reason": reason
+        })
+        self.stats["recorded"] += 1
+        if len(self.buffer) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+
+    def on_mutation(self, user_id, changes: Dict, doc: Dict):
+        """Слушатель изменений из UserCache: пишет в журнал изменения денег"""
+        delta = (changes.get("inc") or {}).get("money")
+        if delta:
+            self.record(user_id, delta, doc.get("money", 0), changes.get("reason"))
+
+    async def flush(self):
+        """Записывает буфер в хранилище одной пачкой"""
+        async with self._flush_lock:
+            if not self.buffer:
+                return
+            batch, self.buffer = self.buffer, []
+            try:
+                await self.storage.insert_ledger_entries(batch)
+                self.stats["written"] += len(batch)
+            except Exception as e:
+                self.stats["write_errors"] += 1
+                logger.error(f"Ошибка записи журнала транзакций: {e}")
+                self.buffer = batch + self.buffer
+
+    async def compact(self, cutoff_seq: Optional[int] = None) -> int:
+        """
+        Сворачивает записи старше cutoff_seq в снимки по игрокам
+        Снимок сохраняется до удаления записей, а записи с seq <= снимка
+        пропускаются при повторе, так что прерванное сжатие безопасно
+        """
+        await self.flush()
+        if cutoff_seq is None:
+            cutoff_seq = time.time_ns() - int(self.retention * 1e9)
+
+        folded = 0
+        for user_id in await self.storage.get_ledger_users(before_seq=cutoff_seq):
+            snapshot = await self.storage.get_ledger_snapshot(user_id)
+            after_seq = snapshot["seq"] if snapshot else None
+            entries = await self.storage.get_ledger_entries(user_id, after_seq=after_seq, before_seq=cutoff_seq)
+            new_snapshot = fold_snapshot(user_id, snapshot, entries)
+            if new_snapshot is None:
+                continue
+            await self.storage.save_ledger_snapshot(new_snapshot)
+            await self.storage.delete_ledger_entries(user_id, up_to_seq=new_snapshot["seq"])
+            folded += len(entries)
+        self.stats["compacted"] += folded
+        if folded:
+            logger.info(f"Журнал транзакций сжат: свернуто {folded} записей")
+        return folded
+
+    async def replay(self, user_id) -> Optional[int]:
+        """Восстанавливает баланс игрока по снимку и хвосту журнала"""
+        await self.flush()
+        snapshot = await self.storage.get_ledger_snapshot(user_id)
+        after_seq = snapshot["seq"] if snapshot else None
+        tail = await self.storage.get_ledger_entries(user_id, after_seq=after_seq)
+        result = fold_snapshot(user_id, snapshot, tail)
+        return result["balance"] if result else None
+
+    # Фоновые задачи
+
+    def start(self, compact: bool = True):
+        """
+        Запускает фоновую запись и сжатие
+        compact=False - без сжатия (в многопроцессном режиме журнал сжимает один процесс)
+        """
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._periodic(self.flush, self.flush_interval))]
+            if compact:
+                self._tasks.append(asyncio.create_task(self._periodic(self.compact, self.compact_interval)))
+
+    async def stop(self):
+        """Останавливает фоновые задачи и дописывает буфер"""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        await self.flush()
+
+    async def _periodic(self, job, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await job()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой задачи журнала транзакций: {e}")
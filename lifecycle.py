@@ -0,0 +1,149 @@
+"""
+Модуль жизненного цикла бота
+Учет выполняющихся обработчиков и согласованная остановка в режиме polling
+и в процессах-обработчиках многопроцессного режима: прием обновлений
+прекращается, начатые обработчики дорабатывают до крайнего срока (оставшиеся
+отменяются), после чего приложение останавливается штатно (post_stop
+сохраняет снимок состояния, post_shutdown - изменения игроков)
+"""
+
+import asyncio
+import functools
+import logging
+import signal
+from typing import Dict, Optional, Set
+
+from telegram import Update
+from telegram.ext import Application
+
+from workers import serve_worker
+
+logger = logging.getLogger(__name__)
+
+
+class InFlightHandlers:
+    """
+    Выполняющиеся обработчики PTB
+    Каждый обработчик идет отдельной задачей, чтобы при остановке его можно
+    было отменить, не ломая учет обновлений в самом Application
+    """
+
+    def __init__(self):
+        self.tasks: Set[asyncio.Task] = set()
+        self.closed = False
+        self.stats = {"started": 0, "aborted": 0, "refused": 0}
+        self._aborted: Set[asyncio.Task] = set()
+
+    def tracked(self, handler):
+        """Оборачивает обработчик PTB; после остановки новые обновления не обрабатываются"""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if self.closed:
+                self.stats["refused"] += 1
+                return None
+            task = asyncio.ensure_future(handler(update, context))
+            self.tasks.add(task)
+            self.stats["started"] += 1
+            try:
+                return await task
+            except asyncio.CancelledError:
+                if task not in self._aborted:
+                    raise
+                # Обработчик отменен по крайнему сроку остановки
+                return None
+            finally:
+                self.tasks.discard(task)
+                self._aborted.discard(task)
+        return wrapper
+
+    async def drain(self, timeout: float, queue: Optional[asyncio.Queue] = None) -> int:
+        """
+        Ждет завершения обработчиков (и разбора очереди queue) не дольше timeout
+        секунд, затем отменяет оставшиеся и закрывает прием; возвращает число отмененных
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.tasks or (queue is not None and not queue.empty()):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            if self.tasks:
+                await asyncio.wait(set(self.tasks), timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(min(0.05, remaining))
+
+        self.closed = True
+        leftover = list(self.tasks)
+        for task in leftover:
+            self._aborted.add(task)
+            task.cancel()
+        if leftover:
+            await asyncio.gather(*leftover, return_exceptions=True)
+            self.stats["aborted"] += len(leftover)
+            logger.warning(f"Остановка: {len(leftover)} обработчиков не уложились в {timeout} с и отменены")
+        return len(leftover)
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, "active": len(self.tasks)}
+
+
+in_flight = InFlightHandlers()
+
+
+async def run_polling(application: Application, handlers: InFlightHandlers = in_flight,
+                      drain_timeout: float = 20):
+    """
+    Запускает приложение в режиме polling до SIGINT/SIGTERM
+    В отличие от Application.run_polling, ожидание обработчиков при остановке
+    ограничено drain_timeout
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    await application.start()
+    try:
+        await stop_event.wait()
+        logger.info("Остановка: прием обновлений прекращен, дорабатываем начатые...")
+    finally:
+        await application.updater.stop()
+        await handlers.drain(drain_timeout, application.update_queue)
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def run_worker(application: Application, sock, handlers: InFlightHandlers = in_flight,
+                     drain_timeout: float = 20):
+    """
+    Запускает приложение в процессе-обработчике (см. workers.py): обновления
+    приходят от супервизора по сокету канала sock, остановку тоже объявляет он
+    """
+    # Ctrl+C и SIGTERM группе процессов получает и супервизор: он пришлет STOP
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, signal.SIG_IGN)
+
+    async def process_update(data):
+        await application.process_update(Update.de_json(data, application.bot))
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        await serve_worker(sock, process_update, drain=lambda: handlers.drain(drain_timeout))
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,136 @@
+"""
+Модуль настройки логирования
+Обработчики логгеров только кладут записи в очередь; в файл и на консоль их
+пишет фоновый поток (QueueListener), поэтому цикл событий не ждет диска.
+Файл ротируется по размеру или по времени, уровни задаются по логгерам,
+частые записи транспорта (httpx: каждый getUpdates и editMessageText)
+прореживаются, а токен бота вырезается из всех сообщений и трассировок
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import re
+from typing import Dict, Optional
+
+import config
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Токен в URL Bot API: https://api.telegram.org/bot<id>:<secret>/method
+TOKEN_PATTERN = re.compile(r"\d{5,}:[A-Za-z0-9_-]{30,}")
+REDACTED = "<token>"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def redact(text: str, secrets=()) -> str:
+    for secret in secrets:
+        if secret:
+            text = text.replace(secret, REDACTED)
+    return TOKEN_PATTERN.sub(REDACTED, text)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает каждую every-ю запись ниже WARNING от логгеров rates (имя -> every)
+    Записи считаются по тексту сообщения: getUpdates и editMessageText,
+    ответы 200 и 429 прореживаются независимо
+    """
+
+    def __init__(self, rates: Dict[str, int], max_keys: int = 1000):
+        super().__init__()
+        self.rates = rates
+        self.max_keys = max_keys
+        self.counts: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        every = self.rates.get(record.name.split(".", 1)[0], self.rates.get(record.name))
+        if not every or every <= 1:
+            return True
+        key = f"{record.name}:{record.getMessage()}"
+        if key not in self.counts and len(self.counts) >= self.max_keys:
+            self.counts.clear()
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if count % every:
+            return False
+        if count:
+            record.msg = f"{record.getMessage()} [1 из {every}]"
+            record.args = None
+        return True
+
+
+class RedactingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который вырезает токен из готового текста записи (вместе с трассировкой)"""
+
+    def __init__(self, log_queue: queue.Queue, secrets=()):
+        super().__init__(log_queue)
+        self.secrets = [secret for secret in secrets if secret]
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.msg = record.message = redact(record.msg, self.secrets)
+        return record
+
+
+def worker_log_file(path: str, index: int) -> str:
+    """Файл лога процесса-обработчика: у каждого процесса своя ротация"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}{ext}"
+
+
+def _file_handler(path: str) -> logging.Handler:
+    if config.LOG_ROTATION == "time":
+        return logging.handlers.TimedRotatingFileHandler(
+            path, when=config.LOG_ROTATE_WHEN, backupCount=config.LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    return logging.handlers.RotatingFileHandler(
+        path, maxBytes=config.LOG_MAX_BYTES, backupCount=config.LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+
+
+def setup_logging(log_file: Optional[str] = None, level: Optional[str] = None):
+    """
+    Настраивает корневой логгер: очередь -> фоновый поток -> файл и консоль
+    Повторный вызов заменяет прежнюю настройку; поток останавливается при выходе
+    """
+    global _listener
+    stop_logging()
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [_file_handler(log_file or config.LOG_FILE), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue()
+    queue_handler = RedactingQueueHandler(log_queue, secrets=[config.BOT_TOKEN, config.WEBHOOK_SECRET])
+    queue_handler.addFilter(SamplingFilter(config.LOG_SAMPLING))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level or config.LOG_LEVEL)
+    for name, logger_level in config.LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает фоновый поток записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,370 @@
+"""
+Модуль метрик задержек
+Хранит последние замеры по каждой стадии обработки и считает по ним
+перцентили (p50/p99) для админ-команды /latency, замеры холодного старта
+против бюджета и реестр метрик (счетчики, гистограммы по маршрутам, командам,
+вызовам базы и Bot API), который отдается локальным HTTP-эндпоинтом в
+текстовом формате Prometheus
+"""
+
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyStats:
+    """
+    Скользящее окно последних window замеров на стадию
+    Перцентили считаются сортировкой окна только при запросе отчета
+    """
+
+    def __init__(self, window: int = 2048):
+        self.window = window
+        self.samples: Dict[str, Deque[float]] = {}
+        self.counts: Dict[str, int] = {}
+
+    def observe(self, stage: str, seconds: float):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples[stage] = deque(maxlen=self.window)
+            self.counts[stage] = 0
+        samples.append(seconds)
+        self.counts[stage] += 1
+
+    @contextmanager
+    def timer(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def percentile(self, stage: str, q: float) -> float:
+        """Перцентиль q (0..1) по окну стадии, в секундах; 0 при отсутствии замеров"""
+        samples = sorted(self.samples.get(stage, ()))
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def summary(self) -> Dict[str, Dict]:
+        """Стадия -> число замеров, p50 и p99 в миллисекундах"""
+        return {
+            stage: {
+                "count": self.counts[stage],
+                "p50": self.percentile(stage, 0.5) * 1000,
+                "p99": self.percentile(stage, 0.99) * 1000
+            }
+            for stage in self.samples
+        }
+
+
+latency = LatencyStats()
+
+
+class StartupBudget:
+    """
+    Холодный старт: секунды от started до каждой стадии (import, build, ready)
+    и время обработки первого обновления (first_update, холодные кэши)
+    report пишет замеры в лог; стадия, превысившая бюджет, - предупреждением
+    """
+
+    def __init__(self, budget: Dict[str, float], started: Optional[float] = None):
+        self.budget = budget
+        self.started = started if started is not None else time.perf_counter()
+        self.marks: Dict[str, float] = {}
+        self._reported = set()
+
+    def mark(self, stage: str, elapsed: Optional[float] = None) -> float:
+        """Отмечает стадию (повторные отметки не меняют первую); elapsed по умолчанию - с начала старта"""
+        if stage not in self.marks:
+            self.marks[stage] = elapsed if elapsed is not None else time.perf_counter() - self.started
+        return self.marks[stage]
+
+    def over_budget(self) -> Dict[str, float]:
+        """Стадии, превысившие бюджет: стадия -> замер в секундах"""
+        return {
+            stage: elapsed
+            for stage, elapsed in self.marks.items()
+            if stage in self.budget and elapsed > self.budget[stage]
+        }
+
+    def report(self):
+        """Пишет в лог еще не выведенные замеры"""
+        over = self.over_budget()
+        for stage, elapsed in self.marks.items():
+            if stage in self._reported:
+                continue
+            self._reported.add(stage)
+            if stage in over:
+                logger.warning(f"Старт: {stage} {elapsed * 1000:.0f} мс - превышен бюджет {self.budget[stage] * 1000:.0f} мс")
+            else:
+                logger.info(f"Старт: {stage} {elapsed * 1000:.0f} мс")
+
+    def tracked(self, handler):
+        """Оборачивает обработчик PTB: отмечает first_update после первого завершенного вызова"""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if "first_update" in self.marks:
+                return await handler(update, context)
+            started = time.perf_counter()
+            try:
+                return await handler(update, context)
+            finally:
+                self.mark("first_update", time.perf_counter() - started)
+                self.report()
+        return wrapper
+
+    def summary(self) -> Dict[str, Dict]:
+        """Стадия -> замер и бюджет в миллисекундах (бюджет None, если не задан)"""
+        return {
+            stage: {
+                "elapsed": elapsed * 1000,
+                "budget": self.budget[stage] * 1000 if stage in self.budget else None
+            }
+            for stage, elapsed in self.marks.items()
+        }
+
+
+# Реестр метрик
+
+# Границы корзин гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Счетчик с метками: значения меток -> сумма"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def lines(self) -> Iterator[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+    """
+    Гистограмма с метками: для каждого набора меток - счетчики корзин, сумма и число
+    Наблюдение - бинарный поиск корзины; накопленные значения считаются при выводе
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Метки -> [по корзинам..., +Inf, сумма]
+        self.series: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels) -> int:
+        series = self.series.get(labels)
+        return int(sum(series[:-1])) if series else 0
+
+    def total(self, *labels) -> float:
+        series = self.series.get(labels)
+        return series[-1] if series else 0.0
+
+    def quantile(self, q: float, *labels) -> float:
+        """Оценка квантиля сверху: граница корзины, в которую он попал (inf за последней)"""
+        series = self.series.get(labels)
+        if not series:
+            return 0.0
+        rank = q * sum(series[:-1])
+        seen = 0
+        for index, bucket_count in enumerate(series[:-1]):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def summary(self, limit: Optional[int] = None) -> Dict[Tuple, Dict]:
+        """Самые частые наборы меток: число, среднее и оценка p99 (мс)"""
+        rows = sorted(self.series, key=lambda labels: -self.count(*labels))[:limit]
+        return {
+            labels: {
+                "count": self.count(*labels),
+                "avg": self.total(*labels) / self.count(*labels) * 1000,
+                "p99": self.quantile(0.99, *labels) * 1000
+            }
+            for labels in rows
+        }
+
+    def lines(self) -> Iterator[str]:
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(series[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Collected:
+    """
+    Метрика, значения которой читаются при выводе: collect() -> число или
+    словарь значения меток -> число (размер кэша, глубина очередей, ...)
+    """
+
+    def __init__(self, name: str, documentation: str, collect: Callable, labelnames: Tuple[str, ...] = (),
+                 kind: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        self.labelnames = labelnames
+        self.kind = kind
+
+    def lines(self) -> Iterator[str]:
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса; render() - текстовый формат Prometheus 0.0.4"""
+
+    def __init__(self, prefix: str = "casino_"):
+        self.prefix = prefix
+        self.metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self.prefix + name, documentation, labelnames, buckets))
+
+    def collected(self, name: str, documentation: str, collect: Callable, labelnames: Tuple[str, ...] = (),
+                  kind: str = "gauge") -> Collected:
+        """Регистрирует (или заменяет) метрику, читаемую при выводе"""
+        return self._register(Collected(self.prefix + name, documentation, collect, labelnames, kind))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                body = list(metric.lines())
+            except Exception as e:
+                logger.error(f"Не удалось собрать метрику {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(body)
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+callback_seconds = registry.histogram("callback_seconds", "Обработка callback по маршрутам", ("route",))
+command_seconds = registry.histogram("command_seconds", "Обработка команд", ("command",))
+db_seconds = registry.histogram("db_seconds", "Вызовы хранилища игроков", ("backend", "method"))
+db_errors = registry.counter("db_errors_total", "Ошибки вызовов хранилища", ("backend", "method"))
+api_seconds = registry.histogram("api_seconds", "Запросы к Bot API (без ожидания в очереди)", ("method",))
+api_requests = registry.counter("api_requests_total", "Запросы к Bot API по исходу", ("method", "outcome"))
+
+
+def timed_command(name: str, handler):
+    """Оборачивает обработчик команды PTB замером command_seconds"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        with command_seconds.time(name):
+            return await handler(update, context)
+    return wrapper
+
+
+class MetricsServer:
+    """
+    HTTP-эндпоинт метрик: GET /metrics - registry.render(), остальное - 404
+    Слушает локальный адрес: метрики не защищены и наружу не публикуются
+    """
+
+    def __init__(self, metrics: MetricsRegistry = registry, read_timeout: float = 10):
+        self.registry = metrics
+        self.read_timeout = read_timeout
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Метрики: http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
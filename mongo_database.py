@@ -1,60 +1,290 @@
+import logging
+from datetime import datetime, timezone
+
 import motor.motor_asyncio
-from datetime import datetime
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import PyMongoError
+
+from storage import (UserStorage, LEADERBOARD_SORTS, RANK_NAMES, new_user_document, fields_projection,
+                     derived_sets, with_derived)
+
+logger = logging.getLogger(__name__)
+
+# Пересчет производных полей на стороне сервера (см. storage.derived_fields)
+DERIVED_FIELDS_STAGE = {"$set": {
+    "reputation_total": {"$sum": {"$map": {
+        "input": {"$objectToArray": {"$ifNull": ["$reputation", {}]}},
+        "in": "$$this.v"
+    }}},
+    "territory_count": {"$size": {"$ifNull": ["$territories", []]}},
+    "rank_index": {"$indexOfArray": [RANK_NAMES, "$rank"]}
+}}
+
+# Индексы рейтингов до перехода на производные поля
+OBSOLETE_INDEXES = ("top_rank", "top_reputation")
 
-class MongoDB:
+class MongoDB(UserStorage):
     def __init__(self, uri, db_name="telegram_game"):
         self.client = motor.motor_asyncio.AsyncIOMotorClient(uri)
         self.db = self.client[db_name]
         self.users = self.db["users"]
+        self.ledger = self.db["ledger"]
+        self.ledger_snapshots = self.db["ledger_snapshots"]
+        self.broadcasts = self.db["broadcasts"]
+        self.sessions = self.db["sessions"]
 
-    async def get_user(self, user_id):
-        return await self.users.find_one({"user_id": user_id})
+    async def get_user(self, user_id, fields=None):
+        return await self.users.find_one({"user_id": user_id}, fields_projection(fields))
 
     async def create_user(self, user_id, username, name):
-        user_data = {
-            "user_id": user_id,
-            "username": username,
-            "name": name,
-            "money": 1000,
-            "rank": "Շեստյորկա",
-            "reputation": {"копы": 0, "мафия": 0, "граждане": 0},
-            "territories": [],
-            "inventory": [],
-            "jail_time": None,
-            "jail_start": None,
-            "daily_bonus_time": None,
-            "last_crime_time": None,
-            "last_casino_time": None,
-            "last_territory_income": None,
-            "gang": None,
-            "statistics": {
-                "games_played": 0,
-                "games_won": 0,
-                "crimes_committed": 0,
-                "crimes_successful": 0,
-                "money_earned": 0,
-                "money_lost": 0
-            },
-            "achievements": [],
-            "created_at": datetime.now().isoformat(),
-            "banned": False
-        }
+        user_data = new_user_document(user_id, username, name)
         await self.users.insert_one(user_data)
         return user_data
 
-    async def update_user(self, user_id, updates: dict):
-        await self.users.update_one({"user_id": user_id}, {"$set": updates})
+    async def update_user(self, user_id, updates: dict, expected_version: int = None) -> bool:
+        query = {"user_id": user_id, **_version_query(expected_version)}
+        result = await self.users.update_one(
+            query, {"$set": {**updates, **derived_sets(updates)}, "$inc": {"version": 1}}
+        )
+        return result.matched_count == 1
+
+    async def bulk_update_users(self, updates_by_user: dict):
+        """Записывает изменения нескольких пользователей одним запросом"""
+        if not updates_by_user:
+            return
+        requests = [
+            UpdateOne({"user_id": user_id}, {"$set": {**updates, **derived_sets(updates)}})
+            for user_id, updates in updates_by_user.items()
+        ]
+        await self.users.bulk_write(requests, ordered=False)
+
+    async def apply_delta(self, user_id, inc: dict = None, set_fields: dict = None,
+                          push: dict = None, pull: dict = None, min_money: int = None,
+                          expected_version: int = None):
+        """
+        Атомарно применяет изменения к пользователю на стороне сервера
+        inc/set_fields/push/pull превращаются в $inc/$set/$push/$pull
+        min_money - условие "money >= min_money", проверяемое в том же запросе
+        expected_version - условие "версия документа не изменилась"
+        Производные поля (reputation_total и т.д.) и version меняются тем же запросом
+        Возвращает обновленный документ или None, если условие не выполнено
+        """
+        inc, set_fields, guard = with_derived(inc, set_fields, push, pull)
+        query = {"user_id": user_id, **guard, **_version_query(expected_version)}
+        if min_money is not None:
+            query["money"] = {"$gte": min_money}
+
+        update = {}
+        if inc:
+            update["$inc"] = inc
+        if set_fields:
+            update["$set"] = set_fields
+        if push:
+            update["$push"] = push
+        if pull:
+            update["$pull"] = pull
+        if not update:
+            return await self.users.find_one(query)
+
+        return await self.users.find_one_and_update(
+            query, update, return_document=ReturnDocument.AFTER
+        )
 
     async def get_top_users(self, by="money", limit=10):
-        sort_key = by if by in ["money", "rank"] else None
-        if by == "reputation":
-            cursor = self.users.find().sort([("reputation.копы", -1), ("reputation.мафия", -1), ("reputation.граждане", -1)]).limit(limit)
-        elif sort_key:
-            cursor = self.users.find().sort(sort_key, -1).limit(limit)
+        sort = LEADERBOARD_SORTS.get(by)
+        if sort:
+            cursor = self.users.find().sort(sort).limit(limit)
         else:
             cursor = self.users.find().limit(limit)
         return [user async for user in cursor]
 
-    async def get_all_users(self):
-        cursor = self.users.find()
-        return [user async for user in cursor] 
\ No newline at end of file
+    async def ensure_indexes(self):
+        """
+        Создает недостающие индексы коллекции users
+        Возвращает отчет: имя индекса -> "exists", "created" или текст ошибки
+        """
+        wanted = {"user_id_unique": ([("user_id", 1)], {"unique": True})}
+        for keys in LEADERBOARD_SORTS.values():
+            wanted[f"top_{keys[0][0]}"] = (keys, {})
+
+        report = await self._ensure_collection_indexes(self.users, wanted)
+        report.update(await self._ensure_collection_indexes(self.ledger, {
+            "user_seq": ([("user_id", 1), ("seq", 1)], {"unique": True}),
+            "seq": ([("seq", 1)], {})
+        }))
+        report.update(await self._ensure_collection_indexes(self.ledger_snapshots, {
+            "user_id_unique": ([("user_id", 1)], {"unique": True})
+        }))
+        report.update(await self._ensure_collection_indexes(self.broadcasts, {
+            "job_id_unique": ([("job_id", 1)], {"unique": True})
+        }))
+        # Брошенные сессии удаляет сам MongoDB по полю expires (дата)
+        report.update(await self._ensure_collection_indexes(self.sessions, {
+            "key_unique": ([("key", 1)], {"unique": True}),
+            "expires_ttl": ([("expires", 1)], {"expireAfterSeconds": 0})
+        }))
+        logger.info(f"Индексы: {report}")
+        return report
+
+    async def _ensure_collection_indexes(self, collection, wanted: dict):
+        existing = await collection.index_information()
+        report = {}
+        for name, (keys, options) in wanted.items():
+            full_name = f"{collection.name}.{name}"
+            if name in existing:
+                report[full_name] = "exists"
+                continue
+            try:
+                await collection.create_index(keys, name=name, **options)
+                report[full_name] = "created"
+            except PyMongoError as e:
+                report[full_name] = f"error: {e}"
+                logger.error(f"Не удалось построить индекс {full_name}: {e}")
+        return report
+
+    async def check_query_plans(self):
+        """
+        Проверяет планы горячих запросов через explain()
+        Запросы, которые сканируют всю коллекцию, попадают в лог как предупреждения
+        """
+        queries = {"get_user": self.users.find({"user_id": 0}).limit(1)}
+        for by, keys in LEADERBOARD_SORTS.items():
+            queries[f"top_{by}"] = self.users.find().sort(keys).limit(10)
+
+        plans = {}
+        for name, cursor in queries.items():
+            try:
+                explanation = await cursor.explain()
+            except PyMongoError as e:
+                logger.error(f"Не удалось получить план запроса {name}: {e}")
+                continue
+            winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+            # Начиная с MongoDB 5 план может быть обернут в queryPlan
+            stages = _plan_stages(winning_plan.get("queryPlan", winning_plan))
+            plans[name] = stages
+            if "COLLSCAN" in stages:
+                logger.warning(f"Запрос {name} выполняется полным сканированием коллекции: {stages}")
+        return plans
+
+    async def iter_users(self, query: dict = None, projection: dict = None, batch_size: int = 500,
+                         after_user_id=None):
+        """
+        Потоково перебирает пользователей по возрастанию user_id, не загружая всех в память
+        projection ограничивает возвращаемые поля, batch_size - размер пачки курсора,
+        after_user_id - продолжить после этого игрока (по индексу user_id_unique)
+        """
+        query = dict(query or {})
+        if after_user_id is not None:
+            query["user_id"] = {"$gt": after_user_id}
+        cursor = self.users.find(query, projection, batch_size=batch_size).sort("user_id", 1)
+        async for user in cursor:
+            yield user
+
+    async def backfill_derived_fields(self):
+        """
+        Разовый пересчет производных полей у всех игроков одним
+        update_many с конвейером; заодно удаляет устаревшие индексы рейтингов
+        """
+        result = await self.users.update_many({}, [DERIVED_FIELDS_STAGE])
+        existing = await self.users.index_information()
+        for name in OBSOLETE_INDEXES:
+            if name in existing:
+                await self.users.drop_index(name)
+                logger.info(f"Удален устаревший индекс users.{name}")
+        return result.modified_count
+
+    async def get_users_summary(self):
+        """Считает общее число игроков, забаненных и сумму денег одной агрегацией"""
+        pipeline = [
+            {"$group": {
+                "_id": None,
+                "total": {"$sum": 1},
+                "banned": {"$sum": {"$cond": [{"$eq": ["$banned", True]}, 1, 0]}},
+                "total_money": {"$sum": "$money"}
+            }}
+        ]
+        async for row in self.users.aggregate(pipeline):
+            return {"total": row["total"], "banned": row["banned"], "total_money": row["total_money"]}
+        return {"total": 0, "banned": 0, "total_money": 0}
+
+    async def insert_ledger_entries(self, entries):
+        if entries:
+            # insert_many дописывает _id в документы, поэтому передаем копии
+            await self.ledger.insert_many([dict(entry) for entry in entries], ordered=False)
+
+    async def get_ledger_users(self, before_seq):
+        return await self.ledger.distinct("user_id", {"seq": {"$lt": before_seq}})
+
+    async def get_ledger_entries(self, user_id, after_seq=None, before_seq=None):
+        seq = {}
+        if after_seq is not None:
+            seq["$gt"] = after_seq
+        if before_seq is not None:
+            seq["$lt"] = before_seq
+        query = {"user_id": user_id}
+        if seq:
+            query["seq"] = seq
+        cursor = self.ledger.find(query, {"_id": 0}).sort("seq", 1)
+        return [entry async for entry in cursor]
+
+    async def delete_ledger_entries(self, user_id, up_to_seq):
+        await self.ledger.delete_many({"user_id": user_id, "seq": {"$lte": up_to_seq}})
+
+    async def get_ledger_snapshot(self, user_id):
+        return await self.ledger_snapshots.find_one({"user_id": user_id}, {"_id": 0})
+
+    async def save_ledger_snapshot(self, snapshot):
+        await self.ledger_snapshots.replace_one({"user_id": snapshot["user_id"]}, snapshot, upsert=True)
+
+    async def get_broadcast_jobs(self, status=None):
+        cursor = self.broadcasts.find({} if status is None else {"status": status}, {"_id": 0})
+        return await cursor.to_list(length=None)
+
+    async def save_broadcast_job(self, job):
+        await self.broadcasts.replace_one({"job_id": job["job_id"]}, dict(job), upsert=True)
+
+    async def get_session(self, key):
+        return await self.sessions.find_one({"key": key}, {"_id": 0, "expires": 0})
+
+    async def save_session(self, session, expected_version=None):
+        doc = {**session, "expires": datetime.fromtimestamp(session["expires_at"], timezone.utc)}
+        if expected_version is None:
+            await self.sessions.replace_one({"key": session["key"]}, doc, upsert=True)
+            return True
+        result = await self.sessions.replace_one({"key": session["key"], "version": expected_version}, doc)
+        return result.matched_count == 1
+
+    async def delete_session(self, key, expected_version=None):
+        query = {"key": key} if expected_version is None else {"key": key, "version": expected_version}
+        result = await self.sessions.delete_one(query)
+        return result.deleted_count == 1
+
+    async def purge_sessions(self, now):
+        # Обычно сессии успевает удалить TTL-индекс; здесь - то, что он еще не обработал
+        result = await self.sessions.delete_many({"expires_at": {"$lte": now}})
+        return result.deleted_count
+
+
+def _plan_stages(plan: dict) -> list:
+    """Собирает названия стадий плана запроса сверху вниз"""
+    stages = []
+    while plan:
+        stages.append(plan.get("stage"))
+        if "inputStage" in plan:
+            plan = plan["inputStage"]
+        elif plan.get("inputStages"):
+            for child in plan["inputStages"]:
+                stages.extend(_plan_stages(child))
+            break
+        else:
+            break
+    return stages
+
+
+def _version_query(expected_version):
+    """Условие на версию документа; у старых документов поля version нет (версия 0)"""
+    if expected_version is None:
+        return {}
+    if expected_version == 0:
+        return {"version": {"$in": [0, None]}}
+    return {"version": expected_version}
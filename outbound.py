@@ -0,0 +1,341 @@
+"""
+Модуль исходящих запросов к Telegram
+Все запросы бота проходят через планировщик (ApplicationBuilder.rate_limiter):
+общий лимит на бота, лимиты на каждый чат и очереди приоритетов, так что
+рассылка не задерживает ответы на нажатия, а 429 не останавливает обработчики
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import api_requests, api_seconds
+
+logger = logging.getLogger(__name__)
+
+# Очереди в порядке приоритета; приоритет задается rate_limit_args={"priority": ...}
+PRIORITIES = ("interactive", "broadcast")
+
+# Правки сообщения: новая правка, пока старая ждет в очереди, заменяет ее
+EDIT_ENDPOINTS = frozenset(("editMessageText", "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia"))
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до свободного токена (0 - можно отправлять)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+def timed_request(callback, endpoint: str):
+    """
+    Оборачивает запрос к Bot API замером api_seconds и счетчиком исходов
+    (ok, retry_after, error); время ожидания в очередях сюда не входит
+    """
+    async def request(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await callback(*args, **kwargs)
+            outcome = "ok"
+            return result
+        except RetryAfter:
+            outcome = "retry_after"
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, endpoint)
+            api_requests.inc(endpoint, outcome)
+    return request
+
+
+class Outgoing:
+    """
+    Запрос в очереди; futures - все вызывающие, чьи правки он заменил
+    chat_id - чат, чье ведро расходует запрос (None - только общее ведро)
+    """
+    __slots__ = ("args", "kwargs", "callback", "chat_id", "edit_key", "lane", "futures", "attempts", "queued_at")
+
+    def __init__(self, callback, args, kwargs, chat_id, edit_key, lane: int, future: asyncio.Future, now: float):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.edit_key = edit_key
+        self.lane = lane
+        self.futures: List[asyncio.Future] = [future]
+        self.attempts = 0
+        self.queued_at = now
+
+
+def _seconds(retry_after) -> float:
+    # В новых версиях PTB retry_after - timedelta
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """
+    Планировщик исходящих запросов
+    Запросы с chat_id ставятся в очередь своего приоритета и уходят, когда
+    есть токены в общем ведре и в ведре чата; правки экранов в личных чатах
+    расходуют только общее ведро, остальные запросы (answerCallbackQuery,
+    getMe, setWebhook...) отправляются сразу. После 429 отправка приостанавливается
+    на retry_after, а запрос повторяется первым в своей очереди
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate: float = 20 / 60, group_burst: float = 5, max_retries: int = 3,
+                 scan_limit: int = 64, drain_timeout: float = 10):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.scan_limit = scan_limit
+        self.drain_timeout = drain_timeout
+        self.lanes: List[Deque[Outgoing]] = [deque() for _ in PRIORITIES]
+        self.edits: Dict[tuple, Outgoing] = {}
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.global_bucket: Optional[TokenBucket] = None
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.stats = {
+            "sent": 0,
+            "immediate": 0,
+            "coalesced": 0,
+            "retry_after": 0,
+            "failed": 0,
+            "max_wait": 0.0
+        }
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._sending: set = set()
+
+    # Интерфейс BaseRateLimiter
+
+    async def initialize(self) -> None:
+        # ExtBot вызывает initialize при каждой своей инициализации (бот приложения и Updater)
+        if self._dispatcher is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self.global_bucket = TokenBucket(self.global_rate, self.global_rate, loop.time())
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        """Дожидается отправки очереди (не дольше drain_timeout) и останавливает планировщик"""
+        if self._dispatcher is None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_timeout
+        while (self.pending() or self._sending) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, return_exceptions=True)
+        self._dispatcher = None
+        dropped = 0
+        for lane in self.lanes:
+            while lane:
+                for future in lane.popleft().futures:
+                    future.cancel()
+                dropped += 1
+        self.edits.clear()
+        if dropped:
+            logger.warning(f"Исходящая очередь не разобрана при остановке: отброшено {dropped}")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        callback = timed_request(callback, endpoint)
+        chat_id = data.get("chat_id")
+        if self._dispatcher is None or (chat_id is None and "inline_message_id" not in data):
+            return await self._send_now(callback, args, kwargs)
+
+        priority = rate_limit_args.get("priority") if isinstance(rate_limit_args, dict) else rate_limit_args
+        lane = PRIORITIES.index(priority) if priority in PRIORITIES else 0
+        edit_key = None
+        bucket_chat = chat_id
+        if endpoint in EDIT_ENDPOINTS:
+            edit_key = (endpoint, chat_id, data.get("message_id"), data.get("inline_message_id"))
+            if isinstance(chat_id, int) and chat_id > 0:
+                # Правка экрана в личном чате отвечает на нажатие, а не шлет новое сообщение;
+                # обработчик ждет ее под блокировкой игрока, и лимит чата тормозил бы каждое нажатие
+                bucket_chat = None
+
+        future = asyncio.get_running_loop().create_future()
+        queued = self.edits.get(edit_key) if edit_key is not None else None
+        if queued is not None:
+            # Прежняя правка еще не отправлена: отправим только последнюю
+            queued.callback, queued.args, queued.kwargs = callback, args, kwargs
+            queued.futures.append(future)
+            self.stats["coalesced"] += 1
+        else:
+            entry = Outgoing(callback, args, kwargs, bucket_chat, edit_key, lane, future, asyncio.get_running_loop().time())
+            self.lanes[lane].append(entry)
+            if edit_key is not None:
+                self.edits[edit_key] = entry
+            self._wakeup.set()
+        return await future
+
+    # Отправка
+
+    async def _send_now(self, callback, args, kwargs):
+        """Запрос вне очередей: ждет только паузы после 429"""
+        self.stats["immediate"] += 1
+        for attempt in range(self.max_retries + 1):
+            delay = self.paused_until - asyncio.get_running_loop().time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._pause(e)
+                if attempt == self.max_retries:
+                    raise
+
+    def _pause(self, error: RetryAfter):
+        self.stats["retry_after"] += 1
+        until = asyncio.get_running_loop().time() + _seconds(error.retry_after)
+        if until > self.paused_until:
+            self.paused_until = until
+            logger.warning(f"Telegram ограничил частоту запросов: пауза {_seconds(error.retry_after)} с")
+
+    def _bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) >= 10000:
+                # Полные ведра ничего не помнят, их можно выбросить
+                self.buckets = {key: value for key, value in self.buckets.items() if not value.is_full(now)}
+            # Отрицательный chat_id или @username - группа или канал, у них лимит строже
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst, now)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def _next_ready(self, now: float):
+        """Первый запрос, чей чат может получить сообщение; иначе (None, сколько ждать)"""
+        shortest = None
+        for lane in self.lanes:
+            for index, entry in enumerate(lane):
+                if index >= self.scan_limit:
+                    break
+                if entry.chat_id is None:
+                    return entry, 0
+                wait = self._bucket(entry.chat_id, now).wait_time(now)
+                if wait <= 0:
+                    return entry, 0
+                if shortest is None or wait < shortest:
+                    shortest = wait
+        return None, shortest
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            delay = None
+            if self.pending():
+                delay = self.paused_until - now
+                if delay <= 0:
+                    delay = self.global_bucket.wait_time(now)
+                if delay <= 0:
+                    entry, delay = self._next_ready(now)
+                    if entry is not None:
+                        self._start(entry, now)
+                        continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, entry: Outgoing, now: float):
+        self.lanes[entry.lane].remove(entry)
+        if entry.edit_key is not None:
+            self.edits.pop(entry.edit_key, None)
+        self.global_bucket.take()
+        if entry.chat_id is not None:
+            self.buckets[entry.chat_id].take()
+        waited = now - entry.queued_at
+        if waited > self.stats["max_wait"]:
+            self.stats["max_wait"] = waited
+        task = asyncio.create_task(self._send(entry))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, entry: Outgoing):
+        self.in_flight += 1
+        try:
+            result = await entry.callback(*entry.args, **entry.kwargs)
+        except RetryAfter as e:
+            self._pause(e)
+            if entry.attempts < self.max_retries:
+                entry.attempts += 1
+                self._requeue(entry)
+            else:
+                self._finish(entry, exception=e)
+        except Exception as e:
+            self._finish(entry, exception=e)
+        else:
+            self.stats["sent"] += 1
+            self._finish(entry, result=result)
+        finally:
+            self.in_flight -= 1
+
+    def _requeue(self, entry: Outgoing):
+        """Повтор после 429 - первым в своей очереди (или вместе с более новой правкой)"""
+        newer = self.edits.get(entry.edit_key) if entry.edit_key is not None else None
+        if newer is not None:
+            newer.futures.extend(entry.futures)
+            self.stats["coalesced"] += 1
+            return
+        self.lanes[entry.lane].appendleft(entry)
+        if entry.edit_key is not None:
+            self.edits[entry.edit_key] = entry
+        self._wakeup.set()
+
+    def _finish(self, entry: Outgoing, result=None, exception: Optional[BaseException] = None):
+        if exception is not None:
+            self.stats["failed"] += 1
+        for future in entry.futures:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    # Метрики
+
+    def pending(self) -> int:
+        return sum(len(lane) for lane in self.lanes)
+
+    def get_stats(self) -> Dict:
+        loop_time = asyncio.get_running_loop().time() if self.global_bucket else 0
+        return {
+            **self.stats,
+            "queued": {name: len(lane) for name, lane in zip(PRIORITIES, self.lanes)},
+            "in_flight": self.in_flight,
+            "chats": len(self.buckets),
+            "paused": max(0.0, self.paused_until - loop_time)
+        }
@@ -0,0 +1,100 @@
+"""
+Модуль званий
+Звание - функция денег и суммарной репутации по порогам config.RANKS.
+Пороги заранее сведены в отсортированные массивы, звание находится бинарным
+поиском; UserCache пересчитывает его при каждом изменении денег или
+репутации и сообщает подписчикам о смене звания
+"""
+
+import bisect
+import logging
+from typing import Callable, Dict, List, Optional
+
+from config import RANKS
+
+logger = logging.getLogger(__name__)
+
+# Изменения этих полей могут поменять звание
+RANK_INPUTS = ("money", "reputation")
+# Звание, выданное администратором (/setrank), не пересчитывается
+RANK_LOCK = "rank_locked"
+
+
+class RankEngine:
+    """
+    Звания по порогам ranks (в порядке возрастания, как в config.RANKS)
+    Звание получено, если выполнены его пороги и пороги всех званий ниже,
+    поэтому пороги приводятся к накопленному максимуму и массивы монотонны
+    """
+
+    def __init__(self, ranks: Dict[str, Dict] = RANKS):
+        self.names: List[str] = list(ranks)
+        self.money_thresholds: List[int] = []
+        self.reputation_thresholds: List[int] = []
+        money = reputation = 0
+        for requirement in ranks.values():
+            money = max(money, requirement.get("min_money", 0))
+            reputation = max(reputation, requirement.get("min_reputation", 0))
+            self.money_thresholds.append(money)
+            self.reputation_thresholds.append(reputation)
+        self.listeners: List[Callable] = []
+        self.stats = {"evaluated": 0, "promoted": 0, "demoted": 0}
+
+    def subscribe(self, listener: Callable):
+        """
+        Подписывает слушателя на смену званий
+        listener(user_id, old_rank, new_rank, promoted)
+        """
+        self.listeners.append(listener)
+
+    def index_for(self, money: int, reputation: int) -> int:
+        """Номер звания для денег и суммарной репутации (0, если не выполнен ни один порог)"""
+        by_money = bisect.bisect_right(self.money_thresholds, money)
+        by_reputation = bisect.bisect_right(self.reputation_thresholds, reputation)
+        return max(0, min(by_money, by_reputation) - 1)
+
+    def resolve(self, money: int, reputation: int) -> str:
+        return self.names[self.index_for(money, reputation)]
+
+    @staticmethod
+    def affected(*operators: Optional[Dict]) -> bool:
+        """Затрагивают ли операторы изменения ($inc, $set, ...) деньги или репутацию"""
+        for paths in operators:
+            for path in paths or ():
+                if path.split(".", 1)[0] in RANK_INPUTS:
+                    return True
+        return False
+
+    def evaluate(self, doc: Dict) -> Optional[str]:
+        """
+        Новое звание для документа, если оно отличается от текущего; None,
+        если звание верное, закреплено администратором или в документе нет
+        звания, денег или репутации
+        """
+        if doc.get(RANK_LOCK):
+            return None
+        if "rank" not in doc or "money" not in doc or ("reputation" not in doc and "reputation_total" not in doc):
+            return None
+        self.stats["evaluated"] += 1
+        reputation = doc.get("reputation_total")
+        if reputation is None:
+            reputation = sum((doc.get("reputation") or {}).values())
+        rank = self.resolve(doc["money"], reputation)
+        return rank if rank != doc.get("rank") else None
+
+    def notify(self, user_id, old_rank: Optional[str], new_rank: str):
+        """Сообщает подписчикам о смене звания"""
+        old_index = self.names.index(old_rank) if old_rank in self.names else -1
+        promoted = self.names.index(new_rank) > old_index
+        self.stats["promoted" if promoted else "demoted"] += 1
+        for listener in self.listeners:
+            try:
+                listener(user_id, old_rank, new_rank, promoted)
+            except Exception as e:
+                logger.error(f"Ошибка слушателя смены звания {user_id}: {e}")
+
+    def get_stats(self) -> Dict:
+        return dict(self.stats)
+
+
+rank_engine = RankEngine()
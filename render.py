@@ -0,0 +1,83 @@
+"""
+Модуль отрисовки экранов
+Запоминает отпечаток (текст, parse_mode, клавиатура) последней версии каждого
+сообщения и не вызывает editMessageText, если экран не изменился: повторное
+нажатие той же кнопки и возврат на уже открытый экран обходятся без запроса.
+В многопроцессном режиме сообщение группы правят процессы разных игроков,
+поэтому отпечатки ведутся только для личных чатов (private_only)
+"""
+
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from telegram.constants import ChatType
+from telegram.error import BadRequest
+
+
+class Renderer:
+    """
+    Правки сообщений с пропуском пустых
+    Отпечатки хранятся для последних max_messages сообщений (LRU)
+    private_only - не вести отпечатки сообщений групп и inline-сообщений:
+    их могли изменить другие процессы, и пропуск правки оставил бы чужой экран
+    """
+
+    def __init__(self, max_messages: int = 50000, private_only: bool = False):
+        self.max_messages = max_messages
+        self.private_only = private_only
+        self.fingerprints: "OrderedDict[object, int]" = OrderedDict()
+        self.stats = {"edits": 0, "skipped": 0, "not_modified": 0}
+
+    def message_key(self, query):
+        """Ключ сообщения, к которому привязана кнопка; None, если отпечаток не ведется"""
+        if query.inline_message_id:
+            return None if self.private_only else query.inline_message_id
+        message = query.message
+        if message is None or (self.private_only and message.chat.type != ChatType.PRIVATE):
+            return None
+        return message.chat_id, message.message_id
+
+    def forget(self, query):
+        key = self.message_key(query)
+        if key is not None:
+            self.fingerprints.pop(key, None)
+
+    async def edit(self, query, text: str, reply_markup=None, parse_mode: Optional[str] = None):
+        """
+        Замена query.edit_message_text: если сообщение уже показывает этот экран,
+        запрос не отправляется; ответ Telegram "message is not modified" не считается ошибкой
+        """
+        key = self.message_key(query)
+        # Клавиатуры PTB хешируются по содержимому кнопок
+        fingerprint = hash((text, parse_mode, reply_markup))
+        if key is not None and self.fingerprints.get(key) == fingerprint:
+            self.fingerprints.move_to_end(key)
+            self.stats["skipped"] += 1
+            return None
+
+        try:
+            result = await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+            self.stats["edits"] += 1
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                self.forget(query)
+                raise
+            self.stats["not_modified"] += 1
+            result = None
+        except Exception:
+            # Неизвестно, что теперь показывает сообщение
+            self.forget(query)
+            raise
+
+        if key is not None:
+            self.fingerprints[key] = fingerprint
+            self.fingerprints.move_to_end(key)
+            if len(self.fingerprints) > self.max_messages:
+                self.fingerprints.popitem(last=False)
+        return result
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, "tracked": len(self.fingerprints)}
+
+
+renderer = Renderer()
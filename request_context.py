@@ -0,0 +1,172 @@
+"""
+Модуль контекста запроса
+Один RequestContext на обновление: игрок читается один раз (недостающие поля
+дочитываются), изменения копятся и уходят в базу одной записью в конце
+обработки. Обработчики получают его как context.request
+"""
+
+import copy
+import functools
+import logging
+from typing import Dict, Optional
+
+from telegram.ext import CallbackContext
+
+from storage import apply_update
+
+logger = logging.getLogger(__name__)
+
+
+class RequestContext:
+    """
+    Состояние обработки одного обновления для игрока user_id
+    Накопленные inc/set/push/pull сразу применяются к request.user, поэтому
+    обработчик видит итоговые значения до записи. До первого изменения
+    request.user - документ кэша; изменение сначала копирует его верхний
+    уровень и те поля, которые меняет, так что кэш и другие обработчики
+    видят изменения только после flush
+    """
+
+    def __init__(self, db, user_id):
+        self.db = db
+        self.user_id = user_id
+        self.user: Optional[Dict] = None
+        self.fields: Optional[set] = set()  # None - документ загружен целиком
+        self.missing = False
+        # Поля, скопированные из документа кэша (None - request.user и есть документ кэша)
+        self.copied: Optional[set] = None
+        self.inc: Dict = {}
+        self.set_fields: Dict = {}
+        self.push: Dict = {}
+        self.pull: Dict = {}
+        self.reasons = []
+
+    async def get_user(self, fields=None) -> Optional[Dict]:
+        """Игрок с полями fields (None - все); повторный вызов дочитывает только недостающие"""
+        if self.missing or self.user_id is None:
+            return None
+        wanted = None if fields is None else set(fields)
+        if self.user is not None and (self.fields is None or (wanted is not None and wanted <= self.fields)):
+            return self.user
+
+        to_load = None if wanted is None else tuple(wanted - self.fields)
+        doc = await self.db.get_user(self.user_id, to_load)
+        if doc is None:
+            self.missing = True
+            return None
+        if self.user is None:
+            self.user = doc
+        else:
+            # Уже загруженные поля могли измениться отложенными изменениями - не затираем их
+            for key, value in doc.items():
+                if key not in self.user:
+                    self.user[key] = value
+        self.fields = None if wanted is None else self.fields | wanted
+        return self.user
+
+    async def get_rank(self) -> Optional[str]:
+        """Ранг игрока из уже загруженного документа (дочитывается при необходимости)"""
+        user = await self.get_user(("rank",))
+        return user.get("rank") if user else None
+
+    def mutate(self, inc: dict = None, set_fields: dict = None, push: dict = None, pull: dict = None,
+               reason: str = None):
+        """Откладывает изменение до flush; одинаковые пути в inc складываются"""
+        for path, amount in (inc or {}).items():
+            self.inc[path] = self.inc.get(path, 0) + amount
+        self.set_fields.update(set_fields or {})
+        self.push.update(push or {})
+        self.pull.update(pull or {})
+        if reason and reason not in self.reasons:
+            self.reasons.append(reason)
+        if self.user is not None:
+            self._own(inc, set_fields, push, pull)
+            apply_update(self.user, inc=inc, set_fields=set_fields, push=push, pull=pull)
+
+    def _own(self, *operators: Optional[dict]):
+        """Копирует из документа кэша верхнеуровневые поля, которые меняют operators"""
+        if self.copied is None:
+            self.user = dict(self.user)
+            self.copied = set()
+        for operator in operators:
+            for path in operator or ():
+                field = path.split(".", 1)[0]
+                if field not in self.copied:
+                    value = self.user.get(field)
+                    if isinstance(value, (dict, list)):
+                        self.user[field] = copy.deepcopy(value)
+                    self.copied.add(field)
+
+    def discard(self):
+        """Отбрасывает накопленные изменения (обработчик завершился ошибкой)"""
+        self.inc, self.set_fields, self.push, self.pull, self.reasons = {}, {}, {}, {}, []
+        if self.copied is not None:
+            # В копии остались отброшенные изменения: следующее чтение вернет документ кэша
+            self.user, self.fields, self.copied = None, set(), None
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.inc or self.set_fields or self.push or self.pull)
+
+    async def flush(self, min_money: int = None, expected_version: int = None) -> Optional[Dict]:
+        """
+        Записывает накопленные изменения одним apply_delta
+        Условия (min_money, expected_version) относятся ко всей записи; при их
+        нарушении возвращается None, изменения отбрасываются, а request.user
+        перечитывается без них
+        """
+        if not self.dirty:
+            return self.user
+        inc, set_fields, push, pull = self.inc, self.set_fields, self.push, self.pull
+        reason = ",".join(self.reasons) or None
+        self.inc, self.set_fields, self.push, self.pull, self.reasons = {}, {}, {}, {}, []
+        doc = await self.db.apply_delta(
+            self.user_id,
+            inc=inc or None,
+            set_fields=set_fields or None,
+            push=push or None,
+            pull=pull or None,
+            min_money=min_money,
+            reason=reason,
+            expected_version=expected_version
+        )
+        if doc is None:
+            await self._reload()
+            return None
+        # После записи документ кэша полный и точный
+        self.user, self.fields, self.copied = doc, None, None
+        return doc
+
+    async def _reload(self):
+        """Перечитывает уже загруженные поля (после отклоненной записи)"""
+        if self.user is None:
+            return
+        fields = self.fields
+        self.user, self.fields, self.copied = None, set(), None
+        await self.get_user(fields)
+
+
+class BotContext(CallbackContext):
+    """CallbackContext с контекстом запроса (ContextTypes(context=BotContext))"""
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id, user_id)
+        self.request: Optional[RequestContext] = None
+
+
+def request_scoped(db):
+    """
+    Декоратор обработчиков PTB: создает context.request и после успешной
+    обработки сохраняет накопленные изменения
+    """
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            user = getattr(update, "effective_user", None)
+            context.request = RequestContext(db, user.id if user is not None else None)
+            result = await handler(update, context)
+            if context.request.dirty:
+                await context.request.flush()
+            return result
+        return wrapper
+    return decorate
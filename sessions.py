@@ -0,0 +1,155 @@
+"""
+Модуль игровых сессий
+Незавершенные игры (раздача блэкджека, выбранная ставка рулетки и костей)
+хранятся отдельно от context.user_data: в памяти процесса или в базе, общей
+для всех экземпляров бота. У сессии есть версия: ход применяется, только если
+версия не изменилась с момента показа кнопок, поэтому повторное нажатие
+"взять карту" или "хватит" не сработает дважды. Брошенные сессии удаляются
+по истечении ttl
+"""
+
+import asyncio
+import logging
+import string
+import time
+from typing import Dict, List, Optional, Tuple
+
+from storage import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+# Компактная запись карт: одна буква на карту ("10♥" -> "I")
+CARD_RANKS = ("2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K", "A")
+CARD_SUITS = ("♠", "♥", "♦", "♣")
+CARD_ALPHABET = string.ascii_letters
+CARD_CODES = {
+    f"{rank}{suit}": CARD_ALPHABET[suit_index * len(CARD_RANKS) + rank_index]
+    for suit_index, suit in enumerate(CARD_SUITS)
+    for rank_index, rank in enumerate(CARD_RANKS)
+}
+CARDS_BY_CODE = {code: card for card, code in CARD_CODES.items()}
+
+
+def encode_cards(cards: List[str]) -> str:
+    return "".join(CARD_CODES[card] for card in cards)
+
+
+def decode_cards(code: str) -> List[str]:
+    return [CARDS_BY_CODE[char] for char in code]
+
+
+def blackjack_state(bet: int, player_cards: List[str], dealer_cards: List[str]) -> Dict:
+    return {"b": bet, "p": encode_cards(player_cards), "d": encode_cards(dealer_cards)}
+
+
+def blackjack_hand(state: Dict) -> Tuple[int, List[str], List[str]]:
+    """Ставка, карты игрока и карты дилера из состояния сессии"""
+    return state["b"], decode_cards(state["p"]), decode_cards(state["d"])
+
+
+def session_key(user_id, game: str) -> str:
+    return f"{user_id}:{game}"
+
+
+class SessionStore:
+    """
+    Сессии игр: (user_id, игра) -> состояние и версия
+    Документы {"key", "user_id", "game", "state", "version", "expires_at"}
+    хранятся в storage (UserStorage): в общей базе или в MemoryStorage процесса
+    """
+
+    def __init__(self, storage, ttl: float = 3600, purge_interval: float = 300):
+        self.storage = storage
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.stats = {"started": 0, "updated": 0, "finished": 0, "conflicts": 0, "expired": 0}
+        self._purge_task: Optional[asyncio.Task] = None
+
+    async def get(self, user_id, game: str) -> Optional[Dict]:
+        """Сессия {"state", "version"} или None, если ее нет или она истекла"""
+        doc = await self.storage.get_session(session_key(user_id, game))
+        if doc is None or doc["expires_at"] <= time.time():
+            return None
+        return {"state": doc["state"], "version": doc["version"]}
+
+    async def start(self, user_id, game: str, state: Dict) -> int:
+        """
+        Начинает сессию, заменяя прежнюю; возвращает версию
+        Версия продолжает счет прежней сессии, чтобы кнопки старой игры не подошли к новой
+        """
+        key = session_key(user_id, game)
+        previous = await self.storage.get_session(key)
+        version = (previous["version"] if previous else 0) + 1
+        await self.storage.save_session(self._document(key, user_id, game, state, version))
+        self.stats["started"] += 1
+        return version
+
+    async def update(self, user_id, game: str, state: Dict, version: int) -> Optional[int]:
+        """Сохраняет новое состояние, если версия не изменилась; возвращает новую версию или None"""
+        doc = self._document(session_key(user_id, game), user_id, game, state, version + 1)
+        if not await self.storage.save_session(doc, expected_version=version):
+            self.stats["conflicts"] += 1
+            return None
+        self.stats["updated"] += 1
+        return version + 1
+
+    async def finish(self, user_id, game: str, version: Optional[int] = None) -> bool:
+        """
+        Завершает сессию; с version - только если версия не изменилась
+        True означает, что завершил именно этот вызов (ход можно засчитать)
+        """
+        if not await self.storage.delete_session(session_key(user_id, game), expected_version=version):
+            self.stats["conflicts"] += 1
+            return False
+        self.stats["finished"] += 1
+        return True
+
+    def _document(self, key: str, user_id, game: str, state: Dict, version: int) -> Dict:
+        return {
+            "key": key,
+            "user_id": user_id,
+            "game": game,
+            "state": state,
+            "version": version,
+            "expires_at": time.time() + self.ttl
+        }
+
+    # Очистка брошенных сессий
+
+    async def purge(self) -> int:
+        removed = await self.storage.purge_sessions(time.time())
+        self.stats["expired"] += removed
+        return removed
+
+    def start_purging(self):
+        if self._purge_task is None:
+            self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def stop(self):
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+            self._purge_task = None
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                await self.purge()
+            except Exception as e:
+                logger.error(f"Ошибка очистки игровых сессий: {e}")
+
+    def get_stats(self) -> Dict:
+        return dict(self.stats)
+
+
+def create_session_store(backend: str, storage, ttl: float = 3600, purge_interval: float = 300) -> SessionStore:
+    """
+    Хранилище сессий по имени из конфигурации: "storage" - в базе игроков,
+    общее для всех экземпляров; "memory" - в памяти процесса (не переживает перезапуск)
+    """
+    if backend == "memory":
+        return SessionStore(MemoryStorage(), ttl, purge_interval)
+    if backend == "storage":
+        return SessionStore(storage, ttl, purge_interval)
+    raise ValueError(f"Неизвестное хранилище сессий: {backend}")
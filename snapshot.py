@@ -0,0 +1,87 @@
+"""
+Модуль снимка состояния между перезапусками
+При остановке сохраняет список горячих игроков кэша в сжатый файл;
+следующий запуск заранее читает этих игроков. Незавершенные игры живут в
+хранилище сессий (см. sessions.py) и снимка не требуют.
+Документы игроков в снимок не попадают: они перечитываются из базы,
+поэтому снимок не может вернуть устаревшие балансы
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import zlib
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 2
+
+
+class StateSnapshot:
+    """
+    Снимок в файле path: zlib-сжатый JSON
+    Снимок старше max_age секунд при загрузке игнорируется; прочитанный
+    снимок удаляется, чтобы после аварийного перезапуска не применить его повторно
+    """
+
+    def __init__(self, path: str, max_age: float = 900, hot_users: int = 5000):
+        self.path = path
+        self.max_age = max_age
+        self.hot_users = hot_users
+
+    async def save(self, db) -> Dict:
+        """Сохраняет горячих игроков; возвращает счетчики"""
+        state = {
+            "format": SNAPSHOT_FORMAT,
+            "saved_at": time.time(),
+            "hot_users": db.hot_user_ids(self.hot_users)
+        }
+        payload = zlib.compress(json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        await asyncio.to_thread(self._write, payload)
+        counts = {"hot_users": len(state["hot_users"]), "bytes": len(payload)}
+        logger.info(f"Снимок состояния сохранен в {self.path}: {counts}")
+        return counts
+
+    async def load(self, db) -> Dict:
+        """Прогревает кэш; без снимка ничего не делает"""
+        counts = {"hot_users": 0}
+        try:
+            payload = await asyncio.to_thread(self._read)
+        except FileNotFoundError:
+            return counts
+        except OSError as e:
+            logger.error(f"Не удалось прочитать снимок {self.path}: {e}")
+            return counts
+        try:
+            state = json.loads(zlib.decompress(payload))
+        except (zlib.error, ValueError) as e:
+            logger.error(f"Снимок {self.path} поврежден и пропущен: {e}")
+            return counts
+
+        age = time.time() - state.get("saved_at", 0)
+        if state.get("format") != SNAPSHOT_FORMAT or age > self.max_age:
+            logger.info(f"Снимок {self.path} пропущен: формат {state.get('format')}, возраст {age:.0f} с")
+            return counts
+
+        counts["hot_users"] = await db.warm(state.get("hot_users", []))
+        logger.info(f"Снимок состояния загружен (возраст {age:.0f} с): {counts}")
+        return counts
+
+    def _write(self, payload: bytes):
+        # Запись через временный файл: при сбое остается прежний снимок, а не обрывок
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            payload = f.read()
+        os.remove(self.path)
+        return payload
+
@@ -0,0 +1,856 @@
+"""
+Модуль хранилищ данных игроков
+Общий интерфейс, который реализуют MongoDB, память и SQLite
+"""
+
+import asyncio
+import bisect
+import copy
+import functools
+import heapq
+import inspect
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from config import STARTING_MONEY, RANKS
+from metrics import db_errors, db_seconds
+
+logger = logging.getLogger(__name__)
+
+RANK_NAMES = list(RANKS)
+RANK_ORDER = {rank: index for index, rank in enumerate(RANK_NAMES)}
+
+# Сортировки рейтингов из handle_top; под каждую строится индекс.
+# Рейтинги идут по производным полям (см. derived_fields)
+LEADERBOARD_SORTS = {
+    "money": [("money", -1)],
+    "rank": [("rank_index", -1)],
+    "reputation": [("reputation_total", -1)],
+    "territories": [("territory_count", -1)]
+}
+
+
+def set_path(doc: Dict, path: str, value):
+    """Устанавливает значение по пути вида "statistics.games_played" """
+    keys = path.split(".")
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = value
+
+
+def get_path(doc: Dict, path: str, default=None):
+    """Возвращает значение по пути вида "statistics.games_played" """
+    for key in path.split("."):
+        if not isinstance(doc, dict) or key not in doc:
+            return default
+        doc = doc[key]
+    return doc
+
+
+def derived_fields(doc: Dict) -> Dict:
+    """
+    Производные поля документа: сумма репутации, число территорий и
+    номер звания в config.RANKS (-1 для неизвестного звания)
+    """
+    return {
+        "reputation_total": sum((doc.get("reputation") or {}).values()),
+        "territory_count": len(doc.get("territories") or []),
+        "rank_index": RANK_ORDER.get(doc.get("rank"), -1)
+    }
+
+
+def derived_sets(set_fields: Optional[dict]) -> Dict:
+    """
+    Производные поля для $set: пересчитываются только из полей,
+    которые заменяются целиком
+    """
+    result = {}
+    if not set_fields:
+        return result
+    if "rank" in set_fields:
+        result["rank_index"] = RANK_ORDER.get(set_fields["rank"], -1)
+    if "reputation" in set_fields:
+        result["reputation_total"] = sum((set_fields["reputation"] or {}).values())
+    if "territories" in set_fields:
+        result["territory_count"] = len(set_fields["territories"] or [])
+    for path in set_fields:
+        if path.startswith("reputation."):
+            logger.warning(f"$set {path} не обновляет reputation_total, используйте $inc")
+    return result
+
+
+def with_derived(inc: dict = None, set_fields: dict = None, push: dict = None, pull: dict = None):
+    """
+    Дополняет операторы apply_delta изменениями производных полей и
+    версии документа, чтобы они записывались тем же атомарным запросом
+    Возвращает (inc, set_fields, guard); guard - условие для запроса:
+    $pull территории уменьшает счетчик только если территория есть у игрока
+    """
+    inc = {**(inc or {}), "version": 1}
+    set_fields = {**(set_fields or {}), **derived_sets(set_fields)}
+    guard = {}
+
+    reputation_change = sum(value for path, value in inc.items() if path.startswith("reputation."))
+    if reputation_change:
+        inc["reputation_total"] = inc.get("reputation_total", 0) + reputation_change
+    if push and "territories" in push:
+        inc["territory_count"] = inc.get("territory_count", 0) + 1
+    if pull and "territories" in pull:
+        inc["territory_count"] = inc.get("territory_count", 0) - 1
+        guard["territories"] = pull["territories"]
+    return inc, set_fields, guard
+
+
+def version_matches(doc: Dict, expected_version: Optional[int]) -> bool:
+    """Совпадает ли версия документа с ожидаемой (документы без версии считаются версией 0)"""
+    return expected_version is None or doc.get("version", 0) == expected_version
+
+
+def new_user_document(user_id, username, name) -> Dict:
+    """Документ нового игрока"""
+    doc = {
+        "user_id": user_id,
+        "username": username,
+        "name": name,
+        "money": STARTING_MONEY,
+        "rank": "Շեստյորկա",
+        "rank_locked": False,
+        "reputation": {"копы": 0, "мафия": 0, "граждане": 0},
+        "territories": [],
+        "inventory": [],
+        "jail_time": None,
+        "jail_start": None,
+        "daily_bonus_time": None,
+        "last_crime_time": None,
+        "last_casino_time": None,
+        "last_territory_income": None,
+        "gang": None,
+        "statistics": {
+            "games_played": 0,
+            "games_won": 0,
+            "crimes_committed": 0,
+            "crimes_successful": 0,
+            "money_earned": 0,
+            "money_lost": 0
+        },
+        "achievements": [],
+        "created_at": datetime.now().isoformat(),
+        "banned": False,
+        "version": 0
+    }
+    doc.update(derived_fields(doc))
+    return doc
+
+
+def apply_update(doc: Dict, inc: dict = None, set_fields: dict = None, push: dict = None, pull: dict = None):
+    """Применяет к документу операторы $inc/$set/$push/$pull так же, как MongoDB"""
+    for path, value in (set_fields or {}).items():
+        set_path(doc, path, value)
+    for path, value in (inc or {}).items():
+        set_path(doc, path, get_path(doc, path, 0) + value)
+    for path, value in (push or {}).items():
+        items = get_path(doc, path)
+        if items is None:
+            items = []
+            set_path(doc, path, items)
+        items.append(value)
+    for path, value in (pull or {}).items():
+        items = get_path(doc, path)
+        if items is not None:
+            set_path(doc, path, [item for item in items if item != value])
+
+
+def matches(doc: Dict, query: Optional[dict]) -> bool:
+    """Проверяет документ на соответствие простому фильтру (равенство и $gt/$gte/$ne)"""
+    for path, condition in (query or {}).items():
+        value = get_path(doc, path)
+        if isinstance(condition, dict):
+            for operator, operand in condition.items():
+                if operator == "$gt" and not (value is not None and value > operand):
+                    return False
+                if operator == "$gte" and not (value is not None and value >= operand):
+                    return False
+                if operator == "$ne" and value == operand:
+                    return False
+        elif isinstance(value, list) and not isinstance(condition, list):
+            # Как в MongoDB: равенство со скаляром означает "массив содержит"
+            if condition not in value:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(doc: Dict, projection: Optional[dict]) -> Dict:
+    """Оставляет в документе только поля из проекции"""
+    if not projection:
+        return doc
+    included = [path for path, flag in projection.items() if flag and path != "_id"]
+    if not included:
+        return {key: value for key, value in doc.items() if projection.get(key, 1)}
+    missing = object()
+    result = {}
+    for path in included:
+        value = get_path(doc, path, missing)
+        if value is not missing:
+            set_path(result, path, value)
+    return result
+
+
+def fields_projection(fields) -> Optional[dict]:
+    """Проекция для get_user: None - весь документ, иначе перечисленные поля и user_id"""
+    if fields is None:
+        return None
+    projection = {"user_id": 1}
+    projection.update({field: 1 for field in fields})
+    return projection
+
+
+def sort_key(sort: List, doc: Dict):
+    """Ключ сортировки по спецификации вида [("money", -1)] для убывающего порядка"""
+    return tuple(get_path(doc, path, 0) for path, _ in sort)
+
+
+class UserStorage:
+    """
+    Интерфейс хранилища игроков
+    Все методы асинхронные; документы имеют ту же структуру, что в MongoDB
+    """
+
+    async def get_user(self, user_id, fields=None):
+        """
+        Возвращает документ игрока или None
+        fields - верхнеуровневые поля, которые нужны вызывающему (None - все)
+        """
+        raise NotImplementedError
+
+    async def create_user(self, user_id, username, name):
+        raise NotImplementedError
+
+    async def update_user(self, user_id, updates: dict, expected_version: int = None) -> bool:
+        """
+        $set полей с увеличением version
+        expected_version - сравнение с заменой: запись проходит, только если
+        версия документа не изменилась; возвращает, была ли запись
+        """
+        raise NotImplementedError
+
+    async def bulk_update_users(self, updates_by_user: dict):
+        """
+        Записывает отложенные изменения кэша нескольких пользователей
+        Версию не меняет: это досохранение изменений, уже упорядоченных кэшем
+        """
+        raise NotImplementedError
+
+    async def apply_delta(self, user_id, inc: dict = None, set_fields: dict = None,
+                          push: dict = None, pull: dict = None, min_money: int = None,
+                          expected_version: int = None):
+        raise NotImplementedError
+
+    async def get_top_users(self, by="money", limit=10):
+        raise NotImplementedError
+
+    async def backfill_derived_fields(self) -> int:
+        """Пересчитывает производные поля у всех игроков; возвращает число обновленных"""
+        raise NotImplementedError
+
+    async def iter_users(self, query: dict = None, projection: dict = None, batch_size: int = 500,
+                         after_user_id=None):
+        """
+        Потоково перебирает игроков по возрастанию user_id
+        after_user_id - продолжить после этого игрока (возобновляемые обходы)
+        """
+        raise NotImplementedError
+        yield
+
+    async def get_users_summary(self):
+        raise NotImplementedError
+
+    # Журнал транзакций (см. ledger.py)
+
+    async def insert_ledger_entries(self, entries: List[Dict]):
+        raise NotImplementedError
+
+    async def get_ledger_users(self, before_seq: int) -> List:
+        """Игроки, у которых есть записи журнала старше before_seq"""
+        raise NotImplementedError
+
+    async def get_ledger_entries(self, user_id, after_seq: int = None, before_seq: int = None) -> List[Dict]:
+        """Записи игрока с after_seq < seq < before_seq по возрастанию seq"""
+        raise NotImplementedError
+
+    async def delete_ledger_entries(self, user_id, up_to_seq: int):
+        raise NotImplementedError
+
+    async def get_ledger_snapshot(self, user_id) -> Optional[Dict]:
+        raise NotImplementedError
+
+    async def save_ledger_snapshot(self, snapshot: Dict):
+        raise NotImplementedError
+
+    # Задания рассылки (см. broadcast.py)
+
+    async def get_broadcast_jobs(self, status: str = None) -> List[Dict]:
+        raise NotImplementedError
+
+    async def save_broadcast_job(self, job: Dict):
+        """Сохраняет задание целиком (вставка или замена по job_id)"""
+        raise NotImplementedError
+
+    # Игровые сессии (см. sessions.py)
+
+    async def get_session(self, key: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    async def save_session(self, session: Dict, expected_version: int = None) -> bool:
+        """
+        Сохраняет сессию целиком; с expected_version - только поверх сессии
+        этой версии. Возвращает False, если условие не выполнено
+        """
+        raise NotImplementedError
+
+    async def delete_session(self, key: str, expected_version: int = None) -> bool:
+        """Удаляет сессию (с expected_version - только этой версии); False, если удалять нечего"""
+        raise NotImplementedError
+
+    async def purge_sessions(self, now: float) -> int:
+        """Удаляет сессии с expires_at <= now; возвращает их число"""
+        raise NotImplementedError
+
+    async def ensure_indexes(self):
+        """Готовит индексы; локальным хранилищам это не нужно"""
+        return {}
+
+    async def check_query_plans(self):
+        return {}
+
+
+class MemoryStorage(UserStorage):
+    """
+    Хранилище в памяти процесса
+    Для локальной разработки и нагрузочных тестов обработчиков без базы
+    """
+
+    def __init__(self):
+        self.users: Dict[int, Dict] = {}
+        self.ledger: Dict[int, List[Dict]] = {}
+        self.ledger_snapshots: Dict[int, Dict] = {}
+        self.broadcasts: Dict[str, Dict] = {}
+        self.sessions: Dict[str, Dict] = {}
+
+    async def get_user(self, user_id, fields=None):
+        doc = self.users.get(user_id)
+        return copy.deepcopy(project(doc, fields_projection(fields))) if doc is not None else None
+
+    async def create_user(self, user_id, username, name):
+        user_data = new_user_document(user_id, username, name)
+        self.users[user_id] = copy.deepcopy(user_data)
+        return user_data
+
+    async def update_user(self, user_id, updates: dict, expected_version: int = None) -> bool:
+        doc = self.users.get(user_id)
+        if doc is None or not version_matches(doc, expected_version):
+            return False
+        apply_update(doc, inc={"version": 1}, set_fields=copy.deepcopy({**updates, **derived_sets(updates)}))
+        return True
+
+    async def bulk_update_users(self, updates_by_user: dict):
+        for user_id, updates in updates_by_user.items():
+            doc = self.users.get(user_id)
+            if doc is not None:
+                apply_update(doc, set_fields=copy.deepcopy({**updates, **derived_sets(updates)}))
+
+    async def apply_delta(self, user_id, inc: dict = None, set_fields: dict = None,
+                          push: dict = None, pull: dict = None, min_money: int = None,
+                          expected_version: int = None):
+        inc, set_fields, guard = with_derived(inc, set_fields, push, pull)
+        doc = self.users.get(user_id)
+        if (doc is None or (min_money is not None and doc.get("money", 0) < min_money)
+                or not matches(doc, guard) or not version_matches(doc, expected_version)):
+            return None
+        apply_update(doc, inc, copy.deepcopy(set_fields), copy.deepcopy(push), pull)
+        return copy.deepcopy(doc)
+
+    async def get_top_users(self, by="money", limit=10):
+        sort = LEADERBOARD_SORTS.get(by)
+        if sort:
+            top = heapq.nlargest(limit, self.users.values(), key=lambda doc: sort_key(sort, doc))
+        else:
+            top = list(self.users.values())[:limit]
+        return copy.deepcopy(top)
+
+    async def backfill_derived_fields(self) -> int:
+        updated = 0
+        for doc in self.users.values():
+            derived = derived_fields(doc)
+            if any(doc.get(field) != value for field, value in derived.items()):
+                doc.update(derived)
+                updated += 1
+        return updated
+
+    async def iter_users(self, query: dict = None, projection: dict = None, batch_size: int = 500,
+                         after_user_id=None):
+        user_ids = sorted(self.users)
+        if after_user_id is not None:
+            user_ids = user_ids[bisect.bisect_right(user_ids, after_user_id):]
+        for start in range(0, len(user_ids), batch_size):
+            for user_id in user_ids[start:start + batch_size]:
+                doc = self.users.get(user_id)
+                if doc is not None and matches(doc, query):
+                    yield copy.deepcopy(project(doc, projection))
+            # Отдаем управление циклу событий между пачками
+            await asyncio.sleep(0)
+
+    async def get_users_summary(self):
+        docs = self.users.values()
+        return {
+            "total": len(self.users),
+            "banned": sum(1 for doc in docs if doc.get("banned") is True),
+            "total_money": sum(doc.get("money", 0) for doc in docs)
+        }
+
+    async def insert_ledger_entries(self, entries: List[Dict]):
+        for entry in entries:
+            user_entries = self.ledger.setdefault(entry["user_id"], [])
+            if user_entries and user_entries[-1]["seq"] > entry["seq"]:
+                bisect.insort(user_entries, dict(entry), key=lambda item: item["seq"])
+            else:
+                user_entries.append(dict(entry))
+
+    async def get_ledger_users(self, before_seq: int) -> List:
+        return [user_id for user_id, entries in self.ledger.items() if entries and entries[0]["seq"] < before_seq]
+
+    async def get_ledger_entries(self, user_id, after_seq: int = None, before_seq: int = None) -> List[Dict]:
+        entries = self.ledger.get(user_id, [])
+        start = 0 if after_seq is None else bisect.bisect_right(entries, after_seq, key=lambda item: item["seq"])
+        end = len(entries) if before_seq is None else bisect.bisect_left(entries, before_seq, key=lambda item: item["seq"])
+        return [dict(entry) for entry in entries[start:end]]
+
+    async def delete_ledger_entries(self, user_id, up_to_seq: int):
+        entries = self.ledger.get(user_id, [])
+        del entries[:bisect.bisect_right(entries, up_to_seq, key=lambda item: item["seq"])]
+        if not entries:
+            self.ledger.pop(user_id, None)
+
+    async def get_ledger_snapshot(self, user_id) -> Optional[Dict]:
+        snapshot = self.ledger_snapshots.get(user_id)
+        return dict(snapshot) if snapshot else None
+
+    async def save_ledger_snapshot(self, snapshot: Dict):
+        self.ledger_snapshots[snapshot["user_id"]] = dict(snapshot)
+
+    async def get_broadcast_jobs(self, status: str = None) -> List[Dict]:
+        return [copy.deepcopy(job) for job in self.broadcasts.values() if status is None or job["status"] == status]
+
+    async def save_broadcast_job(self, job: Dict):
+        self.broadcasts[job["job_id"]] = copy.deepcopy(job)
+
+    async def get_session(self, key: str) -> Optional[Dict]:
+        session = self.sessions.get(key)
+        return copy.deepcopy(session) if session is not None else None
+
+    async def save_session(self, session: Dict, expected_version: int = None) -> bool:
+        current = self.sessions.get(session["key"])
+        if expected_version is not None and (current is None or current["version"] != expected_version):
+            return False
+        self.sessions[session["key"]] = copy.deepcopy(session)
+        return True
+
+    async def delete_session(self, key: str, expected_version: int = None) -> bool:
+        current = self.sessions.get(key)
+        if current is None or (expected_version is not None and current["version"] != expected_version):
+            return False
+        del self.sessions[key]
+        return True
+
+    async def purge_sessions(self, now: float) -> int:
+        expired = [key for key, session in self.sessions.items() if session["expires_at"] <= now]
+        for key in expired:
+            del self.sessions[key]
+        return len(expired)
+
+
+def _json_field(field: str) -> str:
+    """Выражение SQLite для верхнеуровневого поля JSON-документа (под него строится индекс)"""
+    return f"json_extract(doc, '$.{field}')"
+
+
+class SQLiteStorage(UserStorage):
+    """
+    Хранилище в файле SQLite (режим WAL)
+    Документ хранится как JSON, деньги и бан продублированы в колонках для
+    индексов и агрегатов. Все запросы выполняются в одном фоновом потоке,
+    поэтому проверка баланса и запись в apply_delta атомарны
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-storage")
+        self._conn = None
+        self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id INTEGER PRIMARY KEY, "
+            "money INTEGER NOT NULL DEFAULT 0, "
+            "banned INTEGER NOT NULL DEFAULT 0, "
+            "doc TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_money ON users (money DESC)")
+        for by, ((field, _),) in LEADERBOARD_SORTS.items():
+            if field != "money":
+                self._conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS users_{field} ON users ({_json_field(field)} DESC)"
+                )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ledger ("
+            "user_id INTEGER NOT NULL, seq INTEGER NOT NULL, ts REAL NOT NULL, "
+            "delta INTEGER NOT NULL, balance INTEGER NOT NULL, reason TEXT, "
+            "PRIMARY KEY (user_id, seq))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ledger_seq ON ledger (seq)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ledger_snapshots ("
+            "user_id INTEGER PRIMARY KEY, balance INTEGER NOT NULL, "
+            "seq INTEGER NOT NULL, entries INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, doc TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "key TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL, doc TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _load(self, user_id) -> Optional[Dict]:
+        row = self._conn.execute("SELECT doc FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save(self, doc: Dict):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, money, banned, doc) VALUES (?, ?, ?, ?)",
+            (doc["user_id"], doc.get("money", 0), 1 if doc.get("banned") is True else 0,
+             json.dumps(doc, ensure_ascii=False))
+        )
+
+    def _modify(self, user_id, inc, set_fields, push, pull, min_money, expected_version):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            doc = self._load(user_id)
+            inc, set_fields, guard = with_derived(inc, set_fields, push, pull)
+            if (doc is None or (min_money is not None and doc.get("money", 0) < min_money)
+                    or not matches(doc, guard) or not version_matches(doc, expected_version)):
+                self._conn.execute("ROLLBACK")
+                return None
+            apply_update(doc, inc, set_fields, push, pull)
+            self._save(doc)
+            self._conn.execute("COMMIT")
+            return doc
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def _bulk_set(self, updates_by_user: dict):
+        with self._transaction():
+            for user_id, updates in updates_by_user.items():
+                doc = self._load(user_id)
+                if doc is not None:
+                    apply_update(doc, set_fields={**updates, **derived_sets(updates)})
+                    self._save(doc)
+
+    def _set_versioned(self, user_id, updates: dict, expected_version):
+        with self._transaction():
+            doc = self._load(user_id)
+            if doc is None or not version_matches(doc, expected_version):
+                return False
+            apply_update(doc, inc={"version": 1}, set_fields={**updates, **derived_sets(updates)})
+            self._save(doc)
+            return True
+
+    def _backfill(self):
+        updated = 0
+        with self._transaction():
+            for (raw,) in self._conn.execute("SELECT doc FROM users").fetchall():
+                doc = json.loads(raw)
+                derived = derived_fields(doc)
+                if any(doc.get(field) != value for field, value in derived.items()):
+                    doc.update(derived)
+                    self._save(doc)
+                    updated += 1
+        return updated
+
+    def _insert(self, doc: Dict):
+        self._save(doc)
+
+    def _top(self, by, limit):
+        sort = LEADERBOARD_SORTS.get(by)
+        if sort is None:
+            rows = self._conn.execute("SELECT doc FROM users LIMIT ?", (limit,)).fetchall()
+        else:
+            field = sort[0][0]
+            column = "money" if field == "money" else _json_field(field)
+            rows = self._conn.execute(f"SELECT doc FROM users ORDER BY {column} DESC LIMIT ?", (limit,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _page(self, after_user_id, batch_size):
+        if after_user_id is None:
+            rows = self._conn.execute(
+                "SELECT user_id, doc FROM users ORDER BY user_id LIMIT ?", (batch_size,)
+            ).fetchall()
+        else:
+            rows = self._conn.execute(
+                "SELECT user_id, doc FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (after_user_id, batch_size)
+            ).fetchall()
+        return rows
+
+    def _insert_ledger(self, entries: List[Dict]):
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO ledger (user_id, seq, ts, delta, balance, reason) VALUES (?, ?, ?, ?, ?, ?)",
+                [(e["user_id"], e["seq"], e["ts"], e["delta"], e["balance"], e.get("reason")) for e in entries]
+            )
+
+    def _ledger_users(self, before_seq):
+        rows = self._conn.execute("SELECT DISTINCT user_id FROM ledger WHERE seq < ?", (before_seq,)).fetchall()
+        return [row[0] for row in rows]
+
+    def _ledger_entries(self, user_id, after_seq, before_seq):
+        rows = self._conn.execute(
+            "SELECT user_id, seq, ts, delta, balance, reason FROM ledger "
+            "WHERE user_id = ? AND seq > ? AND seq < ? ORDER BY seq",
+            (user_id, after_seq if after_seq is not None else -1,
+             before_seq if before_seq is not None else 2 ** 63 - 1)
+        ).fetchall()
+        keys = ("user_id", "seq", "ts", "delta", "balance", "reason")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def _delete_ledger(self, user_id, up_to_seq):
+        with self._transaction():
+            self._conn.execute("DELETE FROM ledger WHERE user_id = ? AND seq <= ?", (user_id, up_to_seq))
+
+    def _ledger_snapshot(self, user_id):
+        row = self._conn.execute(
+            "SELECT user_id, balance, seq, entries FROM ledger_snapshots WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return dict(zip(("user_id", "balance", "seq", "entries"), row)) if row else None
+
+    def _save_ledger_snapshot(self, snapshot: Dict):
+        with self._transaction():
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ledger_snapshots (user_id, balance, seq, entries) VALUES (?, ?, ?, ?)",
+                (snapshot["user_id"], snapshot["balance"], snapshot["seq"], snapshot["entries"])
+            )
+
+    def _broadcast_jobs(self, status):
+        if status is None:
+            rows = self._conn.execute("SELECT doc FROM broadcasts").fetchall()
+        else:
+            rows = self._conn.execute("SELECT doc FROM broadcasts WHERE status = ?", (status,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _save_broadcast(self, job: Dict):
+        with self._transaction():
+            self._conn.execute(
+                "INSERT OR REPLACE INTO broadcasts (job_id, status, doc) VALUES (?, ?, ?)",
+                (job["job_id"], job["status"], json.dumps(job, ensure_ascii=False))
+            )
+
+    def _session(self, key: str):
+        row = self._conn.execute("SELECT doc FROM sessions WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save_session(self, session: Dict, expected_version):
+        values = (session["version"], session["expires_at"], json.dumps(session, ensure_ascii=False), session["key"])
+        with self._transaction():
+            if expected_version is None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sessions (version, expires_at, doc, key) VALUES (?, ?, ?, ?)", values
+                )
+                return True
+            cursor = self._conn.execute(
+                "UPDATE sessions SET version = ?, expires_at = ?, doc = ? WHERE key = ? AND version = ?",
+                values + (expected_version,)
+            )
+            return cursor.rowcount == 1
+
+    def _delete_session(self, key: str, expected_version):
+        with self._transaction():
+            if expected_version is None:
+                cursor = self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            else:
+                cursor = self._conn.execute(
+                    "DELETE FROM sessions WHERE key = ? AND version = ?", (key, expected_version)
+                )
+            return cursor.rowcount == 1
+
+    def _purge_sessions(self, now: float):
+        with self._transaction():
+            return self._conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+
+    def _summary(self):
+        total, banned, total_money = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(banned), 0), COALESCE(SUM(money), 0) FROM users"
+        ).fetchone()
+        return {"total": total, "banned": banned, "total_money": total_money}
+
+    async def get_user(self, user_id, fields=None):
+        doc = await self._run(self._load, user_id)
+        return project(doc, fields_projection(fields)) if doc is not None else None
+
+    async def create_user(self, user_id, username, name):
+        user_data = new_user_document(user_id, username, name)
+        await self._run(self._insert, copy.deepcopy(user_data))
+        return user_data
+
+    async def update_user(self, user_id, updates: dict, expected_version: int = None) -> bool:
+        return await self._run(self._set_versioned, user_id, updates, expected_version)
+
+    async def bulk_update_users(self, updates_by_user: dict):
+        if updates_by_user:
+            await self._run(self._bulk_set, updates_by_user)
+
+    async def apply_delta(self, user_id, inc: dict = None, set_fields: dict = None,
+                          push: dict = None, pull: dict = None, min_money: int = None,
+                          expected_version: int = None):
+        return await self._run(self._modify, user_id, inc, set_fields, push, pull, min_money, expected_version)
+
+    async def get_top_users(self, by="money", limit=10):
+        return await self._run(self._top, by, limit)
+
+    async def backfill_derived_fields(self) -> int:
+        return await self._run(self._backfill)
+
+    async def iter_users(self, query: dict = None, projection: dict = None, batch_size: int = 500,
+                         after_user_id=None):
+        after = after_user_id
+        while True:
+            rows = await self._run(self._page, after, batch_size)
+            if not rows:
+                return
+            for user_id, raw in rows:
+                doc = json.loads(raw)
+                if matches(doc, query):
+                    yield project(doc, projection)
+            after = rows[-1][0]
+
+    async def get_users_summary(self):
+        return await self._run(self._summary)
+
+    async def insert_ledger_entries(self, entries: List[Dict]):
+        if entries:
+            await self._run(self._insert_ledger, entries)
+
+    async def get_ledger_users(self, before_seq: int) -> List:
+        return await self._run(self._ledger_users, before_seq)
+
+    async def get_ledger_entries(self, user_id, after_seq: int = None, before_seq: int = None) -> List[Dict]:
+        return await self._run(self._ledger_entries, user_id, after_seq, before_seq)
+
+    async def delete_ledger_entries(self, user_id, up_to_seq: int):
+        await self._run(self._delete_ledger, user_id, up_to_seq)
+
+    async def get_ledger_snapshot(self, user_id) -> Optional[Dict]:
+        return await self._run(self._ledger_snapshot, user_id)
+
+    async def save_ledger_snapshot(self, snapshot: Dict):
+        await self._run(self._save_ledger_snapshot, snapshot)
+
+    async def get_broadcast_jobs(self, status: str = None) -> List[Dict]:
+        return await self._run(self._broadcast_jobs, status)
+
+    async def save_broadcast_job(self, job: Dict):
+        await self._run(self._save_broadcast, copy.deepcopy(job))
+
+    async def get_session(self, key: str) -> Optional[Dict]:
+        return await self._run(self._session, key)
+
+    async def save_session(self, session: Dict, expected_version: int = None) -> bool:
+        return await self._run(self._save_session, copy.deepcopy(session), expected_version)
+
+    async def delete_session(self, key: str, expected_version: int = None) -> bool:
+        return await self._run(self._delete_session, key, expected_version)
+
+    async def purge_sessions(self, now: float) -> int:
+        return await self._run(self._purge_sessions, now)
+
+    def close(self):
+        """Закрывает соединение и фоновый поток"""
+        if self._conn is not None:
+            self._executor.submit(self._conn.close).result()
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+
+class TimedStorage:
+    """
+    Обертка хранилища с метриками: каждый вызов корутин-методов замеряется в
+    db_seconds и считается в db_errors при исключении (метки - хранилище и метод).
+    Остальные атрибуты (iter_users, close, ...) отдаются без изменений
+    """
+
+    def __init__(self, storage: UserStorage, backend: str):
+        self.storage = storage
+        self.backend = backend
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.storage, name)
+        if not inspect.iscoroutinefunction(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await attribute(*args, **kwargs)
+            except Exception:
+                db_errors.inc(self.backend, name)
+                raise
+            finally:
+                db_seconds.observe(time.perf_counter() - started, self.backend, name)
+
+        # Обертка создается один раз на метод
+        setattr(self, name, timed)
+        return timed
+
+
+def create_storage(backend: str, **options) -> UserStorage:
+    """
+    Создает хранилище по имени из конфигурации: "mongo", "memory" или "sqlite"
+    MongoDB импортируется лениво, чтобы локальные хранилища не требовали motor
+    """
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        return SQLiteStorage(options.get("path", "mafia_casino.db"))
+    if backend == "mongo":
+        from mongo_database import MongoDB
+        return MongoDB(options["uri"])
+    raise ValueError(f"Неизвестное хранилище: {backend}")
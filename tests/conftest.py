@@ -0,0 +1,58 @@
+"""
+Общие настройки тестов: корень репозитория в sys.path, запуск async def тестов
+и хранилище с кэшем игроков. Запуск из корня репозитория: python -m pytest
+"""
+
+import asyncio
+import inspect
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MemoryStorage, SQLiteStorage  # noqa: E402
+from user_cache import UserCache  # noqa: E402
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """async def тесты выполняются в своем цикле событий (без pytest-asyncio)"""
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    asyncio.run(pyfuncitem.obj(**arguments))
+    return True
+
+
+@pytest.fixture
+def storage():
+    return MemoryStorage()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    """Каждое локальное хранилище по очереди: поведение memory и SQLite должно совпадать"""
+    if request.param == "memory":
+        yield MemoryStorage()
+        return
+    sqlite = SQLiteStorage(str(tmp_path / "users.db"))
+    yield sqlite
+    sqlite.close()
+
+
+@pytest.fixture
+def cache(storage):
+    return UserCache(storage)
+
+
+@pytest.fixture
+def make_player(storage):
+    """Создает игрока в хранилище: await make_player(user_id, money=..., ...) -> документ"""
+    async def create(user_id=1, **fields):
+        await storage.create_user(user_id, f"player{user_id}", f"Player {user_id}")
+        if fields:
+            await storage.update_user(user_id, fields)
+        return await storage.get_user(user_id)
+    return create
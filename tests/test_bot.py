@@ -0,0 +1,174 @@
+"""Обработчики бота поверх хранилища в памяти: маршрутизация callback'ов и контекст запроса"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot as bot_module
+import config
+from callback_router import RateLimiter
+from request_context import request_scoped
+from translations import get_text
+
+
+class FakeQuery:
+    """callback_query без сети: запоминает ответы и правки"""
+
+    def __init__(self, data, user_id=1, answer_delay=0.0):
+        self.data = data
+        self.answer_delay = answer_delay
+        self.from_user = SimpleNamespace(id=user_id)
+        self.inline_message_id = None
+        self.message = None
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text=None, **kwargs):
+        await asyncio.sleep(self.answer_delay)
+        self.answers.append(text)
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+@pytest.fixture
+def mafia_bot(monkeypatch):
+    """Бот со свежими сервисами на хранилище в памяти"""
+    monkeypatch.setattr(config, "BOT_TOKEN", "123:abc")
+    monkeypatch.setattr(config, "STORAGE_BACKEND", "memory")
+    for name in ("storage", "db", "ledger", "sessions", "snapshot", "broadcaster"):
+        monkeypatch.setattr(bot_module, name, None)
+    return bot_module.create_bot()
+
+
+async def tap(mafia_bot, data, user_id=1, answer_delay=0.0):
+    """Одно нажатие кнопки через handle_callback; возвращает запрос и контекст"""
+    query = FakeQuery(data, user_id, answer_delay)
+    update = SimpleNamespace(callback_query=query, effective_user=query.from_user)
+    context = SimpleNamespace()
+    await request_scoped(bot_module.db)(mafia_bot.handle_callback)(update, context)
+    return query, context
+
+
+async def test_rate_limited_taps_skip_the_handler(mafia_bot):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.data)
+
+    mafia_bot.router.exact("test_tap", handler, fields=False, rate="game")
+    mafia_bot.rate_limiter = RateLimiter({"game": (1, 2)}, clock=lambda: 0.0)
+
+    queries = [(await tap(mafia_bot, "test_tap"))[0] for _ in range(3)]
+    assert len(calls) == 2
+    assert queries[2].answers == [get_text("too_fast")]
+    assert queries[0].answers == [None]
+
+
+async def test_ack_overlaps_player_loading(mafia_bot, monkeypatch):
+    await bot_module.db.create_user(1, "player", "Player")
+    await bot_module.db.flush()
+    bot_module.db.entries.clear()
+    storage_get_user = bot_module.storage.get_user
+
+    async def slow_get_user(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        return await storage_get_user(*args, **kwargs)
+
+    monkeypatch.setattr(bot_module.storage, "get_user", slow_get_user)
+    seen = []
+
+    async def handler(request):
+        seen.append(request.user_data["money"])
+
+    mafia_bot.router.exact("test_load", handler, fields=("money",))
+    started = time.perf_counter()
+    await tap(mafia_bot, "test_load", answer_delay=0.1)
+    # Подтверждение и чтение игрока идут одновременно, а не друг за другом
+    assert time.perf_counter() - started < 0.18
+    assert seen == [config.STARTING_MONEY]
+
+
+async def test_failed_callback_handler_saves_nothing(mafia_bot):
+    await bot_module.db.create_user(1, "player", "Player")
+
+    async def handler(request):
+        request.request.mutate(inc={"money": 500}, reason="test")
+        raise RuntimeError("boom")
+
+    mafia_bot.router.exact("test_fail", handler, fields=("money",))
+    query, _ = await tap(mafia_bot, "test_fail")
+    assert "boom" in query.edits[-1]
+    assert (await bot_module.db.get_user(1))["money"] == config.STARTING_MONEY
+    await bot_module.db.flush()
+    assert (await bot_module.storage.get_user(1))["money"] == config.STARTING_MONEY
+
+
+async def test_slots_bet_is_one_guarded_write(mafia_bot, monkeypatch):
+    await bot_module.db.create_user(1, "player", "Player")
+    monkeypatch.setattr(bot_module.casino_games, "play_slots", lambda bet: {
+        "success": True, "win_amount": 0, "result": ["🍒", "⭐", "🍋"], "message": "lost"
+    })
+    apply_delta = bot_module.db.apply_delta
+    writes = []
+
+    async def counted_apply_delta(*args, **kwargs):
+        writes.append(kwargs.get("min_money"))
+        return await apply_delta(*args, **kwargs)
+
+    monkeypatch.setattr(bot_module.db, "apply_delta", counted_apply_delta)
+    await tap(mafia_bot, "slots_100")
+    user = await bot_module.db.get_user(1)
+    assert writes == [100]
+    assert user["money"] == config.STARTING_MONEY - 100
+    assert user["statistics"]["slots_played"] == 1
+
+    await bot_module.db.update_user(1, {"money": 50})
+    query, _ = await tap(mafia_bot, "slots_100")
+    assert query.edits == [get_text("not_enough_money", amount=100)]
+    assert writes == [100]
+
+
+async def test_setrank_validates_and_locks_rank(mafia_bot, monkeypatch):
+    monkeypatch.setattr(bot_module, "ADMIN_IDS", [99])
+    await bot_module.db.create_user(1, "player", "Player")
+    replies = []
+
+    async def setrank(*args):
+        message = SimpleNamespace(reply_text=lambda text: asyncio.sleep(0, replies.append(text)))
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=99), message=message)
+        await mafia_bot.setrank_command(update, SimpleNamespace(args=list(args)))
+
+    await setrank("1", "Генерал")
+    assert (await bot_module.db.get_user(1))["rank"] == "Շեստյորկա"
+
+    # Название из нескольких слов; пересчет после выигрыша звание не трогает
+    await setrank("1", "Գող", "օրենքով")
+    await bot_module.db.apply_delta(1, inc={"money": 1})
+    assert (await bot_module.db.get_user(1))["rank"] == "Գող օրենքով"
+
+    await setrank("1", "auto")
+    user = await bot_module.db.get_user(1)
+    assert user["rank"] == "Շեստյորկա" and user["rank_locked"] is False
+    assert "Неизвестный ранг" in replies[0]
+
+
+def test_import_opens_no_connections():
+    # Отдельный процесс: в этом модуль bot уже импортирован
+    code = "import sys, bot; print(bot.db is None, 'mongo_database' in sys.modules, bot.startup.marks.keys())"
+    env = {**os.environ, "BOT_TOKEN": "123:abc", "STORAGE_BACKEND": "mongo"}
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", code], cwd=root, env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "True False dict_keys(['import'])"
+
+
+def test_services_are_created_once(mafia_bot):
+    db, storage = bot_module.db, bot_module.storage
+    bot_module.init_services()
+    assert bot_module.db is db and bot_module.storage is storage
+    assert "build" in bot_module.startup.marks
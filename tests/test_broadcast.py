@@ -0,0 +1,95 @@
+"""Рассылки: возобновление с контрольной точки и пометка недоступных чатов"""
+
+import asyncio
+from types import SimpleNamespace
+
+from telegram.error import Forbidden
+
+from broadcast import Broadcaster, classify_error
+from user_cache import UserCache
+
+
+class FakeBot:
+    """Бот рассылки без сети: blocked - игроки, заблокировавшие бота"""
+
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        if "rate_limit_args" in kwargs:
+            # Без rate_limit_args отправляется только прогресс администратору
+            self.sent.append(chat_id)
+        return SimpleNamespace(message_id=1)
+
+    async def edit_message_text(self, *args, **kwargs):
+        return None
+
+
+async def finish(broadcaster):
+    await asyncio.gather(*list(broadcaster._tasks.values()))
+
+
+def test_classify_error():
+    assert classify_error(Forbidden("Forbidden: user is deactivated")) == "deactivated"
+    assert classify_error(Forbidden("Forbidden: bot was blocked by the user")) == "blocked"
+
+
+async def test_broadcast_marks_dead_chats_and_skips_them_next_time(storage, cache, make_player):
+    for user_id in range(1, 6):
+        await make_player(user_id)
+    broadcaster = Broadcaster(cache, concurrency=2)
+    bot = FakeBot(blocked={2})
+
+    job = await broadcaster.start(bot, "news", admin_chat_id=99)
+    await finish(broadcaster)
+    assert sorted(bot.sent) == [1, 3, 4, 5]
+    assert job["status"] == "done" and job["counts"]["blocked"] == 1
+    assert (await storage.get_user(2))["chat_blocked"] is True
+
+    bot.sent.clear()
+    await broadcaster.start(bot, "more news", admin_chat_id=99)
+    await finish(broadcaster)
+    assert sorted(bot.sent) == [1, 3, 4, 5]
+
+
+async def test_dead_chat_mark_reaches_other_processes(storage, cache, make_player):
+    await make_player(1)
+    # Кэш процесса, за которым закреплен игрок: документ уже загружен
+    owner = UserCache(storage)
+    version = (await owner.get_user(1))["version"]
+
+    assert await cache.mark_chat_blocked(1)
+    assert (await storage.get_user(1))["chat_blocked"] is True
+    # Условная запись владельца видит новую версию и перечитывает игрока
+    assert await owner.apply_delta(1, inc={"money": 1}, expected_version=version) is None
+    assert (await owner.get_user(1))["chat_blocked"] is True
+
+
+async def test_resume_continues_after_checkpoint(storage, cache, make_player):
+    for user_id in range(1, 8):
+        await make_player(user_id)
+    job = {
+        "job_id": "resumed",
+        "text": "news",
+        "status": "running",
+        "checkpoint": 4,
+        "counts": {"sent": 4, "blocked": 0, "deactivated": 0, "not_found": 0, "flood": 0, "failed": 0},
+        "admin_chat_id": 99,
+        "progress_message_id": None,
+        "created_at": None,
+        "finished_at": None
+    }
+    await storage.save_broadcast_job(job)
+    broadcaster = Broadcaster(cache, concurrency=3)
+    bot = FakeBot()
+
+    assert await broadcaster.resume(bot) == 1
+    await finish(broadcaster)
+    assert sorted(bot.sent) == [5, 6, 7]
+    saved = await storage.get_broadcast_jobs()
+    assert saved[0]["status"] == "done" and saved[0]["checkpoint"] == 7
+    assert saved[0]["counts"]["sent"] == 7
+    assert await storage.get_broadcast_jobs("running") == []
@@ -0,0 +1,68 @@
+"""Кодек callback_data: обратимость, версия таблиц и лимит Telegram в 64 байта"""
+
+from callback_codec import CATALOGS, PREFIX, ROUTES, VERSION_LENGTH, CallbackCodec, tables_version
+from callback_router import CallbackRouter
+
+TELEGRAM_LIMIT = 64
+
+
+def sample_args(kind):
+    if kind is None:
+        return [None]
+    if kind is int:
+        return [0, 36, 10 ** 9]
+    return list(CATALOGS[kind])
+
+
+def test_round_trip_for_every_route():
+    codec = CallbackCodec()
+    for pattern, kind in ROUTES:
+        for arg in sample_args(kind):
+            data = codec.encode(pattern, arg)
+            assert codec.decode(data) == (pattern, arg)
+            assert len(data.encode("utf-8")) <= TELEGRAM_LIMIT
+
+
+def test_version_is_long_fingerprint():
+    codec = CallbackCodec()
+    assert 4 <= len(codec.version) <= VERSION_LENGTH
+    assert codec.encode("main_menu").startswith(f"{PREFIX}{codec.version}.")
+
+
+def test_changed_tables_make_old_buttons_stale():
+    old = CallbackCodec()
+    catalogs = {**CATALOGS, "bet": CATALOGS["bet"] + (5000,)}
+    new = CallbackCodec(catalogs=catalogs)
+    assert new.version != old.version
+    assert new.decode(old.encode("slots_", 100)) is None
+
+    reordered = CallbackCodec(routes=tuple(reversed(ROUTES)))
+    assert reordered.decode(old.encode("main_menu")) is None
+
+
+def test_versions_of_edited_tables_do_not_collide():
+    # Одно изменение каталога за другим: каждая версия своя
+    versions = {
+        tables_version(ROUTES, {**CATALOGS, "bet": CATALOGS["bet"] + (amount,)})
+        for amount in range(2000, 4000)
+    }
+    assert len(versions) == 2000
+
+
+def test_malformed_data_is_rejected():
+    codec = CallbackCodec()
+    version = codec.version
+    for data in ("~", f"~{version}", f"~{version}.x", f"~{version}.999",
+                 f"~{version}.0.1", f"~{version}.15", f"~{version}.15.99", "~zz.0"):
+        assert codec.decode(data) is None
+
+
+def test_encoded_buttons_resolve_through_router():
+    codec = CallbackCodec()
+    router = CallbackRouter(codec=codec)
+    router.prefix("blackjack_hit_", lambda request: None, arg=int)
+    route, arg = router.resolve(codec.encode("blackjack_hit_", 4))
+    assert route.pattern == "blackjack_hit_" and arg == 4
+    # Маршрут есть в кодеке, но не зарегистрирован в роутере
+    assert router.resolve(codec.encode("main_menu")) == (None, None)
+    assert router.resolve(f"{PREFIX}0.0") == (None, None)
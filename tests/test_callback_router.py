@@ -0,0 +1,90 @@
+"""Маршрутизация callback'ов: точные маршруты, самый длинный префикс и ограничение частоты"""
+
+import pytest
+
+from callback_router import CallbackRouter, RateLimiter, choice
+
+
+def handler(request):
+    return None
+
+
+def make_router(codec=None):
+    router = CallbackRouter(codec=codec)
+    router.exact("blackjack_menu", handler, fields=False)
+    router.exact("blackjack_hit", handler)
+    router.prefix("blackjack_", handler, arg=int)
+    router.prefix("blackjack_hit_", handler, arg=int)
+    router.prefix("roulette_", handler, arg=choice("red", "black"))
+    router.prefix("buy_", handler)
+    router.prefix("buy_territory_", handler)
+    return router
+
+
+@pytest.mark.parametrize("data, pattern, arg", [
+    ("blackjack_menu", "blackjack_menu", None),
+    ("blackjack_hit", "blackjack_hit", None),
+    ("blackjack_100", "blackjack_", 100),
+    ("blackjack_hit_3", "blackjack_hit_", 3),
+    ("roulette_red", "roulette_", "red"),
+    ("buy_knife", "buy_", "knife"),
+    ("buy_territory_Կենտրոն", "buy_territory_", "Կենտրոն"),
+    ("buy_some_item", "buy_", "some_item"),
+])
+def test_resolve(data, pattern, arg):
+    route, parsed = make_router().resolve(data)
+    assert route.pattern == pattern
+    assert parsed == arg
+
+
+@pytest.mark.parametrize("data", ["nonsense", "blackjack_x", "roulette_green", "blackjack", ""])
+def test_unknown_or_invalid(data):
+    assert make_router().resolve(data) == (None, None)
+
+
+def test_registration_order_does_not_matter():
+    router = CallbackRouter()
+    router.prefix("blackjack_hit_", handler, arg=int)
+    router.prefix("blackjack_", handler, arg=int)
+    assert router.resolve("blackjack_hit_2")[0].pattern == "blackjack_hit_"
+    assert router.resolve("blackjack_50")[0].pattern == "blackjack_"
+
+
+def test_duplicates_and_bad_prefix_are_rejected():
+    router = make_router()
+    with pytest.raises(ValueError):
+        router.exact("blackjack_menu", handler)
+    with pytest.raises(ValueError):
+        router.prefix("blackjack_", handler)
+    with pytest.raises(ValueError):
+        router.prefix("dice", handler)
+
+
+def test_cache_is_bounded():
+    router = CallbackRouter(cache_size=2)
+    router.prefix("dice_", handler, arg=int)
+    for value in range(10):
+        assert router.resolve(f"dice_{value}")[1] == value
+    assert len(router._cache) <= 2
+
+
+def test_rate_limiter_buckets_per_class_and_user():
+    now = [0.0]
+    limiter = RateLimiter({"game": (1, 2)}, clock=lambda: now[0])
+    assert [limiter.allow("game", 1) for _ in range(3)] == [True, True, False]
+    # Другой игрок и класс без лимита не затронуты
+    assert limiter.allow("game", 2)
+    assert all(limiter.allow("menu", 1) for _ in range(10))
+    now[0] = 1.0
+    assert limiter.allow("game", 1) and not limiter.allow("game", 1)
+    assert limiter.stats == {"allowed": 4, "limited": 2}
+
+
+def test_rate_limiter_prunes_idle_buckets():
+    now = [0.0]
+    limiter = RateLimiter({"game": (1, 2)}, clock=lambda: now[0], prune_threshold=4)
+    for user_id in range(4):
+        limiter.allow("game", user_id)
+    now[0] = 10.0
+    limiter.allow("game", 99)
+    assert set(limiter.buckets) == {("game", 99)}
@@ -0,0 +1,65 @@
+"""Рейтинги в памяти: обновления очков, места игроков и перестроение из базы"""
+
+from leaderboard import Leaderboard
+
+
+def test_update_moves_player_between_positions():
+    board = Leaderboard()
+    for user_id, money in ((1, 100), (2, 300), (3, 200)):
+        board.update(user_id, {"name": f"P{user_id}", "money": money})
+    assert [user_id for user_id, _, _ in board.top("money")] == [2, 3, 1]
+
+    board.update(1, {"money": 500})
+    assert board.top("money", limit=1) == [(1, "P1", 500)]
+    assert board.position("money", 2) == (2, 300)
+    assert len(board.boards["money"]) == 3
+
+
+def test_ties_share_position_and_remove():
+    board = Leaderboard()
+    for user_id in (1, 2, 3):
+        board.update(user_id, {"money": 100 if user_id < 3 else 50})
+    assert board.position("money", 1) == board.position("money", 2) == (1, 100)
+    assert board.position("money", 3) == (3, 50)
+
+    board.remove(1)
+    assert board.position("money", 1) is None
+    assert board.position("money", 3) == (2, 50)
+
+
+def test_partial_documents_touch_only_their_boards():
+    board = Leaderboard()
+    board.update(1, {"name": "P1", "money": 10, "reputation_total": 5})
+    board.update(1, {"money": 20})
+    assert board.scores["reputation"][1] == 5
+    assert board.top("money") == [(1, "P1", 20)]
+    assert 1 not in board.scores["territories"]
+
+
+async def test_rebuild_and_cache_mutations(storage, cache, make_player):
+    board = Leaderboard()
+    for user_id in (1, 2):
+        await make_player(user_id)
+    await cache.apply_delta(2, inc={"money": 100})
+    assert await board.rebuild(storage) == 2
+    assert board.ready and board.top("money")[0][0] == 2
+
+    cache.subscribe(board.on_mutation)
+    await cache.apply_delta(1, inc={"money": 200})
+    assert board.top("money")[0][0] == 1
+
+
+async def test_refresh_keeps_changes_made_during_rebuild(storage, make_player):
+    board = Leaderboard()
+    await make_player(1)
+    await board.rebuild(storage)
+
+    class SlowStorage:
+        async def iter_users(self, **kwargs):
+            # Изменение пришло, пока рейтинги перечитывались из базы
+            board.on_mutation(1, {}, {"money": 10 ** 6})
+            async for user in storage.iter_users(**kwargs):
+                yield user
+
+    await board.refresh(SlowStorage())
+    assert board.top("money") == [(1, "Player 1", 10 ** 6)]
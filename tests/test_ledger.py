@@ -0,0 +1,37 @@
+"""Журнал транзакций: свертка в снимки, сжатие и восстановление баланса"""
+
+from ledger import Ledger, fold_snapshot
+
+
+def entry(seq, delta, balance):
+    return {"user_id": 1, "seq": seq, "delta": delta, "balance": balance}
+
+
+def test_fold_snapshot_without_snapshot_starts_from_first_balance():
+    result = fold_snapshot(1, None, [entry(1, 100, 1100), entry(2, -50, 1050)])
+    assert result == {"user_id": 1, "balance": 1050, "seq": 2, "entries": 2}
+
+
+def test_fold_snapshot_skips_entries_already_in_snapshot():
+    snapshot = {"user_id": 1, "balance": 1100, "seq": 1, "entries": 1}
+    result = fold_snapshot(1, snapshot, [entry(1, 100, 1100), entry(2, -50, 1050)])
+    assert result["balance"] == 1050 and result["entries"] == 2
+    assert snapshot["balance"] == 1100
+    assert fold_snapshot(1, None, []) is None
+
+
+async def test_replay_matches_balance_across_compaction(storage, cache, make_player):
+    ledger = Ledger(storage)
+    cache.subscribe(ledger.on_mutation)
+    await make_player()
+
+    for delta in (100, -30, 250):
+        await cache.apply_delta(1, inc={"money": delta}, reason="test")
+    cutoff = ledger._last_seq + 1
+    await cache.apply_delta(1, inc={"money": -20}, reason="test")
+
+    assert await ledger.compact(cutoff_seq=cutoff) == 3
+    assert await storage.get_ledger_entries(1, before_seq=cutoff) == []
+    # Повторное сжатие ничего не сворачивает дважды
+    assert await ledger.compact(cutoff_seq=cutoff) == 0
+    assert await ledger.replay(1) == (await storage.get_user(1))["money"]
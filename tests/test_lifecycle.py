@@ -0,0 +1,111 @@
+"""Остановка: дожидаемся начатых обработчиков до крайнего срока, затем отменяем"""
+
+import asyncio
+import os
+import signal
+from types import SimpleNamespace
+
+from lifecycle import InFlightHandlers, run_polling
+
+
+async def test_drain_waits_for_quick_handlers():
+    handlers = InFlightHandlers()
+    done = []
+
+    @handlers.tracked
+    async def handler(update, context):
+        await asyncio.sleep(0.02)
+        done.append(update)
+
+    task = asyncio.create_task(handler("update", None))
+    await asyncio.sleep(0)
+    assert handlers.get_stats()["active"] == 1
+
+    assert await handlers.drain(1.0) == 0
+    await task
+    assert done == ["update"]
+    assert handlers.get_stats() == {"started": 1, "aborted": 0, "refused": 0, "active": 0}
+
+
+async def test_drain_cancels_handlers_past_deadline():
+    handlers = InFlightHandlers()
+    cancelled = []
+
+    @handlers.tracked
+    async def handler(update, context):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(update)
+            raise
+
+    task = asyncio.create_task(handler("slow", None))
+    await asyncio.sleep(0)
+    assert await handlers.drain(0.05) == 1
+    # Обертка глотает отмену по крайнему сроку: PTB не видит ошибки
+    assert await task is None
+    assert cancelled == ["slow"]
+
+    # После остановки новые обновления не обрабатываются
+    assert await handler("late", None) is None
+    assert handlers.get_stats()["refused"] == 1 and handlers.get_stats()["aborted"] == 1
+
+
+async def test_drain_waits_for_update_queue():
+    handlers = InFlightHandlers()
+    queue = asyncio.Queue()
+    queue.put_nowait("update")
+
+    async def consume():
+        await asyncio.sleep(0.05)
+        queue.get_nowait()
+
+    consumer = asyncio.create_task(consume())
+    assert await handlers.drain(1.0, queue) == 0
+    assert queue.empty()
+    await consumer
+
+
+class FakeApplication:
+    """Application без сети: записывает порядок этапов запуска и остановки"""
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.update_queue = asyncio.Queue()
+        self.updater = SimpleNamespace(start_polling=self._step("start_polling"), stop=self._step("stop_polling"))
+        self.initialize = self._step("initialize")
+        self.start = self._step("start")
+        self.stop = self._step("stop")
+        self.shutdown = self._step("shutdown")
+        self.post_init = self._step("post_init")
+        self.post_stop = self._step("post_stop")
+        self.post_shutdown = self._step("post_shutdown")
+
+    def _step(self, name):
+        async def step(*args, **kwargs):
+            self.steps.append(name)
+        return step
+
+
+async def test_run_polling_drains_before_stopping():
+    steps = []
+    handlers = InFlightHandlers()
+
+    @handlers.tracked
+    async def handler(update, context):
+        await asyncio.sleep(0.05)
+        steps.append("handler_done")
+
+    async def stop_soon():
+        await asyncio.sleep(0.01)
+        asyncio.create_task(handler("update", None))
+        await asyncio.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    stopper = asyncio.create_task(stop_soon())
+    await run_polling(FakeApplication(steps), handlers, drain_timeout=1.0)
+    await stopper
+    assert steps == [
+        "initialize", "post_init", "start_polling", "start",
+        "stop_polling", "handler_done", "stop", "post_stop", "shutdown", "post_shutdown"
+    ]
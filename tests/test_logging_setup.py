@@ -0,0 +1,80 @@
+"""Логирование: вырезание токена, прореживание частых записей и файлы процессов"""
+
+import logging
+import queue
+
+import pytest
+
+import config
+from logging_setup import REDACTED, RedactingQueueHandler, SamplingFilter, redact, setup_logging, stop_logging, worker_log_file
+
+TOKEN = "123456789:AAEhBP0av28bVldAaAQUqOp7I_-abcdefgh"
+
+
+def make_record(name, message, level=logging.INFO, args=None):
+    return logging.LogRecord(name, level, __file__, 1, message, args, None)
+
+
+def test_redact_token_and_secrets():
+    url = f"https://api.telegram.org/bot{TOKEN}/getUpdates"
+    assert redact(url) == f"https://api.telegram.org/bot{REDACTED}/getUpdates"
+    assert redact("secret=hook-secret", secrets=["hook-secret", None]) == f"secret={REDACTED}"
+    assert redact("user 123456 paid 100") == "user 123456 paid 100"
+
+
+def test_sampling_keeps_one_of_n_per_message():
+    sampling = SamplingFilter({"httpx": 3})
+    kept = [sampling.filter(make_record("httpx", "POST getUpdates 200")) for _ in range(7)]
+    assert kept == [True, False, False, True, False, False, True]
+    # Другое сообщение считается отдельно
+    assert sampling.filter(make_record("httpx", "POST editMessageText 200"))
+
+
+def test_sampling_passes_warnings_and_other_loggers():
+    sampling = SamplingFilter({"httpx": 100})
+    sampling.filter(make_record("httpx", "POST getUpdates 429"))
+    assert sampling.filter(make_record("httpx", "POST getUpdates 429", logging.WARNING))
+    assert all(sampling.filter(make_record("bot", "update")) for _ in range(5))
+
+
+def test_sampled_record_is_tagged():
+    sampling = SamplingFilter({"httpx": 2})
+    sampling.filter(make_record("httpx", "request %s", args=("a",)))
+    sampling.filter(make_record("httpx", "request %s", args=("a",)))
+    record = make_record("httpx", "request %s", args=("a",))
+    assert sampling.filter(record)
+    assert record.getMessage() == "request a [1 из 2]"
+
+
+def test_queue_handler_redacts_formatted_message():
+    log_queue = queue.Queue()
+    handler = RedactingQueueHandler(log_queue, secrets=["hook-secret"])
+    handler.handle(make_record("httpx", "GET %s with %s", args=(f"/bot{TOKEN}/getMe", "hook-secret")))
+    record = log_queue.get_nowait()
+    assert TOKEN not in record.getMessage() and "hook-secret" not in record.getMessage()
+
+
+def test_worker_log_file():
+    assert worker_log_file("logs/bot.log", 3) == "logs/bot.3.log"
+
+
+@pytest.fixture
+def root_logger():
+    """setup_logging заменяет обработчики корневого логгера: возвращаем прежние"""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    stop_logging()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_setup_logging_writes_redacted_file(root_logger, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "BOT_TOKEN", TOKEN)
+    log_file = tmp_path / "bot.log"
+    setup_logging(str(log_file), "INFO")
+    logging.getLogger("bot").info(f"token {TOKEN}")
+    # Остановка дописывает очередь фонового потока
+    stop_logging()
+    text = log_file.read_text(encoding="utf-8")
+    assert f"token {REDACTED}" in text and TOKEN not in text
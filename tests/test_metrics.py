@@ -0,0 +1,139 @@
+"""Метрики: окна задержек, бюджет холодного старта, гистограммы, формат Prometheus, эндпоинт и замеры хранилища"""
+
+import asyncio
+
+import pytest
+
+from metrics import Histogram, LatencyStats, MetricsRegistry, MetricsServer, StartupBudget, db_errors, db_seconds
+from storage import MemoryStorage, TimedStorage
+
+
+def test_latency_percentiles_over_window():
+    stats = LatencyStats(window=100)
+    for value in range(1, 201):
+        stats.observe("load", value / 1000)
+    # В окне только последние 100 замеров
+    assert stats.percentile("load", 0.5) == pytest.approx(0.151)
+    assert stats.percentile("load", 0.99) == pytest.approx(0.2)
+    assert stats.percentile("missing", 0.5) == 0.0
+    assert stats.summary()["load"]["count"] == 200
+
+
+def test_latency_timer_records_on_error():
+    stats = LatencyStats()
+    with pytest.raises(RuntimeError):
+        with stats.timer("handler"):
+            raise RuntimeError("boom")
+    assert stats.counts["handler"] == 1
+
+
+def test_startup_budget_keeps_first_mark_and_reports_once(caplog):
+    startup = StartupBudget({"import": 0.5, "ready": 1.0}, started=0.0)
+    startup.mark("import", 0.2)
+    startup.mark("import", 5.0)
+    startup.mark("ready", 3.0)
+    assert startup.marks == {"import": 0.2, "ready": 3.0}
+    assert startup.over_budget() == {"ready": 3.0}
+
+    with caplog.at_level("INFO", logger="metrics"):
+        startup.report()
+        startup.report()
+    warnings = [record for record in caplog.records if record.levelname == "WARNING"]
+    assert len(caplog.records) == 2 and len(warnings) == 1
+    assert "ready" in warnings[0].getMessage()
+
+
+async def test_startup_budget_marks_first_update_only():
+    startup = StartupBudget({"first_update": 1.0})
+    calls = []
+
+    @startup.tracked
+    async def handler(update, context):
+        calls.append(update)
+
+    await handler(1, None)
+    first = startup.marks["first_update"]
+    await handler(2, None)
+    assert calls == [1, 2]
+    assert startup.marks == {"first_update": first}
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram("test_seconds", "test", ("route",), buckets=(0.01, 0.1, 1))
+    for value in (0.005, 0.05, 0.05, 0.5):
+        histogram.observe(value, "menu")
+    histogram.observe(5, "slow")
+
+    assert histogram.count("menu") == 4
+    assert histogram.total("menu") == pytest.approx(0.605)
+    assert histogram.quantile(0.5, "menu") == 0.1
+    assert histogram.quantile(0.99, "menu") == 1
+    assert histogram.quantile(0.99, "slow") == float("inf")
+    assert histogram.quantile(0.5, "missing") == 0.0
+    assert list(histogram.summary(limit=1)) == [("menu",)]
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry(prefix="t_")
+    histogram = registry.histogram("seconds", "Время", ("route",), buckets=(0.1, 1))
+    histogram.observe(0.05, 'say "hi"\n')
+    histogram.observe(2, 'say "hi"\n')
+    registry.counter("errors_total", "Ошибки", ("method",)).inc("get_user", amount=2)
+    registry.collected("queued", "Очередь", lambda: {"interactive": 3}, ("lane",))
+
+    lines = registry.render().splitlines()
+    assert "# TYPE t_seconds histogram" in lines
+    assert 't_seconds_bucket{route="say \\"hi\\"\\n",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{route="say \\"hi\\"\\n",le="+Inf"} 2' in lines
+    assert 't_seconds_count{route="say \\"hi\\"\\n"} 2' in lines
+    assert 't_errors_total{method="get_user"} 2' in lines
+    assert 't_queued{lane="interactive"} 3' in lines
+
+
+def test_broken_collector_does_not_break_render():
+    registry = MetricsRegistry(prefix="t_")
+    registry.collected("broken", "Сломано", lambda: 1 / 0)
+    registry.collected("ok", "Работает", lambda: 1)
+    text = registry.render()
+    assert "t_broken" not in text and "t_ok 1" in text
+
+
+async def fetch(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+async def test_metrics_endpoint():
+    registry = MetricsRegistry(prefix="t_")
+    registry.collected("up", "Работает", lambda: 1)
+    server = MetricsServer(registry)
+    await server.start("127.0.0.1", 0)
+    port = server._server.sockets[0].getsockname()[1]
+    try:
+        response = await fetch(port, "/metrics")
+        assert response.startswith(b"HTTP/1.1 200 OK")
+        assert response.endswith(b"t_up 1\n")
+        assert (await fetch(port, "/other")).startswith(b"HTTP/1.1 404")
+    finally:
+        await server.stop()
+
+
+async def test_timed_storage_records_calls_and_errors():
+    async def failing(user_id, fields=None):
+        raise RuntimeError("connection lost")
+
+    storage = TimedStorage(MemoryStorage(), "test")
+    before = db_seconds.count("test", "create_user")
+    await storage.create_user(1, "player", "Player")
+    assert db_seconds.count("test", "create_user") == before + 1
+    assert storage.create_user is storage.create_user
+
+    storage.storage.get_user = failing
+    with pytest.raises(RuntimeError):
+        await storage.get_user(1)
+    assert db_errors.values[("test", "get_user")] == 1
+    assert storage.users == storage.storage.users
@@ -0,0 +1,159 @@
+"""
+MongoDB: условия атомарных изменений ($inc с проверкой денег, версия документа)
+Коллекция подменяется простой реализацией в памяти; без motor тесты пропускаются
+"""
+
+import pytest
+
+pytest.importorskip("motor")
+
+from mongo_database import MongoDB, _plan_stages  # noqa: E402
+from pymongo.errors import PyMongoError  # noqa: E402
+from storage import LEADERBOARD_SORTS, apply_update, get_path, new_user_document  # noqa: E402
+
+
+def _matches(doc, query):
+    for path, condition in query.items():
+        value = get_path(doc, path)
+        if isinstance(condition, dict):
+            for operator, operand in condition.items():
+                if operator == "$gte" and not (value is not None and value >= operand):
+                    return False
+                if operator == "$in" and value not in operand:
+                    return False
+        elif isinstance(value, list):
+            if condition not in value:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class UpdateResult:
+    def __init__(self, matched_count):
+        self.matched_count = matched_count
+
+
+class FakeCollection:
+    """Часть API коллекции motor, нужная apply_delta и update_user"""
+
+    def __init__(self):
+        self.docs = []
+        self.queries = []
+
+    def _find(self, query):
+        self.queries.append(query)
+        return next((doc for doc in self.docs if _matches(doc, query)), None)
+
+    async def find_one(self, query, projection=None):
+        doc = self._find(query)
+        return dict(doc) if doc is not None else None
+
+    async def find_one_and_update(self, query, update, return_document=None):
+        doc = self._find(query)
+        if doc is None:
+            return None
+        apply_update(doc, update.get("$inc"), update.get("$set"), update.get("$push"), update.get("$pull"))
+        return dict(doc)
+
+    async def update_one(self, query, update):
+        doc = self._find(query)
+        if doc is not None:
+            apply_update(doc, update.get("$inc"), update.get("$set"))
+        return UpdateResult(int(doc is not None))
+
+
+@pytest.fixture
+def mongo():
+    db = MongoDB.__new__(MongoDB)
+    db.users = FakeCollection()
+    db.users.docs.append(new_user_document(1, "player", "Player"))
+    db.users.docs[0]["money"] = 1000
+    return db
+
+
+async def test_min_money_is_part_of_the_query(mongo):
+    doc = await mongo.apply_delta(1, inc={"money": -600}, min_money=600)
+    assert doc["money"] == 400 and doc["version"] == 1
+    assert mongo.users.queries[-1]["money"] == {"$gte": 600}
+
+    assert await mongo.apply_delta(1, inc={"money": -600}, min_money=600) is None
+    assert mongo.users.docs[0]["money"] == 400
+
+
+async def test_expected_version_rejects_stale_writes(mongo):
+    assert await mongo.update_user(1, {"name": "A"}, expected_version=0)
+    assert not await mongo.update_user(1, {"name": "B"}, expected_version=0)
+    assert await mongo.apply_delta(1, inc={"money": 1}, expected_version=0) is None
+    doc = await mongo.apply_delta(1, inc={"money": 1}, expected_version=1)
+    assert doc["money"] == 1001 and doc["version"] == 2
+
+
+async def test_version_zero_matches_documents_without_version(mongo):
+    del mongo.users.docs[0]["version"]
+    assert await mongo.update_user(1, {"name": "A"}, expected_version=0)
+    assert mongo.users.docs[0]["version"] == 1
+
+
+class IndexedCollection:
+    """Коллекция, которая хранит только описания индексов и планы запросов"""
+
+    def __init__(self, name, existing=(), failing=(), plan=None):
+        self.name = name
+        self.indexes = {index: {} for index in existing}
+        self.failing = set(failing)
+        self.plan = plan or {"stage": "LIMIT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}
+
+    async def index_information(self):
+        return dict(self.indexes)
+
+    async def create_index(self, keys, name, **options):
+        if name in self.failing:
+            raise PyMongoError("index build failed")
+        self.indexes[name] = {"key": keys, **options}
+
+    def find(self, *args, **kwargs):
+        return self
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, *args):
+        return self
+
+    async def explain(self):
+        return {"queryPlanner": {"winningPlan": {"queryPlan": self.plan}}}
+
+
+def _indexed_mongo(**users_options):
+    db = MongoDB.__new__(MongoDB)
+    db.users = IndexedCollection("users", **users_options)
+    for name in ("ledger", "ledger_snapshots", "broadcasts", "sessions"):
+        setattr(db, name, IndexedCollection(name))
+    return db
+
+
+async def test_ensure_indexes_reports_build_status():
+    db = _indexed_mongo(existing=["user_id_unique"], failing=["top_money"])
+    report = await db.ensure_indexes()
+    assert report["users.user_id_unique"] == "exists"
+    assert report["users.top_money"].startswith("error:")
+    assert all(report[f"users.top_{keys[0][0]}"] == "created" for by, keys in LEADERBOARD_SORTS.items()
+               if keys[0][0] != "money")
+    assert db.sessions.indexes["expires_ttl"]["expireAfterSeconds"] == 0
+
+    report = await db.ensure_indexes()
+    assert report["users.top_money"].startswith("error:")
+    assert report["sessions.key_unique"] == "exists"
+
+
+async def test_check_query_plans_warns_on_collscan(caplog):
+    db = _indexed_mongo(plan={"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}})
+    plans = await db.check_query_plans()
+    assert plans["get_user"] == ["SORT", "COLLSCAN"]
+    assert "get_user" in caplog.text
+
+
+def test_plan_stages_walks_nested_plans():
+    plan = {"stage": "SORT_MERGE", "inputStages": [{"stage": "IXSCAN"}, {"stage": "FETCH", "inputStage": {"stage": "COLLSCAN"}}]}
+    assert _plan_stages(plan) == ["SORT_MERGE", "IXSCAN", "FETCH", "COLLSCAN"]
@@ -0,0 +1,114 @@
+"""Планировщик исходящих запросов: ведра токенов, приоритеты, 429 и объединение правок"""
+
+import asyncio
+
+from telegram.error import RetryAfter
+
+from outbound import OutboundScheduler, TokenBucket
+
+
+class Recorder:
+    """Запрос к Bot API: запоминает порядок и время отправки"""
+
+    def __init__(self, failures=0, retry_after=0.05):
+        self.sent = []
+        self.failures = failures
+        self.retry_after = retry_after
+
+    async def __call__(self, tag):
+        if self.failures:
+            self.failures -= 1
+            raise RetryAfter(self.retry_after)
+        self.sent.append((tag, asyncio.get_running_loop().time()))
+        return tag
+
+    def tags(self):
+        return [tag for tag, _ in self.sent]
+
+
+def request(scheduler, recorder, tag, endpoint="sendMessage", priority=None, **data):
+    return asyncio.create_task(
+        scheduler.process_request(recorder, (tag,), {}, endpoint, data, {"priority": priority} if priority else None)
+    )
+
+
+async def started(**options):
+    scheduler = OutboundScheduler(**{"global_rate": 100, **options})
+    await scheduler.initialize()
+    return scheduler
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, capacity=2, now=0)
+    for _ in range(2):
+        assert bucket.wait_time(0) == 0
+        bucket.take()
+    assert bucket.wait_time(0) == 0.5
+    assert not bucket.is_full(0.5) and bucket.is_full(1.0)
+    assert bucket.wait_time(10) == 0 and bucket.tokens == 2
+
+
+async def test_interactive_lane_goes_before_broadcast():
+    scheduler, recorder = await started(), Recorder()
+    tasks = [request(scheduler, recorder, f"b{i}", priority="broadcast", chat_id=100 + i) for i in range(3)]
+    tasks += [request(scheduler, recorder, f"i{i}", chat_id=10 + i) for i in range(2)]
+    tasks.append(request(scheduler, recorder, "answer", endpoint="answerCallbackQuery", callback_query_id="q"))
+    await asyncio.gather(*tasks)
+    await scheduler.shutdown()
+    assert recorder.tags() == ["answer", "i0", "i1", "b0", "b1", "b2"]
+    assert scheduler.stats["immediate"] == 1 and scheduler.stats["sent"] == 5
+
+
+async def test_chat_bucket_spaces_messages():
+    scheduler, recorder = await started(chat_rate=20, chat_burst=2), Recorder()
+    await asyncio.gather(*(request(scheduler, recorder, f"m{i}", chat_id=1) for i in range(3)))
+    await scheduler.shutdown()
+    times = [sent_at for _, sent_at in recorder.sent]
+    assert times[1] - times[0] < 0.03 <= times[2] - times[1]
+
+
+async def test_private_edits_skip_the_chat_bucket():
+    scheduler, recorder = await started(chat_rate=0.1, chat_burst=1, group_rate=0.1, group_burst=1), Recorder()
+    await request(scheduler, recorder, "message", chat_id=1)
+    # Лимит личного чата исчерпан, но правки экранов уходят сразу
+    await asyncio.wait_for(asyncio.gather(*(
+        request(scheduler, recorder, f"edit{i}", endpoint="editMessageText", chat_id=1, message_id=i)
+        for i in range(3)
+    )), 1)
+
+    await request(scheduler, recorder, "group", chat_id=-5)
+    group_edit = request(scheduler, recorder, "group_edit", endpoint="editMessageText", chat_id=-5, message_id=1)
+    await asyncio.sleep(0.1)
+    assert not group_edit.done()
+    group_edit.cancel()
+    scheduler.drain_timeout = 0
+    await scheduler.shutdown()
+
+
+async def test_queued_edits_of_one_message_coalesce():
+    scheduler, recorder = await started(), Recorder()
+    edits = [request(scheduler, recorder, f"screen{i}", endpoint="editMessageText", chat_id=1, message_id=7)
+             for i in range(3)]
+    assert await asyncio.gather(*edits) == ["screen2"] * 3
+    await scheduler.shutdown()
+    assert recorder.tags() == ["screen2"]
+    assert scheduler.stats["coalesced"] == 2
+
+
+async def test_retry_after_pauses_and_requeues():
+    scheduler, recorder = await started(), Recorder(failures=1, retry_after=0.05)
+    loop = asyncio.get_running_loop()
+    queued_at = loop.time()
+    assert await request(scheduler, recorder, "retry", chat_id=1) == "retry"
+    await scheduler.shutdown()
+    assert recorder.sent[0][1] - queued_at >= 0.05
+    assert scheduler.stats["retry_after"] == 1 and scheduler.stats["failed"] == 0
+
+
+async def test_retries_are_bounded():
+    scheduler, recorder = await started(max_retries=1), Recorder(failures=5, retry_after=0.01)
+    task = request(scheduler, recorder, "flood", chat_id=1)
+    await asyncio.wait([task])
+    await scheduler.shutdown()
+    assert isinstance(task.exception(), RetryAfter)
+    assert scheduler.stats["failed"] == 1 and recorder.sent == []
@@ -0,0 +1,75 @@
+"""Звания: пороги денег и репутации, пересчет в UserCache и закрепление администратором"""
+
+import pytest
+
+from rank_engine import RankEngine
+from user_cache import UserCache
+
+RANKS = {
+    "rookie": {"min_money": 0, "min_reputation": 0},
+    "soldier": {"min_money": 100, "min_reputation": 10},
+    # Порог денег ниже предыдущего: звание требует и порогов всех званий ниже
+    "captain": {"min_money": 50, "min_reputation": 20},
+    "boss": {"min_money": 1000, "min_reputation": 100}
+}
+
+
+def brute_force(money, reputation):
+    rank = "rookie"
+    for name, requirement in RANKS.items():
+        if money < requirement["min_money"] or reputation < requirement["min_reputation"]:
+            break
+        rank = name
+    return rank
+
+
+@pytest.mark.parametrize("money", [-10, 0, 49, 50, 99, 100, 999, 1000, 10 ** 6])
+@pytest.mark.parametrize("reputation", [-5, 0, 9, 10, 19, 20, 99, 100, 500])
+def test_resolve_matches_definition(money, reputation):
+    assert RankEngine(RANKS).resolve(money, reputation) == brute_force(money, reputation)
+
+
+def test_evaluate_uses_reputation_total_or_sum():
+    engine = RankEngine(RANKS)
+    assert engine.evaluate({"rank": "rookie", "money": 150, "reputation": {"a": 5, "b": 5}}) == "soldier"
+    assert engine.evaluate({"rank": "soldier", "money": 150, "reputation_total": 10}) is None
+    assert engine.evaluate({"money": 150, "reputation_total": 10}) is None
+
+
+def test_evaluate_keeps_locked_rank():
+    engine = RankEngine(RANKS)
+    doc = {"rank": "boss", "rank_locked": True, "money": 0, "reputation_total": 0}
+    assert engine.evaluate(doc) is None
+    assert engine.evaluate({**doc, "rank_locked": False}) == "rookie"
+
+
+async def test_cache_promotes_and_notifies(storage, make_player):
+    engine = RankEngine(RANKS)
+    events = []
+    engine.subscribe(lambda *event: events.append(event))
+    cache = UserCache(storage, rank_engine=engine)
+    await make_player(1, rank="rookie", money=0)
+
+    await cache.apply_delta(1, inc={"money": 2000, "reputation.мафия": 150})
+    assert (await cache.get_user(1))["rank"] == "boss"
+    await cache.apply_delta(1, inc={"money": -1950})
+    assert (await cache.get_user(1))["rank"] == "rookie"
+    assert events == [(1, "rookie", "boss", True), (1, "boss", "rookie", False)]
+
+    await cache.flush()
+    assert (await storage.get_user(1))["rank"] == "rookie"
+
+
+async def test_cache_keeps_rank_set_by_admin(storage, make_player):
+    engine = RankEngine(RANKS)
+    cache = UserCache(storage, rank_engine=engine)
+    await make_player(1, rank="boss", rank_locked=True, money=0)
+
+    # Частичная проекция со званием дочитывает и флаг закрепления
+    doc = await cache.get_user(1, ("money", "rank", "reputation"))
+    assert doc["rank_locked"] is True
+    await cache.update_user(1, {"money": 10})
+    await cache.apply_delta(1, inc={"money": 5})
+    await cache.flush()
+    assert (await storage.get_user(1))["rank"] == "boss"
+    assert engine.get_stats()["demoted"] == 0
@@ -0,0 +1,91 @@
+"""Renderer: пропуск неизмененных правок и отпечатки в многопроцессном режиме"""
+
+from types import SimpleNamespace
+
+import pytest
+from telegram.constants import ChatType
+from telegram.error import BadRequest
+
+from render import Renderer
+
+
+class FakeQuery:
+    def __init__(self, chat_id, chat_type=ChatType.PRIVATE, message_id=1, inline_message_id=None, error=None):
+        self.inline_message_id = inline_message_id
+        chat = SimpleNamespace(id=chat_id, type=chat_type)
+        self.message = SimpleNamespace(chat=chat, chat_id=chat_id, message_id=message_id)
+        self.error = error
+        self.edits = []
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        if self.error is not None:
+            raise self.error
+        self.edits.append(text)
+        return text
+
+
+async def test_repeated_screen_is_skipped():
+    renderer = Renderer()
+    query = FakeQuery(1)
+    await renderer.edit(query, "menu")
+    await renderer.edit(query, "menu")
+    await renderer.edit(query, "menu", parse_mode="HTML")
+    await renderer.edit(query, "profile")
+    assert query.edits == ["menu", "menu", "profile"]
+    assert renderer.stats["skipped"] == 1
+
+
+async def test_not_modified_is_not_an_error():
+    renderer = Renderer()
+    query = FakeQuery(1, error=BadRequest("Message is not modified"))
+    assert await renderer.edit(query, "menu") is None
+    assert renderer.stats["not_modified"] == 1
+    query.error = None
+    await renderer.edit(query, "menu")
+    assert query.edits == []
+
+
+async def test_failed_edit_forgets_the_screen():
+    renderer = Renderer()
+    query = FakeQuery(1)
+    await renderer.edit(query, "menu")
+    query.error = BadRequest("Message to edit not found")
+    with pytest.raises(BadRequest):
+        await renderer.edit(query, "profile")
+    query.error = None
+    await renderer.edit(query, "menu")
+    assert query.edits == ["menu", "menu"]
+
+
+async def test_fingerprints_are_bounded():
+    renderer = Renderer(max_messages=2)
+    for message_id in range(3):
+        await renderer.edit(FakeQuery(1, message_id=message_id), "menu")
+    assert list(renderer.fingerprints) == [(1, 1), (1, 2)]
+
+
+async def test_private_only_edits_group_messages_every_time():
+    # Два процесса, игроки одной группы нажимают кнопки одного сообщения
+    first, second = Renderer(private_only=True), Renderer(private_only=True)
+    query = FakeQuery(-100, ChatType.SUPERGROUP)
+    await first.edit(query, "menu")
+    await second.edit(query, "profile")
+    await first.edit(query, "menu")
+    assert query.edits == ["menu", "profile", "menu"]
+    assert first.get_stats()["tracked"] == 0
+
+
+async def test_private_only_skips_inline_messages_tracking():
+    renderer = Renderer(private_only=True)
+    query = FakeQuery(5, inline_message_id="inline")
+    await renderer.edit(query, "menu")
+    await renderer.edit(query, "menu")
+    assert query.edits == ["menu", "menu"]
+
+
+async def test_private_only_still_skips_private_chats():
+    renderer = Renderer(private_only=True)
+    query = FakeQuery(7)
+    await renderer.edit(query, "menu")
+    await renderer.edit(query, "menu")
+    assert query.edits == ["menu"]
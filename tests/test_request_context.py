@@ -0,0 +1,81 @@
+"""RequestContext поверх UserCache: изменения не попадают в кэш до записи"""
+
+import pytest
+
+from request_context import RequestContext, request_scoped
+
+
+async def test_mutations_stay_private_until_flush(cache, make_player):
+    await make_player()
+    request = RequestContext(cache, 1)
+    user = await request.get_user(("money", "statistics", "reputation"))
+    money = user["money"]
+
+    request.mutate(inc={"money": 250, "statistics.games_played": 1}, reason="test")
+    assert request.user["money"] == money + 250
+    cached = await cache.get_user(1, ("money", "statistics", "reputation"))
+    assert cached["money"] == money and cached["statistics"]["games_played"] == 0
+    # Копируются только изменяемые поля
+    assert request.user["reputation"] is cached["reputation"]
+
+    doc = await request.flush()
+    assert doc is await cache.get_user(1)
+    assert doc["money"] == money + 250 and doc["statistics"]["games_played"] == 1
+
+
+async def test_rejected_flush_reloads_without_changes(storage, cache, make_player):
+    await make_player()
+    request = RequestContext(cache, 1)
+    user = await request.get_user(("money", "daily_bonus_time", "version"))
+    money, version = user["money"], user["version"]
+    assert await storage.update_user(1, {"name": "Renamed"})
+
+    request.mutate(inc={"money": 1000}, set_fields={"daily_bonus_time": "2026-01-01T00:00:00"})
+    assert await request.flush(expected_version=version) is None
+    assert not request.dirty and not request.missing
+    assert request.user["money"] == money and request.user["version"] == version + 1
+
+    for doc in (await cache.get_user(1), await storage.get_user(1)):
+        assert doc["money"] == money
+        assert not doc.get("daily_bonus_time")
+
+
+async def test_rejected_bet_keeps_the_request_usable(cache, make_player):
+    await make_player()
+    request = RequestContext(cache, 1)
+    money = (await request.get_user(("money",)))["money"]
+    request.mutate(inc={"money": -(money + 1)})
+    assert await request.flush(min_money=money + 1) is None
+    assert request.user["money"] == money
+
+    request.mutate(inc={"money": -money})
+    assert (await request.flush(min_money=money))["money"] == 0
+
+
+async def test_discard_drops_pending_changes(cache, make_player):
+    await make_player()
+    request = RequestContext(cache, 1)
+    money = (await request.get_user(("money",)))["money"]
+    request.mutate(inc={"money": 500})
+    request.discard()
+    assert not request.dirty
+    assert (await request.get_user(("money",)))["money"] == money
+
+
+async def test_handler_error_discards_pending_changes(storage, cache, make_player):
+    await make_player()
+    money = (await cache.get_user(1))["money"]
+
+    async def handler(update, context):
+        await context.request.get_user(("money",))
+        context.request.mutate(inc={"money": 500})
+        raise RuntimeError("handler failed")
+
+    update = type("Update", (), {"effective_user": type("User", (), {"id": 1})()})()
+    context = type("Context", (), {})()
+    with pytest.raises(RuntimeError):
+        await request_scoped(cache)(handler)(update, context)
+
+    assert (await cache.get_user(1))["money"] == money
+    await cache.flush()
+    assert (await storage.get_user(1))["money"] == money
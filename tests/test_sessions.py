@@ -0,0 +1,52 @@
+"""Игровые сессии: версии против повторных нажатий, истечение и очистка"""
+
+import pytest
+
+from sessions import SessionStore, blackjack_hand, blackjack_state, create_session_store, encode_cards
+from storage import MemoryStorage
+
+
+async def test_stale_version_is_rejected(backend):
+    sessions = SessionStore(backend)
+    version = await sessions.start(1, "blackjack", {"b": 100})
+    assert await sessions.get(1, "blackjack") == {"state": {"b": 100}, "version": version}
+
+    # Двойное нажатие "взять карту": второй ход видел ту же версию
+    assert await sessions.update(1, "blackjack", {"b": 100, "hit": 1}, version) == version + 1
+    assert await sessions.update(1, "blackjack", {"b": 100, "hit": 2}, version) is None
+    assert not await sessions.finish(1, "blackjack", version)
+    assert await sessions.finish(1, "blackjack", version + 1)
+    assert await sessions.get(1, "blackjack") is None
+    assert sessions.get_stats()["conflicts"] == 2
+
+
+async def test_new_game_continues_version_count(backend):
+    sessions = SessionStore(backend)
+    first = await sessions.start(1, "dice", {"bet": 10})
+    second = await sessions.start(1, "dice", {"bet": 20})
+    # Кнопки прошлой игры не подходят к новой
+    assert second > first
+    assert await sessions.update(1, "dice", {"bet": 30}, first) is None
+
+
+async def test_expired_sessions_are_hidden_and_purged(backend):
+    sessions = SessionStore(backend, ttl=-1)
+    await sessions.start(1, "roulette", {"bet": 10})
+    await sessions.start(2, "roulette", {"bet": 10})
+    assert await sessions.get(1, "roulette") is None
+    assert await sessions.purge() == 2
+    assert sessions.get_stats()["expired"] == 2
+
+
+def test_blackjack_state_roundtrip():
+    state = blackjack_state(50, ["10♥", "A♠"], ["K♦"])
+    assert state == {"b": 50, "p": encode_cards(["10♥", "A♠"]), "d": encode_cards(["K♦"])}
+    assert blackjack_hand(state) == (50, ["10♥", "A♠"], ["K♦"])
+
+
+def test_create_session_store():
+    storage = MemoryStorage()
+    assert create_session_store("storage", storage).storage is storage
+    assert create_session_store("memory", storage).storage is not storage
+    with pytest.raises(ValueError):
+        create_session_store("redis", storage)
@@ -0,0 +1,48 @@
+"""Снимок между перезапусками: горячие игроки, устаревшие и битые снимки"""
+
+import json
+import os
+import time
+import zlib
+
+from snapshot import SNAPSHOT_FORMAT, StateSnapshot
+from user_cache import UserCache
+
+
+async def test_roundtrip_warms_hot_users_in_lru_order(storage, make_player, tmp_path):
+    cache = UserCache(storage)
+    for user_id in (1, 2, 3):
+        await make_player(user_id)
+        await cache.get_user(user_id)
+    await cache.get_user(1)
+    snapshot = StateSnapshot(str(tmp_path / "state.bin"))
+
+    counts = await snapshot.save(cache)
+    assert counts["hot_users"] == 3
+
+    restarted = UserCache(storage)
+    assert await snapshot.load(restarted) == {"hot_users": 3}
+    assert list(restarted.entries) == list(cache.entries)
+    # Прочитанный снимок удаляется
+    assert not os.path.exists(snapshot.path)
+
+
+async def test_stale_or_corrupt_snapshot_is_ignored(storage, tmp_path):
+    cache = UserCache(storage)
+    snapshot = StateSnapshot(str(tmp_path / "state.bin"), max_age=60)
+    assert await snapshot.load(cache) == {"hot_users": 0}
+
+    state = {"format": SNAPSHOT_FORMAT, "saved_at": time.time() - 120, "hot_users": [1]}
+    with open(snapshot.path, "wb") as f:
+        f.write(zlib.compress(json.dumps(state).encode("utf-8")))
+    assert await snapshot.load(cache) == {"hot_users": 0}
+
+    # Снимок прежнего формата с сессиями user_data не применяется
+    state = {"format": 1, "saved_at": time.time(), "sessions": {"1": {"a": 1}}, "hot_users": [1]}
+    with open(snapshot.path, "wb") as f:
+        f.write(zlib.compress(json.dumps(state).encode("utf-8")))
+    assert await snapshot.load(cache) == {"hot_users": 0}
+
+    with open(snapshot.path, "wb") as f:
+        f.write(b"not a snapshot")
+    assert await snapshot.load(cache) == {"hot_users": 0}
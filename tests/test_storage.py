@@ -0,0 +1,129 @@
+"""Локальные хранилища игроков: операторы обновления и одинаковое поведение memory и SQLite"""
+
+import pytest
+
+from storage import (RANK_NAMES, MemoryStorage, apply_update, create_storage, derived_fields, matches, project,
+                     with_derived)
+
+
+async def _create_players(backend, count):
+    for user_id in range(1, count + 1):
+        await backend.create_user(user_id, f"p{user_id}", f"P{user_id}")
+        await backend.apply_delta(user_id, inc={"money": user_id * 100})
+
+
+async def test_iter_users_pages_in_user_id_order(backend):
+    await _create_players(backend, 7)
+    users = [user async for user in backend.iter_users(projection={"user_id": 1, "money": 1}, batch_size=3)]
+    assert [user["user_id"] for user in users] == list(range(1, 8))
+    assert set(users[0]) <= {"_id", "user_id", "money"}
+
+    resumed = [user["user_id"] async for user in backend.iter_users(after_user_id=4, batch_size=2)]
+    assert resumed == [5, 6, 7]
+
+
+async def test_iter_users_filters_by_query(backend):
+    await _create_players(backend, 5)
+    await backend.update_user(2, {"banned": True})
+    banned = [user["user_id"] async for user in backend.iter_users({"banned": True})]
+    assert banned == [2]
+
+
+async def test_users_summary(backend):
+    assert await backend.get_users_summary() == {"total": 0, "banned": 0, "total_money": 0}
+    await _create_players(backend, 3)
+    await backend.update_user(3, {"banned": True})
+    start_money = (await backend.get_user(1))["money"] - 100
+
+    summary = await backend.get_users_summary()
+    assert summary == {"total": 3, "banned": 1, "total_money": 3 * start_money + 600}
+
+
+def test_apply_update_operators():
+    doc = {"money": 10, "statistics": {"games": 1}, "territories": ["a"]}
+    apply_update(
+        doc,
+        inc={"money": 5, "statistics.games": 1, "statistics.wins": 1},
+        set_fields={"rank": "boss"},
+        push={"territories": "b", "achievements": "first"},
+        pull={"territories": "a"}
+    )
+    assert doc == {
+        "money": 15,
+        "statistics": {"games": 2, "wins": 1},
+        "territories": ["b"],
+        "achievements": ["first"],
+        "rank": "boss"
+    }
+
+
+def test_matches_and_project():
+    doc = {"user_id": 1, "money": 100, "territories": ["a"], "statistics": {"games": 3}}
+    assert matches(doc, {"money": {"$gte": 100}, "territories": "a"})
+    assert not matches(doc, {"money": {"$gt": 100}})
+    assert not matches(doc, {"territories": "b"})
+    assert project(doc, {"money": 1, "statistics.games": 1}) == {"money": 100, "statistics": {"games": 3}}
+
+
+def test_create_storage_by_name():
+    assert isinstance(create_storage("memory"), MemoryStorage)
+    with pytest.raises(ValueError):
+        create_storage("redis")
+
+
+async def test_apply_delta_guards(backend):
+    await backend.create_user(1, "player", "Player")
+    user = await backend.get_user(1)
+    money = user["money"]
+
+    doc = await backend.apply_delta(1, inc={"money": -money}, min_money=money)
+    assert doc["money"] == 0
+    assert await backend.apply_delta(1, inc={"money": -1}, min_money=1) is None
+    assert await backend.apply_delta(1, inc={"money": 1}, expected_version=user["version"]) is None
+    assert await backend.apply_delta(2, inc={"money": 1}) is None
+    assert (await backend.get_user(1))["money"] == 0
+
+
+async def test_versioned_update(backend):
+    await backend.create_user(1, "player", "Player")
+    version = (await backend.get_user(1))["version"]
+    assert await backend.update_user(1, {"name": "A"}, expected_version=version)
+    assert not await backend.update_user(1, {"name": "B"}, expected_version=version)
+    user = await backend.get_user(1, fields=("name", "version"))
+    assert user["name"] == "A" and user["version"] == version + 1
+
+
+async def test_top_users_order(backend):
+    await _create_players(backend, 3)
+    top = await backend.get_top_users("money", limit=2)
+    assert [user["user_id"] for user in top] == [3, 2]
+
+
+def test_with_derived_tracks_counters_and_version():
+    inc, set_fields, guard = with_derived(
+        inc={"reputation.mafia": 5, "reputation.police": -2},
+        set_fields={"rank": RANK_NAMES[0]},
+        push={"territories": "a"}
+    )
+    assert inc["version"] == 1
+    assert inc["reputation_total"] == 3
+    assert inc["territory_count"] == 1
+    assert set_fields["rank_index"] == 0
+    assert guard == {}
+
+    inc, _, guard = with_derived(pull={"territories": "a"})
+    assert inc["territory_count"] == -1
+    assert guard == {"territories": "a"}
+
+
+async def test_derived_fields_stay_consistent(backend):
+    await backend.create_user(1, "player", "Player")
+    await backend.apply_delta(1, push={"territories": "a"}, inc={"reputation.mafia": 4})
+    # Потеря территории, которой нет, не уменьшает счетчик
+    assert await backend.apply_delta(1, pull={"territories": "b"}) is None
+    await backend.update_user(1, {"rank": RANK_NAMES[1]})
+    user = await backend.get_user(1)
+    assert user["territory_count"] == len(user["territories"]) == 1
+    assert user["reputation_total"] == sum(user["reputation"].values())
+    assert {key: user[key] for key in derived_fields(user)} == derived_fields(user)
+    assert user["rank_index"] == 1
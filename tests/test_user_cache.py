@@ -0,0 +1,116 @@
+"""UserCache поверх MemoryStorage: атомарные изменения, проекции и условные записи"""
+
+import asyncio
+
+from storage import fields_projection
+from user_locks import KeyedLock
+
+
+async def test_guarded_bets_never_overdraw(storage, cache, make_player):
+    await make_player(money=1000)
+    results = await asyncio.gather(*(
+        cache.apply_delta(1, inc={"money": -300}, min_money=300) for _ in range(10)
+    ))
+    assert sum(doc is not None for doc in results) == 3
+    assert (await cache.get_user(1))["money"] == 100
+    assert (await storage.get_user(1))["money"] == 100
+
+
+async def test_apply_delta_carries_pending_fields(storage, cache, make_player):
+    await make_player(money=1000)
+    await cache.get_user(1)
+    await cache.update_user(1, {"last_crime_time": 123})
+
+    await cache.apply_delta(1, inc={"money": 50})
+    stored = await storage.get_user(1)
+    assert stored["last_crime_time"] == 123 and stored["money"] == 1050
+    assert not cache.entries[1].dirty
+
+
+async def test_apply_delta_writes_overlapping_pending_path_first(storage, cache, make_player):
+    await make_player()
+    await cache.get_user(1)
+    await cache.update_user(1, {"statistics.games_played": 7})
+
+    doc = await cache.apply_delta(1, inc={"statistics.games_played": 1})
+    assert doc["statistics"]["games_played"] == 8
+    assert (await storage.get_user(1))["statistics"]["games_played"] == 8
+
+
+def test_fields_projection():
+    assert fields_projection(None) is None
+    assert fields_projection(("money", "rank")) == {"user_id": 1, "money": 1, "rank": 1}
+
+
+async def test_partial_load_reads_only_missing_fields(storage, cache, make_player):
+    await make_player(money=500)
+    doc = await cache.get_user(1, ("money",))
+    assert doc["money"] == 500 and "rank" not in doc
+    assert cache.stats["misses"] == 1
+
+    await cache.get_user(1, ("money",))
+    assert cache.stats["hits"] == 1
+
+    await cache.update_user(1, {"money": 700})
+    doc = await cache.get_user(1, ("money", "rank"))
+    # Дочитанные из базы поля не затирают несохраненные изменения
+    assert doc["money"] == 700 and "rank" in doc
+    assert cache.stats["misses"] == 2
+    assert cache.entries[1].fields == {"money", "rank"}
+
+    full = await cache.get_user(1)
+    assert "statistics" in full and cache.entries[1].fields is None
+    assert (await cache.get_user(1, ("territories",))) is full
+
+
+async def test_apply_delta_version_conflict_reloads_entry(storage, cache, make_player):
+    await make_player()
+    version = (await cache.get_user(1))["version"]
+
+    # Запись в обход кэша (админ-команда, другой процесс) меняет версию
+    assert await storage.update_user(1, {"name": "Renamed"})
+
+    assert await cache.apply_delta(1, inc={"money": 100}, expected_version=version) is None
+    fresh = await cache.get_user(1)
+    assert fresh["version"] == version + 1
+    assert fresh["name"] == "Renamed"
+
+    # Повтор с перечитанной версией проходит, а не ждет истечения ttl
+    money = fresh["money"]
+    doc = await cache.apply_delta(1, inc={"money": 100}, expected_version=fresh["version"])
+    assert doc["money"] == money + 100
+
+
+async def test_apply_delta_version_conflict_keeps_pending_changes(storage, cache, make_player):
+    await make_player()
+    version = (await cache.get_user(1))["version"]
+    assert await cache.update_user(1, {"last_crime_time": 123})
+    assert await storage.update_user(1, {"name": "Renamed"})
+
+    assert await cache.apply_delta(1, inc={"money": 100}, expected_version=version) is None
+    assert (await storage.get_user(1))["last_crime_time"] == 123
+    assert (await cache.get_user(1))["last_crime_time"] == 123
+
+
+async def test_apply_delta_min_money_keeps_entry(cache, make_player):
+    await make_player()
+    user = await cache.get_user(1)
+    assert await cache.apply_delta(1, inc={"money": -1}, min_money=user["money"] + 1) is None
+    assert cache.entries.get(1) is not None
+
+
+async def test_keyed_lock_serializes_one_key_only():
+    locks = KeyedLock()
+    order = []
+
+    async def step(key, name):
+        async with locks.hold(key):
+            order.append(f"{name}+")
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            order.append(f"{name}-")
+
+    await asyncio.gather(step(1, "a"), step(1, "b"), step(2, "c"))
+    assert order.index("a-") < order.index("b+")
+    assert order.index("c+") < order.index("a-")
+    assert locks.get_stats() == {"acquired": 3, "contended": 1, "active": 0}
@@ -0,0 +1,75 @@
+"""Webhook-сервер: проверка секретного токена, обратное давление и остановка"""
+
+import asyncio
+import json
+
+import pytest
+
+from webhook_server import SECRET_HEADER, WebhookServer
+
+
+async def post(port, data, token="secret", path="/telegram"):
+    """Отправляет один POST и возвращает код ответа"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = json.dumps(data).encode()
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: test\r\n{SECRET_HEADER}: {token}\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+async def start(server):
+    await server.start("127.0.0.1", 0)
+    return server._server.sockets[0].getsockname()[1]
+
+
+def test_secret_token_is_required():
+    with pytest.raises(ValueError):
+        WebhookServer(None, "")
+
+
+async def test_rejects_wrong_token_and_dispatches_valid_updates():
+    received = []
+
+    async def dispatch(data):
+        received.append(data)
+
+    server = WebhookServer(None, "secret", dispatch=dispatch, workers=2)
+    port = await start(server)
+    try:
+        assert await post(port, {"update_id": 1}, token="wrong") == 403
+        assert await post(port, {"update_id": 2}, path="/other") == 404
+        assert await post(port, {"update_id": 3}) == 200
+    finally:
+        await server.stop()
+    assert received == [{"update_id": 3}]
+    assert server.stats["rejected_auth"] == 1 and server.stats["processed"] == 1
+
+
+async def test_full_queue_answers_503_and_drains_on_stop():
+    release = asyncio.Event()
+    received = []
+
+    async def dispatch(data):
+        await release.wait()
+        received.append(data["update_id"])
+
+    server = WebhookServer(None, "secret", dispatch=dispatch, workers=1, queue_size=1)
+    port = await start(server)
+    assert await post(port, {"update_id": 1}) == 200
+    await asyncio.sleep(0.01)
+    assert await post(port, {"update_id": 2}) == 200
+    # Обработчик занят первым обновлением, второе ждет в очереди
+    assert await post(port, {"update_id": 3}) == 503
+    assert server.stats["rejected_full"] == 1
+
+    stopping = asyncio.create_task(server.stop(drain_timeout=5))
+    await asyncio.sleep(0.01)
+    assert not server.accepting
+    release.set()
+    await stopping
+    assert received == [1, 2]
@@ -0,0 +1,46 @@
+"""Разбиение обновлений по процессам: согласованный хеш и отправитель обновления"""
+
+from collections import Counter
+
+from workers import HashRing, update_user_id, worker_path
+
+
+def test_player_always_maps_to_same_worker():
+    ring = HashRing(4)
+    again = HashRing(4)
+    for user_id in range(1, 2000):
+        assert ring.node_for(user_id) == again.node_for(user_id)
+        assert 0 <= ring.node_for(user_id) < 4
+
+
+def test_load_is_balanced():
+    ring = HashRing(4)
+    load = Counter(ring.node_for(user_id) for user_id in range(1, 40001))
+    assert len(load) == 4
+    assert max(load.values()) / min(load.values()) < 1.25
+
+
+def test_adding_worker_moves_few_players():
+    before, after = HashRing(4), HashRing(5)
+    users = range(1, 20001)
+    moved = sum(before.node_for(user_id) != after.node_for(user_id) for user_id in users)
+    # В идеале переезжает 1/5 игроков; при обычном остатке от деления - около 4/5
+    assert moved / len(users) < 0.3
+
+
+def test_update_user_id_prefers_sender_over_chat():
+    group_tap = {
+        "update_id": 1,
+        "callback_query": {
+            "id": "1",
+            "from": {"id": 42, "is_bot": False, "first_name": "A"},
+            "message": {"message_id": 1, "chat": {"id": -100, "type": "supergroup"}}
+        }
+    }
+    assert update_user_id(group_tap) == 42
+    assert update_user_id({"update_id": 2, "my_chat_member": {"chat": {"id": -5}}}) == -5
+    assert update_user_id({"update_id": 3}) is None
+
+
+def test_worker_path():
+    assert worker_path("state_snapshot.bin", 2) == "state_snapshot.bin.2"
@@ -83,6 +83,7 @@ ARMENIAN_TRANSLATIONS = {
     "top_rank": "📊 **Դասակարգում ըստ կոչման** 📊\n\n",
     "top_reputation": "📊 **Դասակարգում ըստ հեղինակության** 📊\n\n",
     "top_territories": "📊 **Դասակարգում ըստ տարածքների** 📊\n\n",
+    "top_my_position": "\n👤 Ձեր տեղը: {place}. {value}",
     
     # Ежедневный бонус
     "daily_bonus_wait": "⏰ **Օրական բոնուս**\n\nՀաջորդ բոնուսը {hours}ժ {minutes}ր հետո",
@@ -102,6 +103,10 @@ ARMENIAN_TRANSLATIONS = {
     "in_jail": "❌ Դուք բանտում եք! Սպասեք ազատ արձակմանը",
     "unknown_command": "❌ Անհայտ հրաման",
     "error_occurred": "❌ Սխալ տեղի ունեցավ: Փորձեք կրկին",
+    "concurrent_update": "⏳ Ձեր տվյալները հենց նոր փոխվեցին: Փորձեք կրկին",
+    "stale_button": "⌛ Այս կոճակը հնացել է: Ահա թարմ մենյուն",
+    "too_fast": "⏳ Չափազանց արագ: Սպասեք մի պահ",
+    "blackjack_no_game": "🃏 Ակտիվ խաղ չկա: Ընտրեք գրավադրումը նոր խաղի համար",
     
     # Кнопки
     "back_button": "🔙 Հետ",
@@ -115,6 +120,7 @@ ARMENIAN_TRANSLATIONS = {
     "rank_smotryashchiy": "Սմոտրյաշչիյ",
     "rank_vor_v_zakone": "Գող օրենքով",
     "rank_don": "Դոն",
+    "rank_up": "🎉 **Նոր կոչում!** 🎉\n\n👑 Այժմ դուք **{rank}** եք",
     
     # Преступления
     "crime_pickpocket": "գրպանահատություն",
@@ -0,0 +1,457 @@
+"""
+Модуль кэша состояния пользователей
+Держит документы игроков в памяти и откладывает запись в базу (write-behind)
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from storage import set_path, get_path, derived_sets
+from rank_engine import RANK_LOCK
+
+logger = logging.getLogger(__name__)
+
+
+def _paths_overlap(a: str, b: str) -> bool:
+    """Проверяет, что один путь совпадает с другим или вложен в него"""
+    return a == b or a.startswith(b + ".") or b.startswith(a + ".")
+
+
+def _with_rank_lock(fields):
+    """Вместе со званием читаем и флаг его закрепления, иначе пересчет его перезапишет"""
+    if fields is None or "rank" not in fields:
+        return fields
+    return (*fields, RANK_LOCK)
+
+
+class CacheEntry:
+    """
+    Запись кэша: документ пользователя и его несохраненные поля
+    fields - загруженные верхнеуровневые поля (None - документ целиком)
+    """
+    __slots__ = ("doc", "dirty", "loaded_at", "fields")
+
+    def __init__(self, doc: Dict, fields: Optional[set] = None):
+        self.doc = doc
+        self.dirty: Dict = {}
+        self.loaded_at = time.monotonic()
+        self.fields = fields
+
+    def covers(self, fields: Optional[set]) -> bool:
+        """Есть ли в записи все запрошенные поля"""
+        if self.fields is None:
+            return True
+        return fields is not None and fields <= self.fields
+
+
+class UserCache:
+    """
+    Кэш пользователей перед MongoDB
+    Чтения обслуживаются из памяти, изменения копятся по полям и
+    сбрасываются одной пачкой по таймеру или при вытеснении записи
+    """
+
+    def __init__(self, db, max_size: int = 10000, ttl: float = 300, flush_interval: float = 2.0,
+                 rank_engine=None):
+        self.db = db
+        # RankEngine: звание пересчитывается после каждого изменения денег или репутации
+        self.rank_engine = rank_engine
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "flushes": 0,
+            "flushed_users": 0,
+            "flush_errors": 0,
+            "evictions": 0,
+            "expired": 0
+        }
+        self._writing: Dict[int, asyncio.Task] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.listeners: List[Callable] = []
+
+    def subscribe(self, listener: Callable):
+        """
+        Подписывает слушателя на изменения пользователей (create/update/apply_delta)
+        listener(user_id, changes, doc), где changes - inc/set/push/pull/reason
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, user_id, changes: Dict, doc: Dict):
+        for listener in self.listeners:
+            try:
+                listener(user_id, changes, doc)
+            except Exception as e:
+                logger.error(f"Ошибка слушателя изменений пользователя {user_id}: {e}")
+
+    # Чтение
+
+    async def get_user(self, user_id, fields=None):
+        """
+        Возвращает документ пользователя из кэша или из базы
+        fields - нужные верхнеуровневые поля; из базы читаются только недостающие
+        """
+        wanted = set(fields) if fields is not None else None
+        entry = self.entries.get(user_id)
+        if entry is not None and time.monotonic() - entry.loaded_at >= self.ttl:
+            # Запись устарела: сохраняем изменения и перечитываем
+            self.stats["expired"] += 1
+            await self._drop(user_id)
+            entry = None
+        if entry is not None and entry.covers(wanted):
+            self.stats["hits"] += 1
+            self.entries.move_to_end(user_id)
+            return entry.doc
+
+        self.stats["misses"] += 1
+        # Если запись этого игрока как раз сохраняется, дожидаемся ее
+        pending = self._writing.get(user_id)
+        if pending is not None:
+            await asyncio.shield(pending)
+
+        if entry is None:
+            doc = await self.db.get_user(user_id, _with_rank_lock(fields))
+            if doc is not None:
+                await self._store(user_id, doc, wanted)
+            return doc
+
+        # Дочитываем недостающие поля в уже закэшированный документ
+        missing = None if wanted is None else wanted - entry.fields
+        doc = await self.db.get_user(user_id, _with_rank_lock(missing))
+        if doc is None:
+            return None
+        if self.entries.get(user_id) is not entry:
+            # Запись вытеснили, пока шел запрос: читаем заново
+            return await self.get_user(user_id, fields)
+        entry.doc.update(doc)
+        for path, value in entry.dirty.items():
+            set_path(entry.doc, path, value)
+        entry.fields = None if wanted is None else entry.fields | wanted
+        self.entries.move_to_end(user_id)
+        return entry.doc
+
+    async def create_user(self, user_id, username, name):
+        """Создает пользователя в базе и сразу кладет его в кэш"""
+        doc = await self.db.create_user(user_id, username, name)
+        await self._store(user_id, doc)
+        self._notify(user_id, {"reason": "create"}, doc)
+        return doc
+
+    # Запись
+
+    async def update_user(self, user_id, updates: dict, expected_version: int = None) -> bool:
+        """
+        Применяет изменения к закэшированному документу и помечает поля грязными
+        Если пользователя нет в кэше, запись уходит в базу сразу
+        expected_version - сравнение с заменой по полю version: такая запись
+        всегда идет в базу сразу вместе с несохраненными полями игрока
+        Возвращает False, если версия не совпала
+        """
+        updates = {**updates, **derived_sets(updates)}
+        entry = self.entries.get(user_id)
+        if expected_version is not None:
+            return await self._update_versioned(user_id, entry, updates, expected_version)
+        if entry is None:
+            await self.db.update_user(user_id, updates)
+            # Без кэша слушателям доступны только верхнеуровневые поля
+            self._notify(user_id, {"set": updates}, {path: value for path, value in updates.items() if "." not in path})
+            return True
+
+        for path, value in updates.items():
+            set_path(entry.doc, path, value)
+            self._mark_dirty(entry, path, value)
+            if entry.fields is not None and "." not in path:
+                entry.fields.add(path)
+        self.entries.move_to_end(user_id)
+        self._notify(user_id, {"set": updates}, entry.doc)
+        await self._update_rank(user_id, entry.doc, updates)
+        return True
+
+    async def _update_versioned(self, user_id, entry: Optional[CacheEntry], updates: dict, expected_version: int) -> bool:
+        if entry is None:
+            if not await self.db.update_user(user_id, updates, expected_version):
+                return False
+            self._notify(user_id, {"set": updates}, {path: value for path, value in updates.items() if "." not in path})
+            return True
+
+        if entry.doc.get("version", 0) != expected_version:
+            return False
+        pending, entry.dirty = entry.dirty, {}
+        if any(_paths_overlap(a, b) for a in pending for b in updates):
+            # Пересекающиеся пути сохраняем отдельно; версию это не меняет
+            await self._write_batch({user_id: pending})
+            pending = {}
+        if not await self.db.update_user(user_id, {**pending, **updates}, expected_version):
+            # Документ изменили в обход кэша: сохраняем свои поля и перечитываем
+            entry.dirty = {**pending, **entry.dirty}
+            await self._drop(user_id)
+            return False
+
+        for path, value in updates.items():
+            set_path(entry.doc, path, value)
+        entry.doc["version"] = expected_version + 1
+        if self.entries.get(user_id) is entry:
+            self.entries.move_to_end(user_id)
+        self._notify(user_id, {"set": updates}, entry.doc)
+        await self._update_rank(user_id, entry.doc, updates)
+        return True
+
+    async def apply_delta(self, user_id, inc: dict = None, set_fields: dict = None,
+                          push: dict = None, pull: dict = None, min_money: int = None,
+                          reason: str = None, expected_version: int = None):
+        """
+        Атомарное изменение через базу (см. MongoDB.apply_delta)
+        Несохраненные поля пользователя уходят в том же запросе, а
+        закэшированный документ заменяется ответом базы
+        reason - причина изменения для слушателей (журнал транзакций и т.п.)
+        expected_version - версия, которую видел обработчик (None - без проверки)
+        """
+        entry = self.entries.get(user_id)
+        pending = {}
+        if entry is not None and entry.dirty:
+            operator_paths = [*(inc or {}), *(push or {}), *(pull or {}), *(set_fields or {})]
+            if any(_paths_overlap(a, b) for a in entry.dirty for b in operator_paths):
+                # Пересекающиеся пути нельзя объединить в одном запросе
+                await self._write_batch({user_id: entry.dirty})
+            else:
+                pending = entry.dirty
+            entry.dirty = {}
+
+        doc = await self.db.apply_delta(
+            user_id,
+            inc=inc,
+            set_fields={**pending, **(set_fields or {})},
+            push=push,
+            pull=pull,
+            min_money=min_money,
+            expected_version=expected_version
+        )
+
+        entry = self.entries.get(user_id)
+        if doc is None:
+            if entry is not None and pending:
+                entry.dirty = {**pending, **entry.dirty}
+            if entry is not None and expected_version is not None:
+                # Версия могла устареть (запись в обход кэша): перечитаем при следующем обращении
+                await self._drop(user_id)
+            return None
+
+        self._notify(user_id, {"inc": inc, "set": set_fields, "push": push, "pull": pull, "reason": reason}, doc)
+
+        if entry is not None:
+            # Обновляем документ на месте, чтобы ссылки в обработчиках не устарели
+            entry.doc.clear()
+            entry.doc.update(doc)
+            for path, value in entry.dirty.items():
+                set_path(entry.doc, path, value)
+            entry.fields = None
+            entry.loaded_at = time.monotonic()
+            self.entries.move_to_end(user_id)
+            doc = entry.doc
+        else:
+            await self._store(user_id, doc)
+        await self._update_rank(user_id, doc, inc, set_fields, push, pull)
+        return doc
+
+    async def _update_rank(self, user_id, doc: Dict, *operators: Optional[dict]):
+        """
+        Пересчитывает звание после изменения денег или репутации
+        Новое звание записывается как обычное отложенное изменение,
+        rank_index - вместе с ним (derived_sets), поэтому рейтинги узнают о нем
+        от слушателей; подписчики RankEngine получают событие смены звания
+        """
+        if self.rank_engine is None or not self.rank_engine.affected(*operators):
+            return
+        new_rank = self.rank_engine.evaluate(doc)
+        if new_rank is None:
+            return
+        old_rank = doc.get("rank")
+        await self.update_user(user_id, {"rank": new_rank})
+        self.rank_engine.notify(user_id, old_rank, new_rank)
+
+    @staticmethod
+    def _mark_dirty(entry: CacheEntry, path: str, value):
+        """Отмечает поле грязным так, чтобы пути в $set не пересекались"""
+        parts = path.split(".")
+        for i in range(1, len(parts)):
+            parent = ".".join(parts[:i])
+            if parent in entry.dirty:
+                # Уже сохраняется весь родительский объект целиком
+                entry.dirty[parent] = get_path(entry.doc, parent)
+                return
+        # Более общий путь перекрывает ранее отмеченные вложенные поля
+        prefix = path + "."
+        for dirty_path in [p for p in entry.dirty if p.startswith(prefix)]:
+            del entry.dirty[dirty_path]
+        entry.dirty[path] = value
+
+    async def flush(self):
+        """Сбрасывает все накопленные изменения одной пачкой"""
+        batch = {}
+        for user_id, entry in self.entries.items():
+            if entry.dirty:
+                batch[user_id] = entry.dirty
+                entry.dirty = {}
+        if batch:
+            await self._write_batch(batch)
+
+    async def _write_batch(self, batch: Dict[int, Dict]):
+        """Записывает пачку изменений; при ошибке возвращает поля в кэш"""
+        try:
+            await self.db.bulk_update_users(batch)
+            self.stats["flushes"] += 1
+            self.stats["flushed_users"] += len(batch)
+        except Exception as e:
+            self.stats["flush_errors"] += 1
+            logger.error(f"Ошибка сброса кэша пользователей: {e}")
+            for user_id, fields in batch.items():
+                entry = self.entries.get(user_id)
+                if entry is None:
+                    continue
+                # Более новые значения, записанные за время сброса, важнее
+                entry.dirty = {**fields, **entry.dirty}
+
+    # Вытеснение
+
+    async def _store(self, user_id, doc: Dict, fields: Optional[set] = None):
+        """Кладет документ в кэш и вытесняет самые старые записи"""
+        self.entries[user_id] = CacheEntry(doc, fields)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            oldest_id = next(iter(self.entries))
+            self.stats["evictions"] += 1
+            await self._drop(oldest_id)
+
+    async def _drop(self, user_id):
+        """Удаляет запись из кэша, сохраняя ее несохраненные поля"""
+        entry = self.entries.pop(user_id, None)
+        if entry is None or not entry.dirty:
+            return
+        task = asyncio.ensure_future(self.db.bulk_update_users({user_id: entry.dirty}))
+        self._writing[user_id] = task
+        try:
+            await task
+            self.stats["flushed_users"] += 1
+        except Exception as e:
+            self.stats["flush_errors"] += 1
+            logger.error(f"Ошибка записи вытесненного пользователя {user_id}: {e}")
+        finally:
+            if self._writing.get(user_id) is task:
+                del self._writing[user_id]
+
+    async def _expire(self):
+        """Удаляет записи с истекшим TTL"""
+        now = time.monotonic()
+        expired = [user_id for user_id, entry in self.entries.items() if now - entry.loaded_at >= self.ttl]
+        for user_id in expired:
+            self.stats["expired"] += 1
+            await self._drop(user_id)
+
+    # Фоновый сброс
+
+    def start(self):
+        """Запускает фоновый сброс изменений"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Останавливает фоновый сброс и сохраняет все изменения"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                await self._expire()
+            except Exception as e:
+                logger.error(f"Ошибка фонового сброса кэша: {e}")
+
+    # Прогрев после перезапуска (см. snapshot.py)
+
+    def hot_user_ids(self, limit: int) -> List:
+        """До limit игроков кэша, от недавно использованных к давним"""
+        user_ids = []
+        for user_id in reversed(self.entries):
+            if len(user_ids) >= limit:
+                break
+            user_ids.append(user_id)
+        return user_ids
+
+    async def warm(self, user_ids: List, concurrency: int = 32) -> int:
+        """
+        Заранее читает игроков в кэш (user_ids - от горячих к холодным)
+        Читаем с конца, чтобы порядок LRU совпал с порядком до перезапуска
+        Возвращает число загруженных; ошибки чтения не мешают запуску
+        """
+        loaded = 0
+        user_ids = list(reversed(user_ids[:self.max_size]))
+        for start in range(0, len(user_ids), concurrency):
+            results = await asyncio.gather(
+                *(self.get_user(user_id) for user_id in user_ids[start:start + concurrency]),
+                return_exceptions=True
+            )
+            loaded += sum(1 for doc in results if isinstance(doc, dict))
+        return loaded
+
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики кэша для подбора размера"""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "dirty": sum(1 for entry in self.entries.values() if entry.dirty),
+            "hit_ratio": self.stats["hits"] / lookups if lookups else 0.0
+        }
+
+    # Сквозные запросы
+
+    async def get_top_users(self, by="money", limit=10):
+        await self.flush()
+        return await self.db.get_top_users(by, limit)
+
+    async def iter_users(self, query: dict = None, projection: dict = None, batch_size: int = 500,
+                         after_user_id=None):
+        await self.flush()
+        async for user in self.db.iter_users(query, projection, batch_size, after_user_id):
+            yield user
+
+    async def get_users_summary(self):
+        await self.flush()
+        return await self.db.get_users_summary()
+
+    async def mark_chat_blocked(self, user_id) -> bool:
+        """
+        Помечает чат игрока недоступным сразу в базе
+        Рассылка идет по всем игрокам, а в многопроцессном режиме игрок закреплен
+        за своим процессом: запись через этот кэш там бы не увидели. Запись в базе
+        меняет версию документа, и кэш владельца перечитает его при конфликте
+        """
+        await self._drop(user_id)
+        return await self.db.update_user(user_id, {"chat_blocked": True})
+
+    async def get_broadcast_jobs(self, status: str = None):
+        return await self.db.get_broadcast_jobs(status)
+
+    async def save_broadcast_job(self, job: Dict):
+        await self.db.save_broadcast_job(job)
+
+    async def ensure_indexes(self):
+        return await self.db.ensure_indexes()
+
+    async def check_query_plans(self):
+        return await self.db.check_query_plans()
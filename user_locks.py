@@ -0,0 +1,75 @@
+"""
+Модуль последовательной обработки по игрокам
+Обновления одного игрока выполняются строго по очереди, разных игроков -
+параллельно (Application строится с concurrent_updates)
+"""
+
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from typing import Dict
+
+
+class KeyedLock:
+    """
+    Набор asyncio.Lock по ключу (user_id)
+    Замок существует, пока его кто-то держит или ждет, поэтому память
+    не растет с числом игроков
+    """
+
+    def __init__(self):
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.waiters: Dict[int, int] = {}
+        self.stats = {"acquired": 0, "contended": 0}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    async def acquire(self, key):
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        elif lock.locked():
+            self.stats["contended"] += 1
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._release_waiter(key)
+            raise
+        self.stats["acquired"] += 1
+
+    def release(self, key):
+        self.locks[key].release()
+        self._release_waiter(key)
+
+    def _release_waiter(self, key):
+        self.waiters[key] -= 1
+        if not self.waiters[key]:
+            del self.waiters[key]
+            del self.locks[key]
+
+    def serialized(self, handler):
+        """
+        Оборачивает обработчик PTB так, чтобы обновления одного игрока
+        не выполнялись одновременно
+        """
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            user = getattr(update, "effective_user", None)
+            if user is None:
+                return await handler(update, context)
+            async with self.hold(user.id):
+                return await handler(update, context)
+        return wrapper
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, "active": len(self.locks)}
+
+
+user_locks = KeyedLock()
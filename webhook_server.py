@@ -0,0 +1,259 @@
+"""
+Модуль приема обновлений через webhook
+Встроенный асинхронный HTTP-сервер: проверяет секретный токен Telegram,
+кладет обновления в ограниченную очередь и отвечает 503, когда она полна
+(Telegram повторит доставку позже)
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    503: "Service Unavailable"
+}
+
+
+class WebhookServer:
+    """
+    HTTP-приемник обновлений Telegram
+    POST path - обновление (200, 403 при неверном токене, 503 при полной очереди),
+    GET /healthz - 200, пока сервер принимает обновления, 503 во время остановки
+    Вместо application.process_update обновления можно передавать в dispatch(data)
+    (супервизор многопроцессного режима, см. workers.py)
+    """
+
+    def __init__(self, application: Optional[Application], secret_token: str, path: str = "/telegram",
+                 queue_size: int = 1000, workers: int = 64, max_body: int = 1024 * 1024,
+                 read_timeout: float = 30, dispatch: Optional[Callable[[Dict], Awaitable]] = None):
+        if not secret_token:
+            raise ValueError("Для webhook нужен секретный токен (WEBHOOK_SECRET)")
+        self.application = application
+        self.dispatch = dispatch
+        self.secret_token = secret_token.encode()
+        self.path = path
+        self.max_body = max_body
+        self.read_timeout = read_timeout
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.accepting = False
+        self.stats = {
+            "received": 0,
+            "processed": 0,
+            "rejected_full": 0,
+            "rejected_auth": 0,
+            "bad_requests": 0,
+            "errors": 0
+        }
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._worker_tasks: List[asyncio.Task] = []
+
+    # HTTP
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            # Соединения keep-alive обслуживаются до закрытия клиентом
+            while True:
+                request = await asyncio.wait_for(self._read_request(reader), self.read_timeout)
+                if request is None:
+                    break
+                status, body, keep_alive = request
+                self._write_response(writer, status, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка обработки запроса webhook: {e}")
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """Читает один запрос; возвращает (статус, тело ответа, keep-alive) или None при EOF"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            self.stats["bad_requests"] += 1
+            return 400, b"", False
+        method, target, version = parts
+
+        headers: Dict[str, str] = {}
+        header_bytes = 0
+        while True:
+            line = await reader.readline()
+            header_bytes += len(line)
+            if header_bytes > 16 * 1024:
+                return 431, b"", False
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+        length_header = headers.get("content-length")
+        if method == "GET" and target == "/healthz":
+            return (200, b"ok", keep_alive) if self.accepting else (503, b"draining", False)
+        if target != self.path:
+            return 404, b"", False
+        if method != "POST":
+            return 405, b"", False
+        if length_header is None or not length_header.isdigit():
+            return 411, b"", False
+        length = int(length_header)
+        if length > self.max_body:
+            return 413, b"", False
+        body = await reader.readexactly(length)
+
+        # Токен сравнивается за постоянное время
+        token = headers.get(SECRET_HEADER, "").encode("latin-1")
+        if not hmac.compare_digest(token, self.secret_token):
+            self.stats["rejected_auth"] += 1
+            return 403, b"", keep_alive
+
+        if not self.accepting:
+            return 503, b"draining", False
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.stats["bad_requests"] += 1
+            return 400, b"", keep_alive
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # Обратное давление: Telegram повторит доставку позже
+            self.stats["rejected_full"] += 1
+            return 503, b"busy", keep_alive
+        self.stats["received"] += 1
+        return 200, b"", keep_alive
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: int, body: bytes, keep_alive: bool):
+        head = [
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+            f"Content-Length: {len(body)}",
+            "Content-Type: text/plain",
+            "Connection: keep-alive" if keep_alive else "Connection: close"
+        ]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+    # Обработка очереди
+
+    async def _worker(self):
+        while True:
+            data = await self.queue.get()
+            try:
+                if self.dispatch is not None:
+                    await self.dispatch(data)
+                else:
+                    await self.application.process_update(Update.de_json(data, self.application.bot))
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка обработки обновления из webhook: {e}")
+            finally:
+                self.queue.task_done()
+
+    # Жизненный цикл
+
+    async def start(self, host: str, port: int):
+        """Запускает обработчики очереди и начинает принимать соединения"""
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self.accepting = True
+        logger.info(f"Webhook-сервер слушает {host}:{port}{self.path}")
+
+    async def stop(self, drain_timeout: float = 30):
+        """
+        Перестает принимать обновления (новые запросы получают 503, и Telegram
+        доставит их другому экземпляру), дожидается обработки очереди и
+        останавливает обработчики
+        """
+        self.accepting = False
+        if self._server is not None:
+            self._server.close()
+            # Простаивающие keep-alive соединения иначе держали бы остановку
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Очередь webhook не разобрана за {drain_timeout} с: осталось {self.queue.qsize()}")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, "queue": self.queue.qsize(), "queue_size": self.queue.maxsize}
+
+
+async def run_webhook(application: Application, url: str, secret_token: str, listen: str = "0.0.0.0",
+                      port: int = 8443, path: str = "/telegram", queue_size: int = 1000,
+                      workers: int = 64, drain_timeout: float = 30):
+    """
+    Запускает приложение в режиме webhook до SIGINT/SIGTERM
+
+    Передача между экземплярами без простоя: новый экземпляр сначала
+    поднимает сервер и только потом вызывает set_webhook; старый по сигналу
+    отвечает 503 на новые запросы, дорабатывает очередь и завершается,
+    не удаляя webhook
+    """
+    server = WebhookServer(application, secret_token, path=path, queue_size=queue_size, workers=workers)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        await server.start(listen, port)
+        await application.bot.set_webhook(
+            url=url.rstrip("/") + path,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=min(100, max(1, workers))
+        )
+        logger.info(f"Webhook установлен: {url.rstrip('/')}{path}")
+        await stop_event.wait()
+        logger.info("Остановка webhook-сервера...")
+    finally:
+        await server.stop(drain_timeout)
+        logger.info(f"Webhook-сервер остановлен: {server.get_stats()}")
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
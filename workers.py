@@ -0,0 +1,492 @@
+"""
+Модуль многопроцессного режима
+Супервизор принимает обновления (polling или webhook) и раздает их N
+процессам-обработчикам по согласованному хешу user_id: все обновления игрока
+попадают в один процесс, поэтому его кэш, блокировки и игровые сессии остаются
+локальными. Супервизор проверяет процессы пингом, перезапускает упавшие и
+зависшие и повторно отправляет обновления, которые они не успели подтвердить
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+from webhook_server import WebhookServer
+
+logger = logging.getLogger(__name__)
+
+# Сообщения по каналу супервизор <-> обработчик (кортежи, первый элемент - вид)
+UPDATE = "update"  # (UPDATE, номер, данные обновления)
+ACK = "ack"  # (ACK, номер) - обновление обработано
+PING = "ping"  # (PING, метка)
+PONG = "pong"  # (PONG, метка)
+READY = "ready"  # (READY, pid) - обработчик готов принимать обновления
+STOP = "stop"  # (STOP,) - доработать начатое и завершиться
+
+POLL_TIMEOUT = 10  # Длинный опрос getUpdates (секунды)
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Согласованный хеш: каждый узел занимает replicas точек на кольце (1024 точки
+    дают перекос нагрузки между процессами в пределах нескольких процентов)
+    При изменении числа процессов переезжает лишь ~1/N игроков, а не почти все
+    """
+
+    def __init__(self, nodes: int, replicas: int = 1024):
+        points = sorted(
+            (ring_hash(f"{node}:{replica}"), node)
+            for node in range(nodes)
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node_for(self, key) -> int:
+        index = bisect.bisect(self.hashes, ring_hash(str(key)))
+        return self.nodes[index % len(self.nodes)]
+
+
+def update_user_id(data: Dict) -> Optional[int]:
+    """user_id отправителя из JSON обновления (для обновлений без отправителя - id чата или None)"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
+
+
+def worker_path(path: str, index: int) -> str:
+    """Путь к файлу процесса index (снимки состояния у каждого процесса свои)"""
+    return f"{path}.{index}"
+
+
+class Channel:
+    """
+    Канал супервизор <-> обработчик поверх пары сокетов: сообщения - pickle
+    с 4-байтной длиной. Запись не блокирует цикл событий (буферизуется
+    транспортом), поэтому стороны не могут взаимно заблокироваться на
+    переполненном канале, как при синхронных Connection.send
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, sock: socket.socket) -> "Channel":
+        reader, writer = await asyncio.open_connection(sock=sock)
+        return cls(reader, writer)
+
+    def send(self, message) -> bool:
+        if self.writer.is_closing():
+            return False
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        self.writer.write(len(payload).to_bytes(4, "big") + payload)
+        return True
+
+    async def recv(self):
+        """Следующее сообщение; EOFError, если другая сторона закрыла канал"""
+        try:
+            header = await self.reader.readexactly(4)
+            return pickle.loads(await self.reader.readexactly(int.from_bytes(header, "big")))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            raise EOFError from e
+
+    def close(self):
+        self.writer.close()
+
+
+# Сторона обработчика
+
+async def serve_worker(sock: socket.socket, process_update: Callable[[Dict], Awaitable],
+                       drain: Optional[Callable[[], Awaitable]] = None):
+    """
+    Цикл процесса-обработчика: обновления супервизора идут в process_update(data)
+    параллельно, каждое подтверждается после обработки. По STOP (или закрытию
+    канала) прием прекращается, вызывается drain() и ожидаются начатые обновления
+    Пинг обслуживает тот же цикл событий, поэтому зависший цикл не ответит на него
+    """
+    channel = await Channel.open(sock)
+    tasks = set()
+
+    async def process(number: int, data: Dict):
+        try:
+            await process_update(data)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {data.get('update_id')}: {e}")
+        finally:
+            channel.send((ACK, number))
+
+    channel.send((READY, os.getpid()))
+    while True:
+        try:
+            message = await channel.recv()
+        except EOFError:
+            # Супервизор завершился: дорабатываем начатое
+            break
+        kind = message[0]
+        if kind == UPDATE:
+            task = asyncio.create_task(process(message[1], message[2]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        elif kind == PING:
+            channel.send((PONG, message[1]))
+        elif kind == STOP:
+            break
+    if drain is not None:
+        await drain()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await channel.writer.drain()
+    channel.close()
+
+
+# Сторона супервизора
+
+class WorkerProcess:
+    """Процесс-обработчик со стороны супервизора: процесс, канал и неподтвержденные обновления"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.Process] = None
+        self.channel: Optional[Channel] = None
+        self.ready = False
+        # После сбоя неподтвержденные обновления повторяются по одному: номер текущего
+        self.probe: Optional[int] = None
+        self.started_at = 0.0
+        self.last_pong = 0.0
+        self.restarts = 0
+        self.processed = 0
+        # Номер -> [данные, попыток]; словарь хранит порядок отправки
+        self.pending: Dict[int, List] = {}
+        self.room = asyncio.Event()
+        self.room.set()
+        self._reader_task: Optional[asyncio.Task] = None
+
+    def get_stats(self) -> Dict:
+        return {
+            "pid": self.process.pid if self.process else None,
+            "alive": bool(self.process and self.process.is_alive()),
+            "ready": self.ready,
+            "pending": len(self.pending),
+            "processed": self.processed,
+            "restarts": self.restarts
+        }
+
+
+class Supervisor:
+    """
+    N процессов target(index, count, sock) и маршрутизация обновлений между ними
+    target должна быть функцией верхнего уровня модуля: процессы запускаются
+    через spawn и не наследуют состояние супервизора (соединения с базой, цикл
+    событий); sock - сокет канала, его обслуживает serve_worker
+
+    Доставка - не менее одного раза: обновление, не подтвержденное упавшим
+    процессом, отправляется его преемнику; после max_attempts попыток оно
+    отбрасывается, чтобы одно "ядовитое" обновление не роняло процесс бесконечно
+    """
+
+    def __init__(self, target: Callable, count: int, max_pending: int = 1000,
+                 ping_interval: float = 5, ping_timeout: float = 20, start_timeout: float = 120,
+                 max_attempts: int = 3, start_method: str = "spawn"):
+        if count < 1:
+            raise ValueError("Нужен хотя бы один процесс-обработчик")
+        self.target = target
+        self.count = count
+        self.max_pending = max_pending
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.start_timeout = start_timeout
+        self.max_attempts = max_attempts
+        self.ring = HashRing(count)
+        self.workers = [WorkerProcess(index) for index in range(count)]
+        self.stats = {"submitted": 0, "acked": 0, "replayed": 0, "dropped": 0, "restarts": 0}
+        self._context = multiprocessing.get_context(start_method)
+        self._next_number = 0
+        self._monitor_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    # Процессы
+
+    async def _spawn(self, worker: WorkerProcess):
+        parent, child = socket.socketpair()
+        process = self._context.Process(
+            target=self.target,
+            args=(worker.index, self.count, child),
+            name=f"worker-{worker.index}",
+            daemon=True
+        )
+        process.start()
+        child.close()
+        worker.process = process
+        worker.channel = await Channel.open(parent)
+        worker.ready = False
+        worker.started_at = time.monotonic()
+        worker._reader_task = asyncio.create_task(self._read(worker, worker.channel))
+        logger.info(f"Запущен обработчик {worker.index} (pid {process.pid})")
+
+    async def _detach(self, worker: WorkerProcess):
+        if worker._reader_task is not None and worker._reader_task is not asyncio.current_task():
+            worker._reader_task.cancel()
+            await asyncio.gather(worker._reader_task, return_exceptions=True)
+        worker._reader_task = None
+        if worker.channel is not None:
+            worker.channel.close()
+            worker.channel = None
+        worker.ready = False
+
+    async def _restart(self, worker: WorkerProcess, reason: str):
+        logger.error(f"Обработчик {worker.index} {reason}: перезапуск, неподтвержденных обновлений {len(worker.pending)}")
+        await self._detach(worker)
+        if worker.process.is_alive():
+            worker.process.kill()
+        await asyncio.to_thread(worker.process.join, 5)
+        worker.restarts += 1
+        self.stats["restarts"] += 1
+        await self._spawn(worker)
+
+    # Канал
+
+    async def _read(self, worker: WorkerProcess, channel: Channel):
+        while True:
+            try:
+                message = await channel.recv()
+            except EOFError:
+                # Процесс завершился; перезапуском займется монитор
+                worker.ready = False
+                return
+            kind = message[0]
+            if kind == ACK:
+                if worker.pending.pop(message[1], None) is not None:
+                    worker.processed += 1
+                    self.stats["acked"] += 1
+                if worker.probe is not None:
+                    self._send_pending(worker)
+                if len(worker.pending) < self.max_pending:
+                    worker.room.set()
+            elif kind == PONG:
+                worker.last_pong = time.monotonic()
+            elif kind == READY:
+                self._on_ready(worker)
+
+    def _on_ready(self, worker: WorkerProcess):
+        worker.ready = True
+        worker.probe = None
+        worker.last_pong = time.monotonic()
+        for number, entry in list(worker.pending.items()):
+            if entry[1] >= self.max_attempts:
+                worker.pending.pop(number)
+                self.stats["dropped"] += 1
+                logger.error(f"Обновление {entry[0].get('update_id')} отброшено после {entry[1]} попыток")
+        self._send_pending(worker)
+        if len(worker.pending) < self.max_pending:
+            worker.room.set()
+
+    def _send_pending(self, worker: WorkerProcess):
+        """
+        Отправляет неотправленное: неподтвержденное предшественником и
+        накопленное за время запуска процесса. Первое идет по одному, чтобы при
+        новом падении попытка засчиталась только обновлению, которое его вызвало
+        """
+        if worker.probe in worker.pending:
+            return
+        worker.probe = None
+        for number, entry in worker.pending.items():
+            if entry[1] > 0:
+                entry[1] += 1
+                self.stats["replayed"] += 1
+                worker.probe = number
+                worker.channel.send((UPDATE, number, entry[0]))
+                return
+        for number, entry in worker.pending.items():
+            if entry[1] == 0:
+                entry[1] = 1
+                worker.channel.send((UPDATE, number, entry[0]))
+
+    # Обновления
+
+    def worker_for(self, data: Dict) -> WorkerProcess:
+        user_id = update_user_id(data)
+        return self.workers[self.ring.node_for(user_id if user_id is not None else data.get("update_id"))]
+
+    async def submit(self, data: Dict):
+        """
+        Передает обновление процессу игрока; если у процесса max_pending
+        неподтвержденных обновлений, ждет (обратное давление на прием)
+        """
+        worker = self.worker_for(data)
+        while len(worker.pending) >= self.max_pending:
+            worker.room.clear()
+            await worker.room.wait()
+        self._next_number += 1
+        entry = [data, 0]
+        worker.pending[self._next_number] = entry
+        self.stats["submitted"] += 1
+        # Процессу, который еще запускается или повторяет обновления после сбоя, обновление уйдет позже
+        if worker.ready and worker.probe is None:
+            entry[1] = 1
+            worker.channel.send((UPDATE, self._next_number, data))
+
+    # Проверки
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            for worker in self.workers:
+                if self._closing:
+                    return
+                if not worker.process.is_alive():
+                    reason = f"завершился (код {worker.process.exitcode})"
+                elif worker.ready and now - worker.last_pong > self.ping_timeout:
+                    reason = f"не отвечает на проверку {now - worker.last_pong:.0f} с"
+                elif not worker.ready and now - worker.started_at > self.start_timeout:
+                    reason = f"не запустился за {self.start_timeout} с"
+                else:
+                    if worker.ready:
+                        worker.channel.send((PING, now))
+                    continue
+                await self._restart(worker, reason)
+
+    # Жизненный цикл
+
+    async def start(self, timeout: Optional[float] = None):
+        """Запускает процессы и ждет, пока каждый сообщит о готовности"""
+        for worker in self.workers:
+            await self._spawn(worker)
+        self._monitor_task = asyncio.create_task(self._monitor())
+        await asyncio.wait_for(self._wait_ready(), timeout if timeout is not None else self.start_timeout)
+        logger.info(f"Обработчиков запущено: {self.count}")
+
+    async def _wait_ready(self):
+        while not all(worker.ready for worker in self.workers):
+            await asyncio.sleep(0.05)
+
+    async def stop(self, timeout: float = 30):
+        """
+        Просит процессы доработать начатое и завершиться; подтверждения
+        принимаются до их выхода, не успевшие за timeout секунд завершаются принудительно
+        """
+        self._closing = True
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            await asyncio.gather(self._monitor_task, return_exceptions=True)
+            self._monitor_task = None
+        for worker in self.workers:
+            if worker.channel is not None:
+                worker.channel.send((STOP,))
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            while worker.process.is_alive() and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            if worker.process.is_alive():
+                logger.warning(f"Обработчик {worker.index} не завершился за {timeout} с и остановлен принудительно")
+                worker.process.kill()
+            await asyncio.to_thread(worker.process.join, 5)
+            # Подтверждения, отправленные перед выходом, еще могут быть в сокете
+            if worker._reader_task is not None:
+                await asyncio.wait([worker._reader_task], timeout=1)
+        for worker in self.workers:
+            await self._detach(worker)
+        lost = sum(len(worker.pending) for worker in self.workers)
+        if lost:
+            logger.warning(f"Остановка: {lost} обновлений не подтверждены обработчиками")
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, "workers": [worker.get_stats() for worker in self.workers]}
+
+
+# Прием обновлений супервизором
+
+async def _poll(bot: Bot, supervisor: Supervisor):
+    offset = None
+    await bot.delete_webhook()
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT,
+                                                allowed_updates=Update.ALL_TYPES)
+            except TelegramError as e:
+                logger.warning(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await supervisor.submit(update.to_dict())
+                offset = update.update_id + 1
+    finally:
+        if offset is not None:
+            # Подтверждаем Telegram полученное, чтобы после перезапуска оно не пришло снова
+            try:
+                await bot.get_updates(offset=offset, limit=1, timeout=0)
+            except TelegramError:
+                pass
+
+
+async def run_workers(target: Callable, count: int, token: str, mode: str = "polling",
+                      url: Optional[str] = None, secret_token: Optional[str] = None,
+                      listen: str = "0.0.0.0", port: int = 8443, path: str = "/telegram",
+                      queue_size: int = 1000, receivers: int = 64, stop_timeout: float = 30):
+    """
+    Запускает супервизор с count процессами до SIGINT/SIGTERM
+    Сам супервизор обновления не обрабатывает: в режиме polling он опрашивает
+    getUpdates, в режиме webhook принимает их встроенным HTTP-сервером
+    """
+    supervisor = Supervisor(target, count)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    bot = Bot(token)
+    await bot.initialize()
+    await supervisor.start()
+    server: Optional[WebhookServer] = None
+    poller: Optional[asyncio.Task] = None
+    try:
+        if mode == "webhook":
+            server = WebhookServer(None, secret_token, path=path, queue_size=queue_size,
+                                   workers=receivers, dispatch=supervisor.submit)
+            await server.start(listen, port)
+            await bot.set_webhook(
+                url=url.rstrip("/") + path,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=min(100, max(1, receivers))
+            )
+            logger.info(f"Webhook установлен: {url.rstrip('/')}{path}")
+        else:
+            poller = asyncio.create_task(_poll(bot, supervisor))
+        await stop_event.wait()
+        logger.info("Остановка: прием обновлений прекращен, обработчики дорабатывают начатое...")
+    finally:
+        if server is not None:
+            await server.stop(stop_timeout)
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        await supervisor.stop(stop_timeout)
+        logger.info(f"Супервизор остановлен: {supervisor.get_stats()}")
+        await bot.shutdown()